@@ -0,0 +1,255 @@
+'''
+Throughput / memory benchmarks for the processing in "obs_overlap",
+run on synthetic surveys (see "synthetic.py")
+
+Each observation is processed as in tests/test_obs_group_code.py:
+near-duplicate checking, ObsGroup construction (incl. assign_status),
+and then the tracklet-level processing (incl. categorize_overlap
+& the assignment to the destination tables)
+
+The time spent in each stage is recorded, along with the memory used,
+and the results can be saved as a named baseline & compared against
+later runs, so that regressions are easy to spot
+
+> cd benchmarks
+
+> python3 run_benchmarks.py --n_obs 10000 --save my_baseline
+
+> python3 run_benchmarks.py --n_obs 10000 --compare my_baseline
+
+'''
+
+# -------------------------------------------------------------
+# Third Party Imports
+# -------------------------------------------------------------
+import sys, os
+import argparse
+import json
+import time
+import resource
+import tracemalloc
+from collections import defaultdict
+from contextlib import contextmanager, redirect_stdout
+from functools import wraps
+
+# -------------------------------------------------------------
+# Local Imports
+# -------------------------------------------------------------
+from synthetic import SyntheticSurvey, DEFAULT_CONFIG
+
+from db import DB
+from sqlite_db import SQLiteDB
+from spatial import SPATIAL_ENGINES
+from obs import Obs
+from obs_group import ObsGroup
+from tracklet import Tracklet, set_up_independent_tracklets
+import tracklet
+from metrics import METRICS
+import near_dups
+import backfill
+
+
+# Where named baselines are saved
+BASELINE_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'baselines')
+
+# Stages that are timed: stage -> (class/module, attribute)
+STAGES = {
+    'near_dups'                 : (near_dups, 'find_similar_in_batches'),
+    'upgraded_check_near_dups'  : (Obs, 'upgraded_check_near_dups'),
+    'ObsGroup'                  : (ObsGroup, '__init__'),
+    'ObsGroup.assign_status'    : (ObsGroup, 'assign_status'),
+    'tracklet_processing'       : (Tracklet, 'tracklet_processing_A____Top_level_process_handler'),
+    'Tracklet.categorize_overlap': (Tracklet, 'categorize_overlap'),
+    'independent_tracklets'     : (tracklet, 'independent_tracklets'),
+    'categorize_overlaps'       : (tracklet, 'categorize_overlaps'),
+    'assign_to_DESIGNATED'      : (Tracklet, 'assign_to_DESIGNATED'),
+    'assign_to_ITF'             : (Tracklet, 'assign_to_ITF'),
+    'assign_to_UNSELECTABLE'    : (Tracklet, 'assign_to_UNSELECTABLE'),
+    'backfill.find_archive_pairs'   : (backfill, 'find_archive_pairs'),
+    'backfill.assign_status'        : (backfill, 'assign_status'),
+    'backfill.assign_destinations'  : (backfill, 'assign_destinations'),
+}
+
+# A slow-down (per observation) of more than this fraction is flagged as a regression
+REGRESSION_TOLERANCE = 0.2
+
+
+# -------------------------------------------------------------
+# Timing of stages
+# -------------------------------------------------------------
+class StageTimer():
+    '''
+    Accumulates the time (& optionally the net memory allocation) of
+    each stage, by temporarily wrapping the function for each stage
+    '''
+    def __init__(self, trace_memory=False):
+        self.seconds      = defaultdict(float)
+        self.calls        = defaultdict(int)
+        self.net_bytes    = defaultdict(int)
+        self.trace_memory = trace_memory
+
+    def timed(self, stage, func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if self.trace_memory:
+                before = tracemalloc.get_traced_memory()[0]
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.seconds[stage] += time.perf_counter() - start
+                self.calls[stage]   += 1
+                if self.trace_memory:
+                    self.net_bytes[stage] += tracemalloc.get_traced_memory()[0] - before
+        return wrapper
+
+    @contextmanager
+    def wrapping(self, stages=STAGES):
+        ''' Wrap the functions for all of the stages (restoring them afterwards) '''
+        originals = {stage : getattr(owner, name) for stage, (owner, name) in stages.items()}
+        try:
+            for stage, (owner, name) in stages.items():
+                setattr(owner, name, self.timed(stage, originals[stage]))
+            yield self
+        finally:
+            for stage, (owner, name) in stages.items():
+                setattr(owner, name, originals[stage])
+
+
+# -------------------------------------------------------------
+# Running a benchmark
+# -------------------------------------------------------------
+def run(config=DEFAULT_CONFIG, mode='batch', db_type='memory', spatial='healpix', trace_memory=False):
+    '''
+    Generate & process a synthetic survey
+
+    mode    : 'batch'  => near-duplicates found for each batch at once (near_dups.find_similar_in_batches)
+              'serial' => near-duplicates found for each observation (Obs.find_similar)
+              'backfill' => the whole survey is generated first, then processed in bulk (backfill.backfill)
+    db_type : 'memory' or 'sqlite'
+    spatial : spatial engine of the 'memory' DB (see obs_overlap/spatial.py)
+
+    returns:
+    --------
+    dict of results (see report)
+    '''
+    db     = DB(spatial=spatial) if db_type == 'memory' else SQLiteDB(':memory:')
+    survey = SyntheticSurvey(config)
+    timer  = StageTimer(trace_memory=trace_memory)
+    if trace_memory:
+        tracemalloc.start()
+
+    start, n_obs = time.perf_counter(), 0
+    with timer.wrapping(), open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+        if mode == 'backfill':
+            batches = list(survey.gen_batches(db))
+            with db.transaction():
+                n_obs = backfill.backfill(batches, db)['n_obs']
+        else:
+            for b in survey.gen_batches(db):
+                with db.transaction():
+                    similar = near_dups.find_similar_in_batches([b], db) if mode == 'batch' else None
+                    ahead   = set_up_independent_tracklets(b, db, similar) if mode == 'batch' else set()
+                    for t in b.tracklets.values():
+                        if t.TrackletID not in ahead:
+                            for ObsID, o in t.observations.items():
+                                ObsGroup(o, db, similar_obs=None if similar is None else similar[ObsID])
+                        t.tracklet_processing_A____Top_level_process_handler({}, db)
+                        n_obs += len(t.observations)
+    total = time.perf_counter() - start
+
+    results = {
+        'config'    : config._asdict(),
+        'mode'      : mode,
+        'db'        : db_type,
+        'spatial'   : spatial if db_type == 'memory' else None,
+        'n_obs'     : n_obs,
+        'kinds'     : dict(survey.counts),
+        'kind_rates': survey.rates(),
+        'stages'    : { stage : {'seconds'           : timer.seconds[stage],
+                                 'calls'             : timer.calls[stage],
+                                 'obs_per_second'    : n_obs / timer.seconds[stage] if timer.seconds[stage] else None,
+                                 'net_bytes'         : timer.net_bytes[stage] if trace_memory else None}
+                        for stage in STAGES if timer.calls[stage] },
+        'total'     : {'seconds' : total, 'obs_per_second' : n_obs / total},
+        'memory'    : dict(db.memory_report(), peak_rss_bytes=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024),
+        'destinations' : {'DESIGNATED' : len(db.DESIGNATED), 'ITF' : len(db.ITF), 'UNSELECTABLE' : len(db.UNSELECTABLE)},
+    }
+    if trace_memory:
+        results['memory']['peak_traced_bytes'] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return results
+
+def report(results, baseline=None):
+    ''' Print the results (& the ratio of the time per observation to that in the baseline) '''
+    print(f"n_obs={results['n_obs']} mode={results['mode']} db={results['db']} spatial={results.get('spatial')}")
+    print(f"kinds={results['kinds']}")
+    print('kind rates (configured / realised tracklets)= ' +
+          ' '.join(f"{k}:{r['configured']:.3f}/{r['realised'] or 0:.3f}" + (f"({r['owed']} owed)" if r['owed'] else '')
+                   for k, r in results['kind_rates'].items()))
+    print(f"destinations={results['destinations']}")
+    print(f"{'stage':30s} {'seconds':>10s} {'calls':>10s} {'obs/s':>12s} {'vs baseline':>12s}")
+    rows = list(results['stages'].items()) + [('TOTAL', results['total'])]
+    regressions = []
+    for stage, r in rows:
+        ratio = compare_stage(results, baseline, stage)
+        flag  = ''
+        if ratio is not None and ratio > 1. + REGRESSION_TOLERANCE:
+            flag = ' <== REGRESSION'
+            regressions.append(stage)
+        print(f"{stage:30s} {r['seconds']:10.3f} {r.get('calls', 1):10d} {r['obs_per_second'] or 0:12.1f} "
+              f"{'' if ratio is None else f'{ratio:12.2f}'}{flag}")
+    for k, v in results['memory'].items():
+        print(f'{k:30s} {v}')
+    return regressions
+
+def compare_stage(results, baseline, stage):
+    ''' Ratio of the time per observation for a stage to that in the baseline (None if not available) '''
+    if baseline is None:
+        return None
+    get = lambda r : r['total'] if stage == 'TOTAL' else r['stages'].get(stage)
+    new, old = get(results), get(baseline)
+    if not new or not old or not old['seconds']:
+        return None
+    return (new['seconds'] / results['n_obs']) / (old['seconds'] / baseline['n_obs'])
+
+def save_baseline(results, name):
+    os.makedirs(BASELINE_DIR, exist_ok=True)
+    with open(os.path.join(BASELINE_DIR, f'{name}.json'), 'w') as fh:
+        json.dump(results, fh, indent=2)
+
+def load_baseline(name):
+    with open(os.path.join(BASELINE_DIR, f'{name}.json')) as fh:
+        return json.load(fh)
+
+
+# -------------------------------------------------------------
+# Benchmark run
+# -------------------------------------------------------------
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Throughput / memory benchmarks on synthetic surveys')
+    parser.add_argument('--n_obs',          type=int,   default=DEFAULT_CONFIG.n_obs)
+    parser.add_argument('--obs_per_batch',  type=int,   default=DEFAULT_CONFIG.obs_per_batch)
+    parser.add_argument('--n_fields',       type=int,   default=DEFAULT_CONFIG.n_fields)
+    parser.add_argument('--seed',           type=int,   default=DEFAULT_CONFIG.seed)
+    parser.add_argument('--mode',           choices=['batch', 'serial', 'backfill'], default='batch')
+    parser.add_argument('--db',             choices=['memory', 'sqlite'], default='memory')
+    parser.add_argument('--spatial',        choices=list(SPATIAL_ENGINES), default='healpix', help='spatial engine for the near-duplicate shortlist (memory db)')
+    parser.add_argument('--tracemalloc',    action='store_true', help='record the net memory allocated by each stage (slow)')
+    parser.add_argument('--save',           help='save the results as a named baseline')
+    parser.add_argument('--compare',        help='compare the results with a named baseline')
+    parser.add_argument('--metrics',        help='also record the built-in metrics (see obs_overlap/metrics.py) & write a snapshot to this file')
+    args = parser.parse_args()
+
+    config   = DEFAULT_CONFIG._replace(n_obs=args.n_obs, obs_per_batch=args.obs_per_batch, n_fields=args.n_fields, seed=args.seed)
+    if args.metrics:
+        METRICS.enable()
+    results  = run(config, mode=args.mode, db_type=args.db, spatial=args.spatial, trace_memory=args.tracemalloc)
+    if args.metrics:
+        METRICS.dump(args.metrics)
+    baseline = load_baseline(args.compare) if args.compare else None
+    regressions = report(results, baseline)
+    if args.save:
+        save_baseline(results, args.save)
+    sys.exit(1 if regressions else 0)
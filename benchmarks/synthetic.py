@@ -0,0 +1,308 @@
+'''
+The functions in "synthetic" generate synthetic submissions
+(batches of tracklets of observations) at configurable scale,
+for benchmarking the processing in "obs_overlap"
+
+The model is deliberately simple, but includes the features
+that drive the cost of near-duplicate checking & grouping
+ - sky density: tracklets are placed in a fixed set of survey
+   fields, most of which are concentrated towards the ecliptic
+ - exact duplicates: re-submission of an earlier tracklet
+ - near duplicates: jittered positions & times, and (where
+   possible) an equivalent obscode (e.g. 568 <=> T09-T14)
+ - remeasurements: re-submission by the same actor, with
+   "Replaces" pointing at the original observations
+ - deleted tracklets
+ - C51-style re-submission-and-extension by the same actor
+ - submitter-supplied designations (some correct, some not)
+
+Batches are generated one at a time (see SyntheticSurvey.gen_batches) & only a
+bounded history of earlier tracklets is retained (for making
+duplicates), so arbitrarily large surveys can be generated in
+bounded memory
+
+'''
+
+# -------------------------------------------------------------
+# Third Party Imports
+# -------------------------------------------------------------
+import sys, os
+from collections import namedtuple, deque, Counter
+from datetime import datetime, timedelta
+import numpy as np
+
+# -------------------------------------------------------------
+# Local Imports
+# -------------------------------------------------------------
+sys.path.append(os.path.join(
+                    os.path.dirname(
+                        os.path.dirname(
+                            os.path.realpath(__file__))), 'obs_overlap'))
+
+from obs import Obs
+from tracklet import Tracklet
+from batch import Batch
+from obscodes import OBSCODES
+
+
+# -------------------------------------------------------------
+# Configuration
+# -------------------------------------------------------------
+SurveyConfig = namedtuple('SurveyConfig', [
+    'n_obs',                # Total number of observations
+    'obs_per_batch',        # (Approximate) number of observations per batch
+    'n_fields',             # Number of survey fields (fewer fields => denser sky)
+    'field_radius_deg',     # Radius of each field
+    'ecliptic_fraction',    # Fraction of fields near the ecliptic
+    'nights',               # Number of nights over which the observations are spread
+    'tracklet_length',      # (min, max) number of observations per tracklet
+    'p_exact',              # Probability that a tracklet is an exact duplicate
+    'p_near',               # ... a near-duplicate
+    'p_replaces',           # ... an explicit remeasurement (Replaces)
+    'p_deleted',            # ... deleted
+    'p_extend',             # ... a C51-style re-submission & extension
+    'p_desig',              # Probability that a new tracklet comes with a designation
+    'near_arcsec',          # Size of the positional jitter for near-duplicates
+    'near_seconds',         # Size of the time jitter for near-duplicates
+    'obscodes',             # Obscodes used for new tracklets
+    'n_actors',             # Number of submitting actors
+    'history',              # Number of earlier tracklets retained (per actor) for making duplicates
+    'seed',
+])
+
+DEFAULT_CONFIG = SurveyConfig(
+    n_obs               = 10000,
+    obs_per_batch       = 1000,
+    n_fields            = 200,
+    field_radius_deg    = 1.0,
+    ecliptic_fraction   = 0.8,
+    nights              = 10,
+    tracklet_length     = (3, 5),
+    p_exact             = 0.03,
+    p_near              = 0.05,
+    p_replaces          = 0.02,
+    p_deleted           = 0.01,
+    p_extend            = 0.02,
+    p_desig             = 0.2,
+    near_arcsec         = 1.0,
+    near_seconds        = 1.0,
+    obscodes            = ('568', 'T09', 'T10', 'T12', 'T14', 'F51', 'F52', 'C51', 'G96', '704'),
+    n_actors            = 20,
+    history             = 1000,
+    seed                = 0,
+)
+
+# The kinds of tracklet that are generated
+KINDS = ['new', 'exact', 'near', 'replaces', 'deleted', 'extend']
+
+# ... those that are made from an earlier tracklet
+DUPLICATES = ['exact', 'near', 'replaces', 'extend']
+
+# An earlier tracklet (retained for making duplicates)
+past_tracklet = namedtuple('past_tracklet', ['RA', 'Dec', 'MJD', 'ObsCode', 'desig', 'ObsIDs', 'rate'])
+
+# The start of the survey
+SURVEY_START_MJD    = 58900.0
+SUBMISSION_START    = datetime(2020, 4, 20)
+
+
+# -------------------------------------------------------------
+# Survey generator
+# -------------------------------------------------------------
+class SyntheticSurvey():
+    '''
+    Generates synthetic batches (see the module docstring)
+
+    Usage:
+    >>> survey = SyntheticSurvey(SurveyConfig(...))
+    >>> for batch in survey.gen_batches(db): ...
+    >>> survey.counts   # Number of observations of each kind
+    >>> survey.rates()  # Configured & realised fraction of tracklets of each kind
+    '''
+    def __init__(self, config=DEFAULT_CONFIG):
+        self.config  = config
+        self.rng     = np.random.default_rng(config.seed)
+        self.counts  = Counter()
+        self.n_kind  = Counter()
+        self.owed    = Counter()
+
+        # Survey fields: (RA, Dec) centres [deg]
+        n_ecl        = int(round(config.n_fields * config.ecliptic_fraction))
+        ra           = self.rng.uniform(0., 360., config.n_fields)
+        dec          = np.degrees(np.arcsin(self.rng.uniform(-1., 1., config.n_fields)))
+        dec[:n_ecl]  = np.clip(23.44*np.sin(np.radians(ra[:n_ecl])) + self.rng.normal(0., 5., n_ecl), -89., 89.)
+        self.fields  = np.stack([ra, dec], axis=1)
+
+        # Bounded history of earlier tracklets, per actor
+        self.past    = { actor : deque(maxlen=config.history) for actor in self.actors() }
+
+    def actors(self,):
+        return [f'A{i}' for i in range(self.config.n_actors)]
+
+    def rates(self,):
+        '''
+        The configured probability & the realised fraction of the tracklets of each kind,
+        & the number of duplicates that are still owed (see make_tracklet): these have
+        been generated as new tracklets
+        '''
+        c, total = self.config, sum(self.n_kind.values())
+        p = [c.p_exact, c.p_near, c.p_replaces, c.p_deleted, c.p_extend]
+        return { kind : {'configured' : configured, 'realised' : self.n_kind[kind] / total if total else None, 'owed' : self.owed[kind]}
+                 for kind, configured in zip(KINDS, [1. - sum(p)] + p) }
+
+    def has_past(self, kind, actor):
+        ''' Is there an earlier tracklet to make a duplicate of this kind from ? '''
+        return any(self.past.values()) if kind in ['exact', 'near'] else bool(self.past[actor])
+
+    def gen_batches(self, db):
+        ''' Generator of Batch objects (until n_obs observations have been generated) '''
+        n_obs, BatchNumber = 0, 0
+        while n_obs < self.config.n_obs:
+            batch = self.make_batch(db, BatchNumber, self.config.n_obs - n_obs)
+            n_obs       += sum(len(t.observations) for t in batch.tracklets.values())
+            BatchNumber += 1
+            yield batch
+
+    def make_batch(self, db, BatchNumber, max_obs):
+        '''
+        A single batch (from a single actor) of (about) obs_per_batch observations
+        N.B. The observations of the batch are created in the db as a single block
+        '''
+        c       = self.config
+        actor   = self.actors()[self.rng.integers(c.n_actors)]
+        n_max   = min(c.obs_per_batch, max_obs)
+
+        # Generate tracklets until the batch is full
+        tracklets, n = [], 0
+        while n < n_max:
+            t  = self.make_tracklet(actor)
+            tracklets.append(t)
+            n += len(t['MJD'])
+
+        # Create the observations (all at once), tracklets & batch
+        cat         = lambda key : np.concatenate([t[key] for t in tracklets])
+        catlist     = lambda key : [v for t in tracklets for v in t[key]]
+        observations= Obs.from_arrays(cat('RA'), cat('Dec'), cat('MJD'), catlist('ObsCode'),
+                                      catlist('Replaces'), catlist('desig'), catlist('Deleted'), db)
+        bounds      = np.cumsum([0] + [len(t['MJD']) for t in tracklets]).tolist()
+        batch       = Batch( (SUBMISSION_START + timedelta(minutes=BatchNumber)).isoformat(), actor,
+                             [Tracklet(observations[a:b], db) for a, b in zip(bounds[:-1], bounds[1:])],
+                             db)
+
+        # Remember the tracklets (for making duplicates later)
+        for t, a, b in zip(tracklets, bounds[:-1], bounds[1:]):
+            if not t['Deleted'][0]:
+                self.past[actor].append( past_tracklet(t['RA'], t['Dec'], t['MJD'], t['ObsCode'], t['desig'][0],
+                                                       [o.ObsID for o in observations[a:b]], t['rate']) )
+            self.counts[t['kind']] += len(t['MJD'])
+            self.n_kind[t['kind']] += 1
+        return batch
+
+    # -------------------------------------------------------------
+    # Tracklets
+    # -------------------------------------------------------------
+    def make_tracklet(self, actor):
+        '''
+        Make a tracklet of the randomly chosen kind
+        returns dict of arrays / lists (one entry per observation)
+        '''
+        c     = self.config
+        p     = np.array([c.p_exact, c.p_near, c.p_replaces, c.p_deleted, c.p_extend])
+        kind  = KINDS[self.rng.choice(len(KINDS), p=np.r_[1. - p.sum(), p])]
+
+        # Duplicates need an earlier tracklet: if there is none, a new tracklet is made
+        # instead, & the duplicate is owed: it is made in place of a later new tracklet
+        # (once there is an earlier tracklet), so the realised rates match the configured ones
+        if kind == 'new':
+            owed = [k for k in +self.owed if self.has_past(k, actor)]
+            if owed:
+                kind = owed[0]
+                self.owed[kind] -= 1
+        elif kind in DUPLICATES and not self.has_past(kind, actor):
+            self.owed[kind] += 1
+            kind = 'new'
+
+        # Exact / near duplicates of the tracklets of any actor (i.e. drawn from the history of
+        # all of them), but remeasurements / extensions of the same actor's tracklets
+        if kind in ['exact', 'near']:
+            sizes      = np.array([len(self.past[a]) for a in self.actors()])
+            candidates = self.past[self.actors()[self.rng.choice(c.n_actors, p=sizes/sizes.sum())]]
+        elif kind in ['replaces', 'extend']:
+            candidates = self.past[actor]
+        else:
+            candidates = None
+        past = None if candidates is None else candidates[self.rng.integers(len(candidates))]
+
+        if kind in ['new', 'deleted']:
+            t = self.new_tracklet(Deleted=(kind == 'deleted'))
+        elif kind == 'exact':
+            t = self.copy_tracklet(past)
+        elif kind == 'near':
+            t = self.copy_tracklet(past, jitter=True, equivalent=True)
+        elif kind == 'replaces':
+            t = self.copy_tracklet(past, jitter=True)
+            t['Replaces'] = list(past.ObsIDs)
+        elif kind == 'extend':
+            t = self.extend_tracklet(past)
+        t['kind'] = kind
+        return t
+
+    def new_tracklet(self, Deleted=False):
+        ''' A new tracklet, moving linearly within a survey field '''
+        c       = self.config
+        n       = self.rng.integers(c.tracklet_length[0], c.tracklet_length[1] + 1)
+        field   = self.fields[self.rng.integers(c.n_fields)]
+
+        # Start-point within the field (& start time on one of the nights)
+        r, phi  = c.field_radius_deg*np.sqrt(self.rng.uniform()), self.rng.uniform(0., 2.*np.pi)
+        Dec0    = np.clip(field[1] + r*np.sin(phi), -89.9, 89.9)
+        RA0     = (field[0] + r*np.cos(phi)/np.cos(np.radians(Dec0))) % 360.
+        MJD0    = SURVEY_START_MJD + self.rng.integers(c.nights) + self.rng.uniform(0.1, 0.4)
+
+        # Observations ~20-30 minutes apart, moving at a typical main-belt rate [deg/day]
+        rate    = self.rng.normal(0., 0.25, 2)
+        MJD     = MJD0 + np.cumsum(np.r_[0., self.rng.uniform(20., 30., n-1)]) / 1440.
+        ObsCode = c.obscodes[self.rng.integers(len(c.obscodes))]
+
+        # Some tracklets come with a (packed, provisional) designation
+        desig   = f'K20A{self.rng.integers(100):02d}{chr(65 + self.rng.integers(25))}' if self.rng.uniform() < c.p_desig else None
+        return self._tracklet(RA0, Dec0, MJD0, MJD, rate, ObsCode, desig, Deleted)
+
+    def copy_tracklet(self, past, jitter=False, equivalent=False):
+        '''
+        Copy of an earlier tracklet (an exact duplicate)
+        jitter     : perturb the positions & times (a near-duplicate)
+        equivalent : use an equivalent obscode (if there is one)
+        '''
+        c, n    = self.config, len(past.MJD)
+        RA, Dec, MJD = past.RA.copy(), past.Dec.copy(), past.MJD.copy()
+        if jitter:
+            RA  += self.rng.normal(0., c.near_arcsec/3600., n) / np.cos(np.radians(Dec))
+            Dec += self.rng.normal(0., c.near_arcsec/3600., n)
+            MJD += self.rng.normal(0., c.near_seconds, n) / 86400.
+        ObsCode = past.ObsCode[0]
+        if equivalent:
+            options = OBSCODES.equivalent_ObsCodes(ObsCode)
+            ObsCode = options[self.rng.integers(len(options))]
+        return self._arrays(RA % 360., np.clip(Dec, -90., 90.), MJD, past.rate, ObsCode, past.desig, False)
+
+    def extend_tracklet(self, past):
+        ''' Re-submission of an earlier tracklet by the same actor, extended by 1-2 observations '''
+        extra   = self.rng.integers(1, 3)
+        dMJD    = np.cumsum(self.rng.uniform(20., 30., extra)) / 1440.
+        MJD     = np.r_[past.MJD, past.MJD[-1] + dMJD]
+        t       = self._tracklet(past.RA[0], past.Dec[0], past.MJD[0], MJD, past.rate, past.ObsCode[0], past.desig, False)
+        t['RA'][:len(past.MJD)], t['Dec'][:len(past.MJD)] = past.RA, past.Dec
+        return t
+
+    def _tracklet(self, RA0, Dec0, MJD0, MJD, rate, ObsCode, desig, Deleted):
+        ''' Linear motion from (RA0, Dec0) at MJD0 '''
+        dt  = MJD - MJD0
+        Dec = np.clip(Dec0 + rate[1]*dt, -90., 90.)
+        RA  = (RA0 + rate[0]*dt/np.cos(np.radians(Dec0))) % 360.
+        return self._arrays(RA, Dec, MJD, rate, ObsCode, desig, Deleted)
+
+    def _arrays(self, RA, Dec, MJD, rate, ObsCode, desig, Deleted):
+        n = len(MJD)
+        return {'RA': RA, 'Dec': Dec, 'MJD': MJD, 'rate': rate,
+                'ObsCode': [ObsCode]*n, 'desig': [desig]*n, 'Deleted': [Deleted]*n, 'Replaces': [None]*n}
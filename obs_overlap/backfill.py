@@ -0,0 +1,322 @@
+'''
+The functions in "backfill" load an archive of previously-published
+observations in bulk ("BACKFILL" mode), rather than one observation
+at a time through ObsGroup & the tracklet-processing (which would
+take weeks for the whole archive)
+
+ (1) find_archive_pairs  : all of the near-duplicate pairs at once, by
+                           sort-and-sweep (see near_dups.find_pairs_sweep),
+                           plus the explicit remeasurements ("Replaces")
+ (2) similarity_groups   : the groups are the connected components of the pairs
+ (3) assign_status       : the credit & primary observation for each group
+ (4) assign_destinations : reduced tracklet-checks (NO orbit-fits): the
+                           archive is grandfathered in, & only the egregious
+                           problems are flagged
+
+The similarity groups are the same as those from processing the same
+observations (in the same order) through ObsGroup: the pairs are exactly
+those that near_dups.find_similar_in_batches would find (each observation
+against the *earlier* ones), & merging the groups as each observation
+arrives is just an incremental version of the connected components
+
+The status (credit & primary) of each group is also as for ObsGroup: both
+use all of the members of the group (see obs_group.GroupStatus)
+
+> batches = list( ingest.gen_batches(...) )
+> summary = backfill.backfill(batches, db)
+
+'''
+
+# -------------------------------------------------------------
+# Third Party Imports
+# -------------------------------------------------------------
+from collections import defaultdict
+import numpy as np
+
+# -------------------------------------------------------------
+# Local Imports
+# -------------------------------------------------------------
+from db import ObsStore, UNSELECTABLE, DESIGNATED, ITF
+import near_dups
+from obs_group import ObsGroup, GroupStatus
+from motion import fit_motion
+from metrics import METRICS
+
+
+# -------------------------------------------------------------
+# Top-level
+# -------------------------------------------------------------
+def backfill(batches, db, sideHP=32768, nestedHP=True, tileSide=None):
+    '''
+    Load the observations in the supplied batches (e.g. the whole archive)
+    into an empty db: similarity groups, status & destinations
+
+    Observations are taken in processing order (batch, tracklet, obs)
+
+    returns:
+    --------
+    summary : dict
+     - n_obs, n_pairs, n_groups & the number of tracklets in each destination
+     - flagged : dict of problem -> list of TrackletIDs (see assign_destinations)
+    '''
+    observations = near_dups.batch_observations(batches)
+    tracklets    = [t for b in batches for t in b.tracklets.values()]
+    assert not len(db.ACCEPTED), 'backfill is only for loading the archive into an empty db'
+    if not observations:
+        return _summary(0, 0, 0, np.zeros(len(tracklets), dtype=np.int8), {})
+    store = db.OBSSTORE
+    store.obscodes.refresh()
+
+    # Healpix for all of the observations at once (as per Obs.set_observation_healpix)
+    rows = np.array([o._row for o in observations])
+    store.columns['Healpix'][rows] = near_dups.radec_to_healpix(store['RA'][rows], store['Dec'][rows], sideHP=sideHP, nestedHP=nestedHP)
+
+    # (1) & (2) Similarity groups
+    t, c        = find_archive_pairs(store, rows, sideHP=sideHP, nestedHP=nestedHP, tileSide=tileSide)
+    group       = connected_components(len(rows), t, c)
+    obsgroups   = similarity_groups(db, observations, group)
+
+    # (3) Credit & primary observations
+    assign_status(db, obsgroups)
+    for obs in observations:
+        db.accept_observation(obs)
+
+    # (4) Destinations (& then the group categories that follow from them)
+    destination, flagged = assign_destinations(db, tracklets, observations, group, obsgroups)
+    categorize_groups(db, obsgroups, observations, group, np.repeat(destination, [len(t.observations) for t in tracklets]))
+    for tracklet in tracklets:
+        tracklet.release_observations(db)
+
+    return _summary(len(observations), len(t), len(obsgroups), destination, flagged)
+
+def _summary(n_obs, n_pairs, n_groups, destination, flagged):
+    ''' summary of a backfill (see backfill) '''
+    return {
+        'n_obs'     : n_obs,
+        'n_pairs'   : n_pairs,
+        'n_groups'  : n_groups,
+        'tracklets' : {name : int(np.sum(destination == d)) for name, d in [('DESIGNATED', DESIGNATED), ('ITF', ITF), ('UNSELECTABLE', UNSELECTABLE)]},
+        'flagged'   : flagged,
+    }
+
+
+# -------------------------------------------------------------
+# (1) & (2) Similarity groups
+# -------------------------------------------------------------
+def find_archive_pairs(store, rows, sideHP=32768, nestedHP=True, tileSide=None):
+    '''
+    All of the pairs of similar observations amongst the supplied rows of the ObsStore
+     - near-duplicates (see near_dups.find_pairs_sweep)
+     - explicit remeasurements (as per Obs.find_similar, the replaced observation must be earlier)
+
+    returns:
+    --------
+    index (into rows) of the later & the earlier observation of each pair
+    '''
+    A    = near_dups.observation_arrays(store, rows)
+    t, c = near_dups.find_pairs_sweep(A, store.obscodes.compiled.equivalence_class, sideHP=sideHP, nestedHP=nestedHP, tileSide=tileSide)
+
+    later    = np.flatnonzero(store['Replaces'][rows] != -1)
+    Replaces = store['Replaces'][rows][later]
+    sorter   = np.argsort(A['ObsID'], kind='stable')
+    earlier  = sorter[np.minimum(np.searchsorted(A['ObsID'], Replaces, sorter=sorter), len(sorter) - 1)]
+    found    = (A['ObsID'][earlier] == Replaces) & (earlier < later)
+    return np.r_[t, later[found]], np.r_[c, earlier[found]]
+
+def connected_components(n, a, b):
+    '''
+    Label the connected components of the graph with nodes 0, ..., n-1 & edges (a, b)
+
+    Each root (initially each node) is hooked onto the lowest root that it shares
+    an edge with, & the trees are then flattened (pointer-jumping), until
+    both ends of every edge have the same root
+
+    returns:
+    --------
+    component of each node: 0, 1, ... in order of the lowest node in each
+    '''
+    root = np.arange(n)
+    while True:
+        ra, rb = root[a], root[b]
+        differ = ra != rb
+        if not differ.any():
+            break
+        lower  = np.minimum(ra[differ], rb[differ])
+        np.minimum.at(root, ra[differ], lower)
+        np.minimum.at(root, rb[differ], lower)
+        while True:
+            jumped = root[root]
+            if np.array_equal(jumped, root):
+                break
+            root = jumped
+    return np.unique(root, return_inverse=True)[1].reshape(-1)
+
+def similarity_groups(db, observations, group):
+    '''
+    Create a similarity group for each component & label the observations with it
+
+    returns:
+    --------
+    list of ObsGroup (one per group, with nothing yet assigned)
+    '''
+    ObsIDs  = np.array([o.ObsID for o in observations])
+    members = _members(group)
+    SimilarityGroupIDs = db.SIMILARITYGROUPS.new_many([ObsIDs[m].tolist() for m in members])
+    db.set_SimilarityGroupID(ObsIDs.tolist(), np.array(SimilarityGroupIDs)[group])
+    return [ObsGroup.from_members(ID, [observations[i] for i in m.tolist()]) for ID, m in zip(SimilarityGroupIDs, members)]
+
+
+# -------------------------------------------------------------
+# (3) Status
+# -------------------------------------------------------------
+def assign_status(db, obsgroups):
+    '''
+    Credit & primary observation for each group (as per ObsGroup.assign_status)
+     - A single observation is both (unless it is Deleted)
+     - Anything else is built from the members (see GroupStatus)
+    N.B. The statuses are not kept: should a group be added to later,
+    its status is re-built (see GroupStatusTable)
+    '''
+    for obsgroup in obsgroups:
+        if len(obsgroup.observations) == 1:
+            ObsID, obs = next(iter(obsgroup.observations.items()))
+            if not obs.Deleted:
+                obsgroup.credit_ObsID = obsgroup.primary_ObsID = ObsID
+        else:
+            status = GroupStatus.from_members(db, obsgroup.observations.values())
+            obsgroup.credit_ObsID, obsgroup.primary_ObsID = status.credit_ObsID, status.primary_ObsID
+
+
+# -------------------------------------------------------------
+# (4) Destinations
+# -------------------------------------------------------------
+def assign_destinations(db, tracklets, observations, group, obsgroups):
+    '''
+    Reduced version of Tracklet.tracklet_processing_A/B/C (NO orbit-fits)
+
+     - UNSELECTABLE : any of the observations are in a group without a primary observation
+     - DESIGNATED   : the tracklet overlaps (exactly one) designated object, or else it
+                      was published with a designation (see Tracklet.do_name_comprehension)
+     - ITF          : anything else
+    ITF tracklets that share a group with a designated tracklet follow it into
+    DESIGNATED (as per Tracklet.itf_tracklets_sharing_groups)
+
+    Only the tracklets that share a group with another tracklet need to be looked
+    at one-at-a-time (in processing order), & only these can be flagged
+     - MULTIPLE_DESIGNATIONS    : overlaps > 1 designated object (=> UNSELECTABLE)
+     - INCONSISTENT_DESIGNATION : published designation differs from the one it overlaps
+
+    returns:
+    --------
+    destination of each tracklet (UNSELECTABLE / DESIGNATED / ITF)
+    flagged : dict of problem -> list of TrackletIDs
+    '''
+    n_obs       = np.array([len(t.observations) for t in tracklets])
+    starts      = np.cumsum(n_obs) - n_obs
+    tracklet    = np.repeat(np.arange(len(tracklets)), n_obs)
+
+    # Selectable, & any published designation
+    has_primary = np.array([og.primary_ObsID is not None for og in obsgroups])
+    selectable  = np.logical_and.reduceat(has_primary[group], starts)
+    suggested   = [t.do_name_comprehension() for t in tracklets]
+    designation = [s.DESIG if s.VALID else None for s in suggested]
+    destination = np.where(~selectable, UNSELECTABLE, np.where([d is not None for d in designation], DESIGNATED, ITF))
+
+    # The groups that contain more than one tracklet
+    first, last = np.full(len(obsgroups), len(tracklets)), np.full(len(obsgroups), -1)
+    np.minimum.at(first, group, tracklet)
+    np.maximum.at(last,  group, tracklet)
+    shared      = np.logical_or.reduceat((first != last)[group], starts)
+
+    # The tracklets in those groups, in processing order
+    flagged     = defaultdict(list)
+    members     = defaultdict(list)     # group -> (earlier) tracklets
+    groups_of   = {}                    # tracklet -> groups
+    for k in np.flatnonzero(shared).tolist():
+        groups_of[k] = set(group[starts[k]:starts[k] + n_obs[k]].tolist())
+        if selectable[k]:
+            overlapped = set(designation[j] for g in groups_of[k] for j in members[g] if destination[j] == DESIGNATED)
+            if len(overlapped) > 1:
+                destination[k], designation[k] = UNSELECTABLE, None
+                flagged['MULTIPLE_DESIGNATIONS'].append(tracklets[k].TrackletID)
+            elif overlapped:
+                desig = overlapped.pop()
+                if designation[k] is not None and designation[k] != desig:
+                    flagged['INCONSISTENT_DESIGNATION'].append(tracklets[k].TrackletID)
+                destination[k], designation[k] = DESIGNATED, desig
+
+            # ITF tracklets sharing a group follow a designated tracklet into DESIGNATED
+            if destination[k] == DESIGNATED:
+                todo = [k]
+                while todo:
+                    for j in set(j for g in groups_of[todo.pop()] for j in members[g] if destination[j] == ITF):
+                        destination[j], designation[j] = DESIGNATED, designation[k]
+                        todo.append(j)
+        for g in groups_of[k]:
+            members[g].append(k)
+
+    _assign(db, tracklets, observations, starts, n_obs, tracklet, destination, designation)
+    return destination, dict(flagged)
+
+def _assign(db, tracklets, observations, starts, n_obs, tracklet, destination, designation):
+    '''
+    Bulk version of Tracklet.assign_to_DESIGNATED / ITF / UNSELECTABLE (& terminate_processing)
+    '''
+    store   = db.OBSSTORE
+    rows    = np.array([o._row for o in observations])
+    obs_destination = destination[tracklet]
+
+    # Destination tables
+    db.DESTINATIONS.assign(rows, obs_destination)
+    if METRICS.enabled:
+        for d, name in [(DESIGNATED, 'DESIGNATED'), (ITF, 'ITF'), (UNSELECTABLE, 'UNSELECTABLE')]:
+            METRICS.count(f'destination.{name}', int(np.sum(obs_destination == d)))
+
+    # Designated observations know their designation (& nothing else does) ...
+    DesigIDs = np.array([store.get_DesigID(desig) if d == DESIGNATED else -1 for d, desig in zip(destination.tolist(), designation)], dtype=np.int64)
+    store.columns['DesigID'][rows] = DesigIDs[tracklet]
+
+    # ... & processing is complete for all of them
+    store.columns['Flags'][rows] |= ObsStore.PROCESSING_COMPLETE
+    if store.dirty is not None:
+        store.dirty.update(rows.tolist())
+
+    # Motion index for the ITF, & predictions for the designated objects
+    for d in [ITF, DESIGNATED]:
+        selected = np.flatnonzero(destination == d)
+        if not len(selected):
+            continue
+        in_selected = obs_destination == d
+        summaries   = fit_motion(store['UnitVector'][rows[in_selected]], store['MJD'][rows[in_selected]], np.cumsum(n_obs[selected]) - n_obs[selected])
+        TrackletIDs = [tracklets[k].TrackletID for k in selected.tolist()]
+        if d == ITF:
+            db.ITF_MOTION.add_many(TrackletIDs, summaries)
+        else:
+            db.DESIGNATED_PREDICTIONS.add_many([designation[k] for k in selected.tolist()], TrackletIDs, summaries)
+
+def categorize_groups(db, obsgroups, observations, group, destination):
+    '''
+    Category of each group (as for ObsGroup.category) given the destination
+    of each observation, & save the groups in the db
+     - UNSELECTABLE obs are ignored (as in ObsGroup.categorize_similarity_group_wrt_new_observation)
+    '''
+    TrackletIDs = np.array([o.TrackletID for o in observations])
+    for obsgroup, members in zip(obsgroups, _members(group)):
+        if obsgroup.primary_ObsID is None:
+            obsgroup.category = UNSELECTABLE
+        else:
+            d = destination[members]
+            if (d == DESIGNATED).any():
+                obsgroup.category = DESIGNATED
+                obsgroup.desig    = observations[members[d == DESIGNATED][0]].desig
+            elif (d == ITF).any():
+                obsgroup.category    = ITF
+                obsgroup.TrackletIDs = list(set(TrackletIDs[members[d == ITF]].tolist()))
+            else:
+                obsgroup.category = 0
+        obsgroup.release_observations()
+        db.OBSGROUPS[obsgroup.SimilarityGroupID] = obsgroup
+
+def _members(group):
+    ''' Indices of the members of each group (in processing order) '''
+    return np.split(np.argsort(group, kind='stable'), np.cumsum(np.bincount(group))[:-1])
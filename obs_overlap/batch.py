@@ -4,12 +4,13 @@ MJP 2020_08_19
 # -------------------------------------------------------------
 # Third Party Imports
 # -------------------------------------------------------------
-import dateutil.parser
+import sys
 
 # -------------------------------------------------------------
 # Local Imports
 # -------------------------------------------------------------
 from db import BatchID
+from obs import isot_to_mjd, mjd_to_datetime
 
 # -------------------------------------------------------------
 # Batch Class <==> Batch Details Table
@@ -31,7 +32,8 @@ class Batch():
         self.BatchID            = BatchID.get_next_from_db()
 
         # Batch-level data
-        self.SubmissionTime     = dateutil.parser.isoparse(SubmissionTime)
+        # N.B. The submission time is held as an MJD (like the ObsTime of an Obs)
+        self.SubmissionMJD      = isot_to_mjd(SubmissionTime)
         self.ActorID            = ActorID
         
         # Store contained tracklets in a dictionary structure
@@ -46,3 +48,12 @@ class Batch():
 
         # Store self in db
         db.BATCHES[self.BatchID] = self
+
+    def nbytes(self,):
+        ''' Approximate memory used by the batch (the tracklets themselves are in db.TRACKLETS) '''
+        return sys.getsizeof(self) + sys.getsizeof(self.__dict__) + sys.getsizeof(self.tracklets)
+
+    @property
+    def SubmissionTime(self,):
+        ''' (naive, UTC) datetime of the submission: for export only '''
+        return mjd_to_datetime(self.SubmissionMJD)
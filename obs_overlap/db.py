@@ -13,7 +13,21 @@ attributes / functionalities of a database structure
 # -------------------------------------------------------------
 # Third Party Imports
 # -------------------------------------------------------------
+import sys
+from collections.abc import Mapping
+from contextlib import contextmanager
+from array import array
+import numpy as np
 
+# -------------------------------------------------------------
+# Local Imports
+# -------------------------------------------------------------
+from obscodes import OBSCODES
+from motion import MotionIndex
+from predictions import PredictionCache
+from spatial import SPATIAL_ENGINES
+from obs_group import GroupStatusTable, PrimaryJournal
+from processing import FitCache
 
 # -------------------------------------------------------------
 # These classes act like DB-ID generators
@@ -26,6 +40,13 @@ class DB_ID:
     def get_next_from_db(self,):
         self.total += 1
         return self.total
+
+    @classmethod
+    def get_many_from_db(self, n):
+        ''' Reserve a block of n consecutive IDs (e.g. for bulk ingestion) '''
+        first = self.total + 1
+        self.total += n
+        return np.arange(first, first + n)
         
 class BatchID(DB_ID):
     total = -1
@@ -42,16 +63,600 @@ class ITFObsID(DB_ID):
 class UnselectableObsID(DB_ID):
     total = -1
     
+# -------------------------------------------------------------
+# This class acts like the columns of the observations table
+# -------------------------------------------------------------
+class ObsStore():
+    '''
+    Columnar (struct-of-arrays) storage for observations
+
+    Each quantity is held in a contiguous, typed numpy array with one row
+    per observation. The Obs class is just a thin view onto a row of this store
+
+    Missing values (e.g. an unset SimilarityGroupID) are stored as -1
+
+    Strings (ObsCode & desig) are stored as integer IDs into look-up lists
+
+    Flags & Destination start as 0 (no flags set / not yet assigned a destination)
+    '''
+    # name : (dtype, per-row shape)
+    COLUMNS = {
+        'ObsID'             : (np.int64,   ()  ),
+        'RA'                : (np.float64, ()  ),
+        'Dec'               : (np.float64, ()  ),
+        'UnitVector'        : (np.float64, (3,)),
+        'MJD'               : (np.float64, ()  ),
+        'ObsCodeID'         : (np.int16,   ()  ),
+        'Healpix'           : (np.int64,   ()  ),
+        'SimilarityGroupID' : (np.int32,   ()  ),
+        'BatchID'           : (np.int32,   ()  ),
+        'TrackletID'        : (np.int32,   ()  ),
+        'Replaces'          : (np.int64,   ()  ),
+        'DesigID'           : (np.int32,   ()  ),
+        'Flags'             : (np.uint8,   ()  ),
+        'Destination'       : (np.int8,    ()  ),
+    }
+
+    # Columns that start as 0 (rather than -1)
+    ZEROED = ('Flags', 'Destination')
+
+    # Bits used in the Flags column
+    DELETED             = 1
+    PROCESSING_COMPLETE = 2
+    ACCEPTED            = 4
+
+    def __init__(self, capacity=1024, obscodes=OBSCODES, ordered=True, track_dirty=False):
+        self.n          = 0
+        self.capacity   = 0
+        self.columns    = {name : np.empty((0,)+shape, dtype=dtype) for name, (dtype, shape) in self.COLUMNS.items()}
+        self._grow(capacity)
+
+        # If ObsIDs are NOT appended in increasing order (e.g. when the store is
+        # used as a cache of a larger on-disk table), rows are found via a dict
+        self.rows       = None if ordered else {}
+
+        # Optionally record the rows that are modified after being appended
+        # (so that they can be written back to an on-disk table)
+        self.dirty      = set() if track_dirty else None
+
+        # Look-up lists for string quantities
+        # - ObsCodeIDs come from the (compiled) obscode configuration
+        self.obscodes   = obscodes
+        self.desigs,    self.DesigIDs    = [], {}
+
+    @property
+    def ObsCodes(self,):
+        return self.obscodes.ObsCodes
+
+    def __len__(self,):
+        return self.n
+
+    def __getitem__(self, name):
+        ''' The populated part of a column '''
+        return self.columns[name][:self.n]
+
+    def _grow(self, capacity):
+        ''' Re-allocate the columns with (at least) the requested capacity '''
+        capacity = max(capacity, 2*self.capacity)
+        for name, col in self.columns.items():
+            new = np.full((capacity,)+col.shape[1:], 0 if name in self.ZEROED else -1, dtype=col.dtype)
+            new[:self.n] = col[:self.n]
+            self.columns[name] = new
+        self.capacity = capacity
+
+    def append(self, ObsID, RA, Dec, MJD, ObsCode, Replaces, desig, Deleted):
+        '''
+        Add a single observation & return its row
+        N.B. Unless ordered=False, ObsIDs are expected to be supplied in
+        increasing order (as from AcceptedObsID)
+        '''
+        if self.n == self.capacity:
+            self._grow(self.n + 1)
+        row, C = self.n, self.columns
+        C['ObsID'][row]     = ObsID
+        C['RA'][row]        = RA
+        C['Dec'][row]       = Dec
+        C['UnitVector'][row]= radec_to_unitvector(RA, Dec)
+        C['MJD'][row]       = MJD
+        C['ObsCodeID'][row] = self.get_ObsCodeID(ObsCode)
+        C['Replaces'][row]  = -1 if Replaces is None else Replaces
+        C['DesigID'][row]   = self.get_DesigID(desig)
+        C['Flags'][row]     = self.DELETED if Deleted is True else 0
+        if self.rows is not None:
+            self.rows[ObsID] = row
+        self.n += 1
+        return row
+
+    def append_many(self, ObsIDs, RA, Dec, MJD, ObsCodes, Replaces=None, desigs=None, Deleted=None):
+        '''
+        Add a block of observations (supplied as arrays) & return their rows
+        Replaces / desigs / Deleted can be None (=> unset for every observation)
+        '''
+        k = len(ObsIDs)
+        if self.n + k > self.capacity:
+            self._grow(self.n + k)
+        rows, C = np.arange(self.n, self.n + k), self.columns
+        C['ObsID'][rows]        = ObsIDs
+        C['RA'][rows]           = RA
+        C['Dec'][rows]          = Dec
+        C['UnitVector'][rows]   = radec_to_unitvector(np.asarray(RA), np.asarray(Dec))
+        C['MJD'][rows]          = MJD
+        C['ObsCodeID'][rows]    = self._get_IDs(ObsCodes, self.get_ObsCodeID)
+        C['Replaces'][rows]     = -1 if Replaces is None else [-1 if r is None else r for r in Replaces]
+        C['DesigID'][rows]      = -1 if desigs is None else self._get_IDs(desigs, self.get_DesigID)
+        C['Flags'][rows]        = 0 if Deleted is None else np.where(np.asarray(Deleted) == True, self.DELETED, 0)
+        if self.rows is not None:
+            self.rows.update(zip(np.asarray(ObsIDs).tolist(), rows.tolist()))
+        self.n += k
+        return rows
+
+    def copy_rows(self, rows, **kwargs):
+        '''
+        A new ObsStore holding (copies of) the supplied rows, in order (kwargs as for ObsStore)
+        N.B. Any Obs (views) of the rows still refer to this store
+        '''
+        k       = len(rows)
+        store   = ObsStore(capacity=max(k, 1024), obscodes=self.obscodes, **kwargs)
+        for name, col in self.columns.items():
+            store.columns[name][:k] = col[rows]
+        store.columns['DesigID'][:k] = [store.get_DesigID(None if ID == -1 else self.desigs[ID]) for ID in self.columns['DesigID'][rows].tolist()]
+        store.n = k
+        if store.rows is not None:
+            store.rows.update(zip(store['ObsID'].tolist(), range(k)))
+        return store
+
+    def _get_IDs(self, values, get_ID):
+        ''' Integer IDs for an array of strings: one look-up per *distinct* value '''
+        IDs = {}
+        return np.array([IDs[v] if v in IDs else IDs.setdefault(v, get_ID(v)) for v in values], dtype=np.int64)
+
+    def row_of(self, ObsID):
+        '''
+        Row for the supplied ObsID (or None)
+        ObsIDs are generated sequentially, so the row is usually at a
+        fixed offset from the first ObsID. Otherwise fall back to a binary search
+        '''
+        if self.rows is not None:
+            return self.rows.get(ObsID)
+        if self.n == 0:
+            return None
+        ObsIDs  = self.columns['ObsID']
+        row     = ObsID - ObsIDs[0]
+        if not 0 <= row < self.n or ObsIDs[row] != ObsID:
+            row = np.searchsorted(ObsIDs[:self.n], ObsID)
+            if row == self.n or ObsIDs[row] != ObsID:
+                return None
+        return int(row)
+
+    def get_ObsCodeID(self, ObsCode):
+        ''' Integer ID for ObsCode (assigning a new one if necessary) '''
+        return self.obscodes.get_ObsCodeID(ObsCode)
+
+    def get_DesigID(self, desig):
+        ''' Integer ID for designation (-1 for None) '''
+        if desig is None:
+            return -1
+        if desig not in self.DesigIDs:
+            self.DesigIDs[desig] = len(self.desigs)
+            self.desigs.append(desig)
+        return self.DesigIDs[desig]
+
+    def view(self, row):
+        ''' Obs (view) for a row of the store '''
+        from obs import Obs
+        return Obs.from_store(self, row)
+
+    def get_flag(self, row, flag):
+        return bool(self.columns['Flags'][row] & flag)
+
+    def set_flag(self, row, flag, value):
+        if value:
+            self.columns['Flags'][row] |= flag
+        else:
+            self.columns['Flags'][row] &= ~np.uint8(flag)
+        if self.dirty is not None:
+            self.dirty.add(row)
+
+    def memory_report(self,):
+        '''
+        Memory used by the columns of the store
+
+        N.B. Excludes the (small) ObsCode/desig look-up lists,
+        as well as any Obs view objects that are still referenced elsewhere
+        (see DB.memory_report for the memory used per accepted observation)
+        '''
+        bytes_per_obs_columns = sum(col.itemsize * int(np.prod(col.shape[1:])) for col in self.columns.values())
+        return {
+            'n_obs'                 : self.n,
+            'bytes_per_obs_columns' : bytes_per_obs_columns,
+            'bytes_used'            : bytes_per_obs_columns * self.n,
+            'bytes_allocated'       : bytes_per_obs_columns * self.capacity,
+        }
+
+def radec_to_unitvector(RA, Dec):
+    ''' Unit vector(s) for RA, Dec [deg] (N.B. equivalent to hp.ang2vec(90-Dec, RA)) '''
+    ra, dec = np.radians(RA), np.radians(Dec)
+    return np.stack([np.cos(dec)*np.cos(ra), np.cos(dec)*np.sin(ra), np.sin(dec)], axis=-1)
+
+class AcceptedTable(Mapping):
+    '''
+    Dict-like view of the ACCEPTED observations: ObsID -> Obs
+    The data themselves are held in the ObsStore
+    '''
+    def __init__(self, store):
+        self.store = store
+        self.n     = 0
+
+    def row_of(self, ObsID):
+        ''' Row of an accepted observation (or None) '''
+        row = self.store.row_of(ObsID)
+        return row if row is not None and self.store.get_flag(row, ObsStore.ACCEPTED) else None
+
+    def add(self, row):
+        if not self.store.get_flag(row, ObsStore.ACCEPTED):
+            self.store.set_flag(row, ObsStore.ACCEPTED, True)
+            self.n += 1
+
+    def __contains__(self, ObsID):
+        return self.row_of(ObsID) is not None
+
+    def __getitem__(self, ObsID):
+        row = self.row_of(ObsID)
+        if row is None:
+            raise KeyError(ObsID)
+        return self.store.view(row)
+
+    def __iter__(self,):
+        accepted = (self.store['Flags'] & ObsStore.ACCEPTED).astype(bool)
+        return iter(self.store['ObsID'][accepted].tolist())
+
+    def __len__(self,):
+        return self.n
+
+class ObservationTable(Mapping):
+    '''
+    Dict-like registry of *all* observations (accepted or not): ObsID -> Obs
+    or, if a column is supplied, ObsID -> value of that column (e.g. TrackletID)
+
+    Nothing extra needs to be maintained: each observation gets its row in
+    the ObsStore (& so its entry here) when it is created, and its TrackletID
+    when it is put into a Tracklet, so every look-up is O(1)
+    N.B. Look-ups go via db.rows_of, so any observations not yet in the
+    ObsStore are found too (see SQLiteDB)
+    '''
+    def __init__(self, db, column=None):
+        self.db     = db
+        self.column = column
+
+    def row_of(self, ObsID):
+        rows = self.db.rows_of([ObsID])
+        return rows[0] if rows else None
+
+    def __contains__(self, ObsID):
+        return self.row_of(ObsID) is not None
+
+    def __getitem__(self, ObsID):
+        row = self.row_of(ObsID)
+        if row is None:
+            raise KeyError(ObsID)
+        if self.column is None:
+            return self.db.OBSSTORE.view(row)
+        value = self.db.OBSSTORE.columns[self.column][row].item()
+        return None if value == -1 else value
+
+    def __iter__(self,):
+        return iter(self.db.OBSSTORE['ObsID'].tolist())
+
+    def __len__(self,):
+        return len(self.db.OBSSTORE)
+
+# -------------------------------------------------------------
+# These classes act like the destination tables
+# -------------------------------------------------------------
+# Values of the Destination column: as for the ObsGroup.category values
+# (with 0 for an observation that has not yet been assigned a destination)
+UNSELECTABLE, UNASSIGNED, DESIGNATED, ITF = -1, 0, 1, 2
+
+class DestinationStatus():
+    '''
+    The destination of every observation (DESIGNATED / ITF / UNSELECTABLE),
+    held in the (int8) Destination column of the ObsStore, together with
+    the number of observations in each destination
+
+    As each observation has a single Destination value, it can only ever be
+    in one destination, & a whole tracklet is moved with one assignment
+    N.B. counts covers every observation in the db (see SQLiteDB), not just
+    those that are in the ObsStore
+    '''
+    def __init__(self, db):
+        self.db     = db
+        self.counts = [0] * (ITF - UNSELECTABLE + 1)                    # indexed by Destination - UNSELECTABLE
+
+    def assign(self, rows, destination):
+        '''
+        Move the observations (OBSSTORE rows) to a destination
+        (or to an array of destinations, one per observation)
+        '''
+        store, counts = self.db.OBSSTORE, self.counts
+        column  = store.columns['Destination']
+        if isinstance(destination, int):
+            # E.g. a single tracklet: only a handful of observations
+            for d in column[rows].tolist():
+                counts[d - UNSELECTABLE] -= 1
+            counts[destination - UNSELECTABLE] += len(rows)
+            column[rows] = destination
+        else:
+            rows    = np.asarray(rows, dtype=np.int64)
+            old     = column[rows]
+            column[rows] = destination
+            change  = np.bincount(column[rows] - UNSELECTABLE, minlength=len(counts)) - np.bincount(old - UNSELECTABLE, minlength=len(counts))
+            for i, n in enumerate(change.tolist()):
+                counts[i] += n
+            rows    = rows.tolist()
+        counts[UNASSIGNED - UNSELECTABLE] = 0                           # (only the destinations are counted)
+        if store.dirty is not None:
+            store.dirty.update(rows)
+
+    def count(self, destination):
+        ''' Number of observations in a destination '''
+        return self.counts[destination - UNSELECTABLE]
+
+    def all_assigned(self, rows):
+        ''' Whether each of the observations (OBSSTORE rows) is in (exactly) one destination '''
+        return bool((self.db.OBSSTORE.columns['Destination'][np.asarray(rows, dtype=np.int64)] != UNASSIGNED).all())
+
+class DestinationTable(Mapping):
+    '''
+    Dict-like view of the observations in one destination: ObsID -> True
+    Membership is a look-up in the Destination column & len is a counter
+    (see DestinationStatus), so both are O(1)
+    '''
+    def __init__(self, db, destination):
+        self.db          = db
+        self.destination = destination
+
+    def __contains__(self, ObsID):
+        rows = self.db.rows_of([ObsID])
+        return bool(rows) and self.db.OBSSTORE.columns['Destination'][rows[0]] == self.destination
+
+    def __getitem__(self, ObsID):
+        if ObsID not in self:
+            raise KeyError(ObsID)
+        return True
+
+    def __iter__(self,):
+        store = self.db.OBSSTORE
+        return iter(store['ObsID'][store['Destination'] == self.destination].tolist())
+
+    def __len__(self,):
+        return self.db.DESTINATIONS.count(self.destination)
+
+# -------------------------------------------------------------
+# This class keeps track of which similarity-groups have merged
+# -------------------------------------------------------------
+class SimilarityGroups():
+    '''
+    Disjoint-set (union-find) of SimilarityGroupIDs
+
+    A new observation can unite groups that did not previously overlap.
+    Rather than re-labelling every observation whenever that happens,
+    each SimilarityGroupID points at a parent, and the group that an ID
+    now belongs to is the root of its tree (see find)
+     - find uses path-compression
+     - union uses union-by-size (ties go to the lower ID), and returns
+       the groups that were absorbed, so that only the members of those
+       (smaller) groups need to be re-labelled
+
+    The member ObsIDs are held for each root (as an array('q'), rather than a list of int objects)
+
+    load : optional function SimilarityGroupID -> list of member ObsIDs,
+           used for groups that are not (yet) known in memory
+    '''
+    def __init__(self, load=None):
+        self.parent  = {}
+        self.members = {}
+        self.load    = load
+
+    def __contains__(self, SimilarityGroupID):
+        return SimilarityGroupID in self.parent
+
+    def __len__(self,):
+        ''' Number of (distinct) groups '''
+        return len(self.members)
+
+    def new(self, ObsIDs=()):
+        ''' Create a new group containing the supplied ObsIDs '''
+        ID = SimilarityGroupID.get_next_from_db()
+        self.parent[ID], self.members[ID] = ID, array('q', ObsIDs)
+        return ID
+
+    def new_many(self, members):
+        ''' Create a new group for each of the supplied lists of ObsIDs (e.g. see backfill) '''
+        IDs = SimilarityGroupID.get_many_from_db(len(members)).tolist()
+        for ID, ObsIDs in zip(IDs, members):
+            self.parent[ID], self.members[ID] = ID, array('q', ObsIDs)
+        return IDs
+
+    def _missing(self, ID):
+        if self.load is None:
+            raise KeyError(ID)
+        self.parent[ID], self.members[ID] = ID, array('q', self.load(ID))
+
+    def find(self, ID):
+        ''' The (root) SimilarityGroupID of the group that ID now belongs to '''
+        if ID not in self.parent:
+            self._missing(ID)
+        root = ID
+        while self.parent[root] != root:
+            root = self.parent[root]
+        # Path-compression
+        while self.parent[ID] != root:
+            self.parent[ID], ID = root, self.parent[ID]
+        return root
+
+    def union(self, IDs):
+        '''
+        Merge the groups of all of the supplied SimilarityGroupIDs
+
+        returns:
+        --------
+        root     : the SimilarityGroupID of the merged group
+        absorbed : list of the roots that were merged into it
+        moved    : list of the ObsIDs of the members of the absorbed groups
+        '''
+        roots = sorted(set(self.find(ID) for ID in IDs), key=lambda r: (-len(self.members[r]), r))
+        root, absorbed, moved = roots[0], roots[1:], []
+        for r in absorbed:
+            self.parent[r] = root
+            moved.extend(self.members.pop(r))
+        self.members[root].extend(moved)
+        return root, absorbed, moved
+
+    def add(self, root, ObsIDs):
+        ''' Add observations to an (existing) group '''
+        self.members[self.find(root)].extend(ObsIDs)
+
+    def get_members(self, ID):
+        ''' The ObsIDs of all of the observations in the group that ID belongs to '''
+        return self.members[self.find(ID)]
+
+    def nbytes(self,):
+        ''' Approximate memory used by the parents (& their SimilarityGroupIDs) & the members '''
+        return (sys.getsizeof(self.parent) + sum(sys.getsizeof(ID) + sys.getsizeof(parent) for ID, parent in self.parent.items())
+                + sys.getsizeof(self.members) + sum(map(sys.getsizeof, self.members.values())))
+
+def nbytes_of(table):
+    ''' Approximate memory used by a dict of objects (using their nbytes, where they have one) '''
+    return sys.getsizeof(table) + sum(v.nbytes() if hasattr(v, 'nbytes') else sys.getsizeof(v) for v in table.values())
+
+def memory_totals(db, report):
+    ''' Add the memory used by the in-memory structures shared by DB & SQLiteDB to a (DB.memory_report) report, & the totals '''
+    report['bytes_predictions']         = db.DESIGNATED_PREDICTIONS.nbytes()
+    report['bytes_groupstatus']         = db.GROUPSTATUS.nbytes()
+    report['bytes_itf_motion']          = db.ITF_MOTION.nbytes()
+    report['bytes_similaritygroups']    = db.SIMILARITYGROUPS.nbytes()
+    report['bytes_obsgroups']           = nbytes_of(db.OBSGROUPS)
+    report['bytes_tracklets']           = nbytes_of(db.TRACKLETS) + nbytes_of(db.BATCHES)
+    report['n_accepted']                = len(db.ACCEPTED)
+    report['bytes_total']               = report['bytes_allocated'] + sum(v for k, v in report.items() if k.startswith('bytes_') and k not in ('bytes_used', 'bytes_allocated', 'bytes_per_obs_columns', 'bytes_sqlite'))
+    report['bytes_per_obs']             = report['bytes_total'] // max(report['n_accepted'], 1)
+    return report
+
 # -------------------------------------------------------------
 # This class acts like a set of DB tables
 # -------------------------------------------------------------
 class DB():
-    def __init__(self,):
+    '''
+    In-memory DB
+
+    spatial : the engine used to find the near-duplicate shortlist
+              (one of spatial.SPATIAL_ENGINES: 'healpix' or 'kdtree')
+    '''
+    def __init__(self, spatial='healpix'):
         self.BATCHES      = {}
         self.TRACKLETS    = {}
-        self.ACCEPTED     = {}  ### Not currently used
         self.OBSGROUPS    = {}
-        self.DESIGNATED   = {}
-        self.ITF          = {}
-        self.UNSELECTABLE = {}
+
+        # Columnar storage for the data of *all* observations
+        # - ACCEPTED is a view of the subset that have been accepted
+        self.OBSSTORE     = ObsStore()
+        self.ACCEPTED     = AcceptedTable(self.OBSSTORE)
+
+        # The destination of each observation (& the number in each destination)
+        # - DESIGNATED / ITF / UNSELECTABLE are views of the Destination column
+        # - Maintained by Tracklet.assign_to_DESIGNATED / ITF / UNSELECTABLE
+        self.DESTINATIONS = DestinationStatus(self)
+        self.DESIGNATED   = DestinationTable(self, DESIGNATED)
+        self.ITF          = DestinationTable(self, ITF)
+        self.UNSELECTABLE = DestinationTable(self, UNSELECTABLE)
+
+        # Registries of all observations: ObsID -> Obs & ObsID -> TrackletID
+        self.OBSERVATIONS = ObservationTable(self)
+        self.OBS_TRACKLETS = ObservationTable(self, 'TrackletID')
+
+        # Spatial index of the ACCEPTED observations (e.g. on (healpix, MJD))
+        # - This is the equivalent of an index on the (position, time) columns
+        #   of the accepted observations table
+        assert spatial in SPATIAL_ENGINES, f'unknown spatial engine: {spatial}'
+        self.spatial      = spatial
+        self.SPATIAL      = SPATIAL_ENGINES[spatial]()
+
+        # Which SimilarityGroupIDs have been merged (& the members of each group)
+        self.SIMILARITYGROUPS = SimilarityGroups()
+
+        # The (incrementally-maintained) credit & primary status of each group
+        # - Maintained by ObsGroup.get_SimilarityGroupID
+        self.GROUPSTATUS  = GroupStatusTable(self)
+
+        # Journal (per batch) of the changes to the primary observations of the groups
+        # - Written by ObsGroup.get_SimilarityGroupID
+        self.PRIMARY_JOURNAL = PrimaryJournal()
+
+        # Motion summaries of the ITF tracklets, indexed by (time, position)
+        # - Maintained by Tracklet.assign_to_ITF / DESIGNATED / UNSELECTABLE
+        self.ITF_MOTION   = MotionIndex()
+
+        # Predicted positions of the designated objects, indexed by (night, position)
+        # - Maintained by Tracklet.assign_to_DESIGNATED / ITF / UNSELECTABLE
+        self.DESIGNATED_PREDICTIONS = PredictionCache()
+
+        # Results of the orbit-fits, keyed by the observations that went into them
+        # - Invalidated by ObsGroup.get_SimilarityGroupID & Tracklet.assign_to_DESIGNATED / ITF / UNSELECTABLE
+        self.FIT_CACHE    = FitCache()
+
+    def rows_of(self, ObsIDs):
+        ''' OBSSTORE rows for the supplied ObsIDs '''
+        return [row for row in (self.OBSSTORE.row_of(ObsID) for ObsID in ObsIDs) if row is not None]
+
+    def set_SimilarityGroupID(self, ObsIDs, SimilarityGroupID):
+        ''' Assign SimilarityGroupID (or an array of them, one per observation) to all of the supplied observations '''
+        rows = self.rows_of(ObsIDs)
+        self.OBSSTORE.columns['SimilarityGroupID'][rows] = SimilarityGroupID
+        if self.OBSSTORE.dirty is not None:
+            self.OBSSTORE.dirty.update(rows)
+
+    def accept_observation(self, obs):
+        '''
+        Flag an observation as ACCEPTED & update the spatial index
+        Assumes obs.Healpix has already been set
+        '''
+        self.ACCEPTED.add(obs._row)
+        self.SPATIAL.add(obs.ObsID, obs.UnitVector, obs.Healpix, obs.MJD)
+
+    def get_rows_near(self, UnitVector, Healpix, arcsecRadius, MJD_lo, MJD_hi):
+        '''
+        Get the OBSSTORE rows of the ACCEPTED observations that could be within
+        arcsecRadius & the time-window [MJD_lo, MJD_hi] of any of the targets
+        (scalars, or arrays with one value per target)
+        This is a shortlist from the spatial engine: the near-dup checks do the exact selection
+        The cost depends on the density of observations near the targets, NOT on the
+        total number of accepted observations
+        '''
+        return [self.OBSSTORE.row_of(ObsID) for ObsID in self.SPATIAL.query(UnitVector, Healpix, arcsecRadius, MJD_lo, MJD_hi)]
+
+    def get_obs_near(self, UnitVector, Healpix, arcsecRadius, MJD_lo, MJD_hi):
+        ''' As get_rows_near, but returning (views of) the observations '''
+        return [self.OBSSTORE.view(row) for row in self.get_rows_near(UnitVector, Healpix, arcsecRadius, MJD_lo, MJD_hi)]
+
+    @contextmanager
+    def transaction(self,):
+        '''
+        Group a set of changes (e.g. the processing of a batch)
+        Nothing to commit for this in-memory version (see SQLiteDB), but the
+        batches are then processed (see PrimaryJournal.close_batches)
+        '''
+        yield self
+        self.PRIMARY_JOURNAL.close_batches()
+
+    def memory_report(self,):
+        '''
+        Approximate memory used by the accepted observations table, its spatial index, the predictions cache,
+        the group statuses, the similarity groups & the batches / tracklets / groups held in memory
+         - bytes_total   : all of the above (the ObsStore as allocated)
+         - bytes_per_obs : bytes_total per accepted observation (cf. bytes_per_obs_columns, for the ObsStore alone)
+        N.B. Excludes the bounded caches (near_dups search regions & the FIT_CACHE) & the PRIMARY_JOURNAL (of the current batches)
+        '''
+        report = self.OBSSTORE.memory_report()
+        report[f'bytes_{self.spatial}_index'] = self.SPATIAL.nbytes()
+        return memory_totals(self, report)
 
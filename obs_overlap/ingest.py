@@ -0,0 +1,260 @@
+'''
+The functions in "ingest" read observations from submission files
+and turn them into the Batch / Tracklet / Obs objects that are
+processed by the rest of the code (see tests/test_obs_group_code.py)
+
+Two formats are understood
+ - MPC 80-column
+ - ADES PSV (pipe-separated values)
+
+Files are streamed in chunks of lines: each chunk is parsed straight
+into column arrays (with the times converted to MJD in one vectorized
+step, rather than parsing a time-string per observation), so that
+backlogs of millions of observations pass through in bounded memory
+
+ - read_obs80      : 80-column file => generator of chunks
+ - read_ades_psv   : ADES PSV file  => generator of chunks
+ - read_submission : either of the above (the format is detected)
+ - gen_batches     : generator of chunks => generator of Batch objects
+
+Each chunk is a dict of equal-length arrays (see CHUNK_COLUMNS)
+
+'''
+
+# -------------------------------------------------------------
+# Third Party Imports
+# -------------------------------------------------------------
+import re
+from contextlib import contextmanager
+from itertools import islice
+import numpy as np
+
+# -------------------------------------------------------------
+# Local Imports
+# -------------------------------------------------------------
+from obs import Obs, calendar_to_mjd, isot_to_mjd_array
+from tracklet import Tracklet
+from batch import Batch
+
+
+# Default number of lines read per chunk
+CHUNKSIZE = 100000
+
+# The column arrays in each chunk
+# - desig       : submitted designation (None if not supplied)
+# - TrackletKey : consecutive observations with the same key form a tracklet
+CHUNK_COLUMNS = ['RA', 'Dec', 'MJD', 'ObsCode', 'desig', 'TrackletKey']
+
+# Packed provisional designations (e.g. "K20A00B")
+# N.B. Anything else in columns 6-12 of an 80-column line is a temporary designation
+PACKED_PROVISIONAL = re.compile(r'^[I-K]\d\d[A-HJ-Y][0-9A-Za-z]\d[A-Z]$')
+
+# Column 15 of the second line of a two-line (satellite / roving / radar) 80-column observation
+SECOND_LINE_NOTES = 'svr'
+
+
+# -------------------------------------------------------------
+# Readers
+# -------------------------------------------------------------
+def read_submission(filepath, chunksize=CHUNKSIZE):
+    ''' Read an 80-column or ADES PSV file (the format is detected from the first line) '''
+    with open(filepath) as fh:
+        first = next((line for line in fh if line.strip()), '')
+    reader = read_ades_psv if first[:1] in '#!' or '|' in first else read_obs80
+    return reader(filepath, chunksize=chunksize)
+
+def read_obs80(source, chunksize=CHUNKSIZE):
+    '''
+    Read an MPC 80-column file in chunks of (at most) chunksize lines
+
+    source : file-path or open (text) file
+
+    yields:
+    --------
+    dict of column arrays (see CHUNK_COLUMNS)
+    '''
+    with _open(source) as fh:
+        for lines in _chunks(fh, chunksize):
+            chunk = parse_obs80(lines)
+            if len(chunk['MJD']):
+                yield chunk
+
+def read_ades_psv(source, chunksize=CHUNKSIZE):
+    '''
+    Read an ADES PSV file in chunks of (at most) chunksize lines
+
+    Header / context lines ("#" or "!") may appear anywhere: the first
+    line following them names the fields of the data lines that follow
+
+    source : file-path or open (text) file
+
+    yields:
+    --------
+    dict of column arrays (see CHUNK_COLUMNS)
+    '''
+    fields = None
+    with _open(source) as fh:
+        for lines in _chunks(fh, chunksize):
+
+            # Split the lines into blocks that share the same field-names
+            blocks = []
+            for line in lines:
+                if not line.strip():
+                    continue
+                if line[0] in '#!':
+                    fields = None
+                    continue
+                values = [v.strip() for v in line.split('|')]
+                if fields is None:
+                    fields = values
+                    blocks.append((fields, []))
+                elif not blocks:
+                    blocks.append((fields, [values]))
+                else:
+                    blocks[-1][1].append(values)
+
+            chunk = _concatenate([parse_ades_psv(dict(zip(f, zip(*rows)))) for f, rows in blocks if rows])
+            if chunk is not None and len(chunk['MJD']):
+                yield chunk
+
+# -------------------------------------------------------------
+# Parsers
+# -------------------------------------------------------------
+def parse_obs80(lines):
+    '''
+    Parse a list of 80-column lines into column arrays
+
+    N.B. The second lines of two-line observations are skipped
+    (only the positions / times / obscodes from the first lines are needed)
+    '''
+    lines = [line.rstrip('\r\n').ljust(80)[:80] for line in lines]
+    lines = [line for line in lines if line.strip() and line[14] not in SECOND_LINE_NOTES]
+    chars = np.frombuffer(''.join(lines).encode('ascii', 'replace'), dtype='S1').reshape(-1, 80)
+
+    # Times
+    MJD = calendar_to_mjd( _float(chars, 15, 19), _float(chars, 20, 22), _float(chars, 23, 32) )
+
+    # RA [hh mm ss.sss] & Dec [sdd mm ss.ss] => degrees
+    RA  = 15.*(_float(chars, 32, 34) + _float(chars, 35, 37)/60. + _float(chars, 38, 44)/3600.)
+    Dec = np.where(_field(chars, 44, 45) == b'-', -1., 1.) * (_float(chars, 45, 47) + _float(chars, 48, 50)/60. + _float(chars, 51, 56)/3600.)
+
+    # Designations: a (packed) permanent number, else a packed provisional designation
+    number, provisional = _string(chars, 0, 5), _string(chars, 5, 12)
+    unique, inverse     = np.unique(provisional, return_inverse=True)
+    packed              = np.array([PACKED_PROVISIONAL.match(p) is not None for p in unique.tolist()], dtype=bool)[inverse.reshape(-1)]
+    desig               = np.where(number != '', number, np.where(packed, provisional, ''))
+
+    ObsCode = _string(chars, 77, 80)
+    return {
+        'RA'            : RA,
+        'Dec'           : Dec,
+        'MJD'           : MJD,
+        'ObsCode'       : ObsCode,
+        'desig'         : _none_if_blank(desig),
+        'TrackletKey'   : np.char.add(_string(chars, 0, 12), ObsCode),
+    }
+
+def parse_ades_psv(columns):
+    '''
+    Parse a block of ADES PSV data (dict of field-name -> tuple of strings) into column arrays
+    '''
+    n       = len(columns['obsTime'])
+    get     = lambda name : np.array(columns.get(name, ('',)*n), dtype=str)
+    desig   = np.where(get('permID') != '', get('permID'), get('provID'))
+    ObsCode = get('stn')
+    return {
+        'RA'            : get('ra').astype(np.float64),
+        'Dec'           : get('dec').astype(np.float64),
+        'MJD'           : isot_to_mjd_array(get('obsTime')),
+        'ObsCode'       : ObsCode,
+        'desig'         : _none_if_blank(desig),
+        'TrackletKey'   : np.char.add(np.char.add(np.where(get('trkSub') != '', get('trkSub'), desig), '|'), ObsCode),
+    }
+
+# -------------------------------------------------------------
+# Chunks => Batches
+# -------------------------------------------------------------
+def gen_batches(chunks, db, SubmissionTime, ActorID):
+    '''
+    Turn a stream of chunks (from one of the readers) into Batch objects
+
+    Each chunk becomes a Batch, so processing is bounded by the chunk-size
+    in the same way as the reading
+    The last tracklet of each chunk is held back & carried into the
+    next batch (it may continue in the next chunk): tracklets are never split
+
+    SubmissionTime : ISO-format string (as for Batch)
+    '''
+    carry = None
+    for chunk in chunks:
+        chunk   = _concatenate([carry, chunk])
+        last    = tracklet_starts(chunk['TrackletKey'])[-1]
+        carry   = _take(chunk, slice(last, None))
+        if last:
+            yield make_batch(_take(chunk, slice(0, last)), db, SubmissionTime, ActorID)
+    if carry is not None:
+        yield make_batch(carry, db, SubmissionTime, ActorID)
+
+def make_batch(chunk, db, SubmissionTime, ActorID):
+    ''' Create the Obs, Tracklet & Batch objects for a chunk '''
+    observations = Obs.from_arrays(chunk['RA'], chunk['Dec'], chunk['MJD'], chunk['ObsCode'].tolist(),
+                                   None, chunk['desig'].tolist(), None, db)
+    bounds = np.append(tracklet_starts(chunk['TrackletKey']), len(observations)).tolist()
+    return Batch(SubmissionTime, ActorID,
+                 [Tracklet(observations[a:b], db) for a, b in zip(bounds[:-1], bounds[1:])],
+                 db)
+
+def tracklet_starts(TrackletKey):
+    ''' Index of the first observation of each tracklet (i.e. wherever the key changes) '''
+    return np.flatnonzero(np.r_[True, TrackletKey[1:] != TrackletKey[:-1]])
+
+# -------------------------------------------------------------
+# Internal functions
+# -------------------------------------------------------------
+@contextmanager
+def _open(source):
+    ''' Open a file-path, or pass through an already-open file '''
+    if isinstance(source, str):
+        with open(source) as fh:
+            yield fh
+    else:
+        yield source
+
+def _chunks(fh, chunksize):
+    ''' Lists of (at most) chunksize lines '''
+    while True:
+        lines = list(islice(fh, chunksize))
+        if not lines:
+            return
+        yield lines
+
+def _field(chars, start, stop):
+    ''' Fixed-width field (0-based columns [start, stop)) of each line, as bytes '''
+    return np.ascontiguousarray(chars[:, start:stop]).view(f'S{stop-start}').reshape(-1)
+
+def _float(chars, start, stop):
+    ''' Fixed-width numeric field (blank => 0) '''
+    field = _field(chars, start, stop)
+    return np.where(np.char.strip(field) == b'', b'0', field).astype(np.float64)
+
+def _string(chars, start, stop):
+    ''' Fixed-width text field, stripped '''
+    return np.char.strip(np.char.decode(_field(chars, start, stop), 'ascii'))
+
+def _none_if_blank(values):
+    ''' Object array with None in place of blank strings '''
+    values = values.astype(object)
+    values[values == ''] = None
+    return values
+
+def _take(chunk, index):
+    return {name : chunk[name][index] for name in CHUNK_COLUMNS}
+
+def _concatenate(chunks):
+    ''' Concatenate chunks (ignoring None) '''
+    chunks = [c for c in chunks if c is not None]
+    if not chunks:
+        return None
+    if len(chunks) == 1:
+        return chunks[0]
+    return {name : np.concatenate([c[name] for c in chunks]) for name in CHUNK_COLUMNS}
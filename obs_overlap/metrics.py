@@ -0,0 +1,262 @@
+'''
+The classes in "metrics" collect counters & histograms that
+describe what the near-duplicate / grouping / tracklet
+processing is doing, e.g.
+ - the latency of each stage of the processing (p50 / p99)
+ - the size of the near-duplicate shortlist after each filter
+   (healpix => angular-separation => time => obscode)
+ - the number of similarity groups / tracklets in each overlap category
+ - the number of observations assigned to each destination
+
+The processing code records into the module-level instance, METRICS
+
+Metrics are OFF by default, and cost nothing while off
+ - Latencies are recorded by wrapping the functions for each stage
+   (see STAGES), and the wrappers are only installed by enable()
+ - Everything else is recorded at a few points in the code that
+   are guarded by a single "if METRICS.enabled:" check
+
+A snapshot (plain dict / JSON) can be taken at any time, including
+from a running ingest process (see dump_on_signal)
+
+> import metrics
+> metrics.METRICS.enable()
+> ...
+> metrics.METRICS.snapshot()
+
+'''
+
+# -------------------------------------------------------------
+# Third Party Imports
+# -------------------------------------------------------------
+import json
+import math
+import signal
+import time
+from collections import Counter
+from functools import wraps
+import numpy as np
+
+
+# Histogram buckets are logarithmic: this many per factor of 2
+# (=> each bucket spans ~19%, which bounds the error on the percentiles)
+BUCKETS_PER_OCTAVE = 4
+
+# The filters applied to the near-duplicate shortlist (in order)
+# - healpix+time : the shortlist from the spatial look-up, which (for the accepted observations)
+#                  is the (healpix, MJD) index, so the time-window has already been applied
+SHORTLIST_FILTERS = ['healpix+time', 'angular_sepn', 'time', 'obscode']
+
+# Names of the ObsGroup.category values
+CATEGORY_NAMES = {-1: 'UNSELECTABLE', 0: 'SINGLE', 1: 'DESIGNATED', 2: 'ITF'}
+
+# Stages whose latency is recorded: metric-name -> (module-name, class-name (or None), function-name)
+# N.B. Modules are only imported when the metrics are enabled
+STAGES = {
+    'near_dups.find_similar_in_batches'         : ('near_dups', None,       'find_similar_in_batches'),
+    'Obs.find_similar'                          : ('obs',       'Obs',      'find_similar'),
+    'Obs.upgraded_check_near_dups'              : ('obs',       'Obs',      'upgraded_check_near_dups'),
+    'ObsGroup'                                  : ('obs_group', 'ObsGroup', '__init__'),
+    'ObsGroup.get_SimilarityGroupID'            : ('obs_group', 'ObsGroup', 'get_SimilarityGroupID'),
+    'ObsGroup.assign_status'                    : ('obs_group', 'ObsGroup', 'assign_status'),
+    'Tracklet.categorize_overlap'               : ('tracklet',  'Tracklet', 'categorize_overlap'),
+    'tracklet.categorize_overlaps'              : ('tracklet',  None,       'categorize_overlaps'),
+    'Tracklet.tracklet_processing'              : ('tracklet',  'Tracklet', 'tracklet_processing_A____Top_level_process_handler'),
+    'backfill'                                  : ('backfill',  None,       'backfill'),
+}
+
+
+# -------------------------------------------------------------
+# Histograms
+# -------------------------------------------------------------
+class Histogram():
+    '''
+    Log-bucketed histogram of non-negative values (latencies, sizes, ...)
+
+    Only the counts in each (occupied) bucket are kept, so the memory is
+    bounded however many values are recorded
+    Zeros (e.g. empty shortlists) are counted separately
+    '''
+    def __init__(self,):
+        self.buckets = Counter()
+        self.zeros   = 0
+        self.count   = 0
+        self.sum     = 0.
+        self.min     = math.inf
+        self.max     = -math.inf
+
+    def observe(self, value):
+        self.count += 1
+        self.sum   += value
+        self.min    = min(self.min, value)
+        self.max    = max(self.max, value)
+        if value > 0:
+            self.buckets[math.floor(math.log2(value) * BUCKETS_PER_OCTAVE)] += 1
+        else:
+            self.zeros += 1
+
+    def observe_many(self, values):
+        ''' Vectorized observe '''
+        values = np.asarray(values, dtype=np.float64)
+        if not len(values):
+            return
+        self.count += len(values)
+        self.sum   += float(values.sum())
+        self.min    = min(self.min, float(values.min()))
+        self.max    = max(self.max, float(values.max()))
+        positive    = values[values > 0]
+        self.zeros += len(values) - len(positive)
+        buckets, counts = np.unique(np.floor(np.log2(positive) * BUCKETS_PER_OCTAVE).astype(np.int64), return_counts=True)
+        self.buckets.update(dict(zip(buckets.tolist(), counts.tolist())))
+
+    def percentile(self, p):
+        '''
+        Approximate p-th percentile (0 <= p <= 100)
+        N.B. The upper edge of the bucket (limited to the range of the values seen)
+        '''
+        if not self.count:
+            return None
+        rank = p / 100. * self.count
+        if rank <= self.zeros:
+            return 0.
+        seen = self.zeros
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                return min(max(2.**((bucket + 1) / BUCKETS_PER_OCTAVE), self.min), self.max)
+        return self.max
+
+    def snapshot(self,):
+        return {
+            'count' : self.count,
+            'sum'   : self.sum,
+            'mean'  : self.sum / self.count if self.count else None,
+            'min'   : self.min if self.count else None,
+            'max'   : self.max if self.count else None,
+            'p50'   : self.percentile(50),
+            'p99'   : self.percentile(99),
+        }
+
+
+# -------------------------------------------------------------
+# Collection of metrics
+# -------------------------------------------------------------
+class Metrics():
+    '''
+    Named counters & histograms
+
+    Naming convention
+     - latency.<stage>                : histogram [seconds] (see STAGES)
+     - near_dups.shortlist.<filter>   : histogram of the shortlist size per target (see SHORTLIST_FILTERS)
+     - ObsGroup.category.<category>   : counter (see CATEGORY_NAMES)
+     - Tracklet.overlap.<category>    : counter
+     - destination.<table>            : counter of observations assigned to DESIGNATED / ITF / UNSELECTABLE
+     - orbitfit.cache.<hit|miss>      : counter of the orbit-fits served from / missing from the FitCache
+     - speculative_search.itf_link    : counter of the tracklets linked to an ITF tracklet (see processing.speculative_search)
+    '''
+    def __init__(self,):
+        self.enabled    = False
+        self.counters   = Counter()
+        self.histograms = {}
+        self._originals = {}
+
+    # -------------------------------------------------------------
+    # Switching on / off
+    # -------------------------------------------------------------
+    def enable(self, stages=STAGES):
+        ''' Start recording (& install the latency wrappers for the stages) '''
+        if self.enabled:
+            return
+        for name, (owner, attr) in _resolve(stages).items():
+            original = owner.__dict__[attr]
+            self._originals[name] = (owner, attr, original)
+            setattr(owner, attr, self.timed(name, original))
+        self.enabled = True
+
+    def disable(self,):
+        ''' Stop recording (& restore the original functions). Recorded values are kept '''
+        for owner, attr, original in self._originals.values():
+            setattr(owner, attr, original)
+        self._originals = {}
+        self.enabled    = False
+
+    def reset(self,):
+        ''' Discard all recorded values '''
+        self.counters   = Counter()
+        self.histograms = {}
+
+    # -------------------------------------------------------------
+    # Recording
+    # -------------------------------------------------------------
+    def count(self, name, n=1):
+        self.counters[name] += n
+
+    def observe(self, name, value):
+        self._histogram(name).observe(value)
+
+    def observe_many(self, name, values):
+        self._histogram(name).observe_many(values)
+
+    def observe_shortlists(self, sizes):
+        ''' Record the shortlist sizes after each filter: dict filter -> size (or array of sizes) '''
+        for f, n in sizes.items():
+            if np.isscalar(n):
+                self.observe(f'near_dups.shortlist.{f}', n)
+            else:
+                self.observe_many(f'near_dups.shortlist.{f}', n)
+
+    def timed(self, name, func):
+        ''' Wrap func so that each call is recorded in latency.<name> '''
+        key = f'latency.{name}'
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.observe(key, time.perf_counter() - start)
+        return wrapper
+
+    def _histogram(self, name):
+        if name not in self.histograms:
+            self.histograms[name] = Histogram()
+        return self.histograms[name]
+
+    # -------------------------------------------------------------
+    # Reporting
+    # -------------------------------------------------------------
+    def snapshot(self,):
+        ''' All of the recorded values, as a (JSON-serializable) dict '''
+        return {
+            'time'          : time.time(),
+            'enabled'       : self.enabled,
+            'counters'      : dict(sorted(self.counters.items())),
+            'histograms'    : {name : h.snapshot() for name, h in sorted(self.histograms.items())},
+        }
+
+    def dump(self, filepath):
+        ''' Write a snapshot to a JSON file '''
+        with open(filepath, 'w') as fh:
+            json.dump(self.snapshot(), fh, indent=2)
+
+    def dump_on_signal(self, filepath, signum=None):
+        '''
+        Write a snapshot to filepath whenever the process receives signum
+        (default SIGUSR1: e.g. "kill -USR1 <pid>" for a running ingest process)
+        N.B. Must be called from the main thread
+        '''
+        signal.signal(signal.SIGUSR1 if signum is None else signum, lambda *_ : self.dump(filepath))
+
+
+def _resolve(stages):
+    ''' metric-name -> (class or module, function-name) '''
+    import importlib
+    resolved = {}
+    for name, (module, cls, attr) in stages.items():
+        owner = importlib.import_module(module)
+        resolved[name] = (owner if cls is None else getattr(owner, cls), attr)
+    return resolved
+
+
+# The instance used by the processing code
+METRICS = Metrics()
@@ -0,0 +1,216 @@
+'''
+The functions & classes in "motion" summarize the motion of
+tracklets, and index the ITF tracklets by their motion, so that
+a new tracklet only needs to be compared with the ITF tracklets
+whose extrapolated positions fall near it (rather than with
+every tracklet in the ITF)
+
+ - fit_motion  : vectorized great-circle fit for one-or-more tracklets
+ - MotionIndex : (time, healpix)-bucketed index of motion summaries
+
+'''
+
+# -------------------------------------------------------------
+# Third Party Imports
+# -------------------------------------------------------------
+import sys
+from bisect import bisect_left
+from collections import namedtuple, defaultdict
+import numpy as np
+import healpy as hp
+
+
+# Motion of a tracklet, at its mean epoch
+# - MJD        : mean epoch
+# - RA, Dec    : position at the mean epoch [deg]
+# - UnitVector : position at the mean epoch (x,y,z)
+# - Velocity   : tangential velocity at the mean epoch (x,y,z) [rad/day]
+# - rate       : rate of motion [deg/day]
+# - PA         : position angle of the motion [deg, North through East]
+# - n_obs      : number of observations fitted (the motion is zero if 1)
+motion_summary = namedtuple('motion_summary', ['MJD', 'RA', 'Dec', 'UnitVector', 'Velocity', 'rate', 'PA', 'n_obs'])
+
+# Parameters of the MotionIndex
+MAX_DAYS                = 15.   # Largest extrapolation (either direction) [days]
+LINK_RADIUS_DEG         = 0.05  # Allowed separation between extrapolated & actual positions at dt = 0 [deg]
+RATE_ERROR_DEG_PER_DAY  = 0.05  # ... & the growth of that allowance with |dt| [deg/day]
+BUCKET_DAYS             = 5.    # Width of the time buckets [days]
+SIDE_HP                 = 8     # Side of the (nested) healpix used for the spatial buckets (~7.3 deg)
+RATE_CLASSES            = [0.5, 2., 8.]  # Upper limits of the rate classes [deg/day] (anything faster is in a final class)
+
+
+# -------------------------------------------------------------
+# Great-circle fit
+# -------------------------------------------------------------
+def fit_motion(UnitVector, MJD, starts=None):
+    '''
+    Fit a great-circle motion (position & rate) to each of one-or-more tracklets
+
+    The observations of all of the tracklets are supplied in single arrays,
+    with the observations of each tracklet contiguous
+    UnitVector : (N,3) positions of the observations (e.g. from the ObsStore)
+    starts     : index of the first observation of each tracklet (None => a single tracklet)
+
+    The fit is done on the unit-vectors
+     u(t) ~ a + b (t - t0)
+    (least-squares for all of the tracklets at once), and a / b then give the
+    position / tangential velocity at the mean epoch t0
+
+    returns:
+    --------
+    list of motion_summary (one per tracklet)
+    '''
+    U, MJD  = np.atleast_2d(UnitVector).astype(np.float64), np.atleast_1d(MJD).astype(np.float64)
+    starts  = np.zeros(1, dtype=np.int64) if starts is None else np.asarray(starts, dtype=np.int64)
+    n_obs   = np.diff(np.append(starts, len(MJD)))
+    segment = np.repeat(np.arange(len(starts)), n_obs)
+
+    # Mean epoch & mean unit-vector of each tracklet
+    t0      = np.add.reduceat(MJD, starts) / n_obs
+    dt      = MJD - t0[segment]
+    a       = np.add.reduceat(U, starts, axis=0) / n_obs[:, None]
+
+    # Slope (zero for single observations, or observations at a single epoch)
+    Stt     = np.add.reduceat(dt**2, starts)
+    b       = np.add.reduceat(dt[:, None] * U, starts, axis=0) / np.where(Stt > 0, Stt, np.inf)[:, None]
+
+    # Position on the sphere & the velocity in the tangent plane
+    norm    = np.linalg.norm(a, axis=1)
+    p       = a / norm[:, None]
+    v       = b / norm[:, None]
+    v      -= np.sum(v * p, axis=1)[:, None] * p
+
+    # RA, Dec, rate & PA
+    ra      = np.degrees(np.arctan2(p[:, 1], p[:, 0])) % 360.
+    dec     = np.degrees(np.arcsin(np.clip(p[:, 2], -1., 1.)))
+    north, east = north_east(ra, dec)
+    rate    = np.degrees(np.linalg.norm(v, axis=1))
+    PA      = np.degrees(np.arctan2(np.sum(v * east, axis=1), np.sum(v * north, axis=1))) % 360.
+
+    return [motion_summary(*_) for _ in zip(t0.tolist(), ra.tolist(), dec.tolist(), map(tuple, p.tolist()),
+                                            map(tuple, v.tolist()), rate.tolist(), PA.tolist(), n_obs.tolist())]
+
+def north_east(RA, Dec):
+    ''' Unit vectors towards North & East at RA, Dec [deg] '''
+    ra, dec = np.radians(RA), np.radians(Dec)
+    north   = np.stack([-np.sin(dec)*np.cos(ra), -np.sin(dec)*np.sin(ra), np.cos(dec)], axis=-1)
+    east    = np.stack([-np.sin(ra), np.cos(ra), np.zeros_like(ra)], axis=-1)
+    return north, east
+
+def extrapolate(UnitVector, Velocity, dt):
+    '''
+    Position(s) after moving along the great-circle for dt [days]
+    UnitVector, Velocity : (N,3) arrays ; dt : (N,) array
+    '''
+    UnitVector, Velocity = np.atleast_2d(UnitVector), np.atleast_2d(Velocity)
+    w       = np.linalg.norm(Velocity, axis=1)
+    angle   = w * dt
+    unit_v  = Velocity / np.where(w > 0, w, 1.)[:, None]
+    return np.cos(angle)[:, None] * UnitVector + np.sin(angle)[:, None] * unit_v
+
+def sizeof_summary(summary):
+    ''' Approximate memory used by a motion_summary (& its values) '''
+    return sys.getsizeof(summary) + sum(sys.getsizeof(v) + sum(sys.getsizeof(x) for x in v) if isinstance(v, tuple) else sys.getsizeof(v) for v in summary)
+
+
+# -------------------------------------------------------------
+# Index of (ITF) tracklets by their motion
+# -------------------------------------------------------------
+class MotionIndex():
+    '''
+    Index of tracklet motion summaries (e.g. for the ITF tracklets)
+
+    Each tracklet is put in a bucket according to its rate-class & the
+    time-bucket of its mean epoch, and within that by the healpix of its
+    position. A query at time t & position p then only needs to look at
+     - the time-buckets within MAX_DAYS of t (for each rate-class)
+     - for each of those, the healpix within reach of p: the link-radius,
+       plus the distance the fastest tracklet in that bucket could have moved
+    and the extrapolated position of each candidate is then checked exactly
+    N.B. The rate-classes stop the few fast-movers from widening the search for the many slow ones
+    '''
+    def __init__(self,):
+        self.summaries  = {}
+        self.buckets    = defaultdict(lambda : defaultdict(set))
+        self.max_rate   = defaultdict(float)
+
+    def __contains__(self, TrackletID):
+        return TrackletID in self.summaries
+
+    def __len__(self,):
+        return len(self.summaries)
+
+    def _bucket(self, summary):
+        ''' ((rate-class, time-bucket), healpix) '''
+        return ( (bisect_left(RATE_CLASSES, summary.rate), int(np.floor(summary.MJD / BUCKET_DAYS))),
+                 int(hp.vec2pix(SIDE_HP, *summary.UnitVector, nest=True)) )
+
+    def add(self, TrackletID, summary):
+        ''' Add (or replace) the motion summary for a tracklet '''
+        self.remove(TrackletID)
+        bucket, pixel = self._bucket(summary)
+        self.summaries[TrackletID] = summary
+        self.buckets[bucket][pixel].add(TrackletID)
+        self.max_rate[bucket] = max(self.max_rate[bucket], summary.rate)
+
+    def add_many(self, TrackletIDs, summaries):
+        for TrackletID, summary in zip(TrackletIDs, summaries):
+            self.add(TrackletID, summary)
+
+    def nbytes(self,):
+        ''' Approximate memory used by the summaries & the buckets '''
+        pixels = list(self.buckets.values())
+        return (sys.getsizeof(self.summaries) + sum(map(sizeof_summary, self.summaries.values()))
+                + sys.getsizeof(self.buckets) + sum(map(sys.getsizeof, pixels)) + sum(sys.getsizeof(IDs) for p in pixels for IDs in p.values())
+                + sys.getsizeof(self.max_rate))
+
+    def remove(self, TrackletID):
+        ''' Remove a tracklet (if present) '''
+        summary = self.summaries.pop(TrackletID, None)
+        if summary is not None:
+            bucket, pixel = self._bucket(summary)
+            self.buckets[bucket][pixel].discard(TrackletID)
+            if not self.buckets[bucket][pixel]:
+                del self.buckets[bucket][pixel]
+
+    def candidates(self, MJD, UnitVector):
+        '''
+        TrackletIDs in the time-buckets within MAX_DAYS of MJD, & in the healpix
+        within reach of UnitVector (N.B. a superset of query's result)
+        '''
+        found = []
+        for rc in range(len(RATE_CLASSES) + 1):
+            for tb in range(int(np.floor((MJD - MAX_DAYS) / BUCKET_DAYS)), int(np.floor((MJD + MAX_DAYS) / BUCKET_DAYS)) + 1):
+                pixels = self.buckets.get((rc, tb))
+                if not pixels:
+                    continue
+                dt_max  = min(max(abs(MJD - tb*BUCKET_DAYS), abs(MJD - (tb+1)*BUCKET_DAYS)), MAX_DAYS)
+                radius  = LINK_RADIUS_DEG + (self.max_rate[(rc, tb)] + RATE_ERROR_DEG_PER_DAY) * dt_max
+                disc    = hp.query_disc(SIDE_HP, UnitVector, np.radians(min(radius, 180.)), inclusive=True, nest=True)
+                # Look up whichever is fewer: the pixels in the disc, or the occupied pixels
+                if len(disc) > len(pixels):
+                    occupied = np.fromiter(pixels, dtype=np.int64, count=len(pixels))
+                    disc     = occupied[np.isin(occupied, disc)]
+                for pixel in disc.tolist():
+                    found.extend(pixels.get(pixel, ()))
+        return found
+
+    def query(self, summary, exclude=()):
+        '''
+        TrackletIDs of the tracklets whose position, extrapolated (along their
+        great-circle) to the epoch of the supplied summary, falls within
+        LINK_RADIUS_DEG + RATE_ERROR_DEG_PER_DAY * |dt| of the summary's position
+
+        returns:
+        --------
+        list of TrackletIDs (nearest first)
+        '''
+        TrackletIDs = [ID for ID in self.candidates(summary.MJD, summary.UnitVector) if ID not in exclude]
+        if not TrackletIDs:
+            return []
+        S       = [self.summaries[ID] for ID in TrackletIDs]
+        dt      = summary.MJD - np.array([s.MJD for s in S])
+        pos     = extrapolate(np.array([s.UnitVector for s in S]), np.array([s.Velocity for s in S]), dt)
+        sepn    = np.degrees(np.arccos(np.clip(pos @ np.array(summary.UnitVector), -1., 1.)))
+        close   = (np.abs(dt) <= MAX_DAYS) & (sepn <= LINK_RADIUS_DEG + RATE_ERROR_DEG_PER_DAY*np.abs(dt))
+        return [TrackletIDs[i] for i in np.flatnonzero(close)[np.argsort(sepn[close], kind='stable')]]
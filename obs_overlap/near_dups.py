@@ -0,0 +1,460 @@
+'''
+The functions in "near_dups" are a batch-level (vectorized)
+equivalent of the near-duplicate checks in "obs.py"
+
+Rather than checking one "new" observation at a time
+(Obs.find_similar => Obs.upgraded_check_near_dups), all of the
+observations in one-or-more batches are converted to numpy arrays
+and the healpix / angular-separation / time / obscode checks are
+done for all of them at once.
+
+The result is the same as processing the observations one-at-a-time:
+each new observation is compared against
+ (i)  the previously ACCEPTED observations
+ (ii) any *earlier* observations in the supplied batch(es)
+
+For an entire archive (see backfill), find_pairs_sweep finds all of the
+pairs by sort-and-sweep, without needing a (healpix, time) index
+
+'''
+
+# -------------------------------------------------------------
+# Third Party Imports
+# -------------------------------------------------------------
+from functools import lru_cache
+import numpy as np
+import healpy as hp
+
+# -------------------------------------------------------------
+# Local Imports
+# -------------------------------------------------------------
+from metrics import METRICS
+
+
+# -------------------------------------------------------------
+# Batch-level equivalent of Obs.find_similar
+# -------------------------------------------------------------
+def find_similar_in_batches(batches, db, sideHP=32768, nestedHP=True, executor=None, tileSide=None):
+    '''
+    Find the observations that are related/near-duplicate to each of the
+    observations in the supplied batch(es)
+
+    Observations are taken in processing order (batch, tracklet, obs)
+
+    If an executor (e.g. a concurrent.futures.ProcessPoolExecutor) is supplied,
+    the new observations are partitioned into coarse healpix tiles & the
+    pairs for each tile are found by the executor's workers (see find_pairs_by_tile)
+    (Only the pair-finding is parallel: the ObsGroups are then set-up one observation at a time)
+
+    N.B. Sets obs.Healpix for each of the new observations
+    (as per Obs.set_observation_healpix)
+
+    returns:
+    --------
+    similar : dict
+     - ObsID -> list of similar observations (including the target itself)
+     - Each list can be passed directly to ObsGroup(..., similar_obs=...)
+    '''
+    new_obs = batch_observations(batches)
+    if not new_obs:
+        return {}
+    store = db.OBSSTORE
+
+    # Pick up any changes to the obscode configuration
+    store.obscodes.refresh()
+
+    # (1) Healpix for all of the new observations at once
+    new_rows = np.array([o._row for o in new_obs])
+    store.columns['Healpix'][new_rows] = radec_to_healpix(store['RA'][new_rows], store['Dec'][new_rows], sideHP=sideHP, nestedHP=nestedHP)
+
+    # (2) Search region (healpix list) for each of the new observations
+    # - N.B. search_region is cached, so dense fields hit the same few regions
+    target_pix = [ search_region(h, r, sideHP=sideHP, nestedHP=nestedHP) for h, r in
+                    zip(store['Healpix'][new_rows].tolist(), store.obscodes.arcsecRadius(store['ObsCodeID'][new_rows]).tolist()) ]
+    target_rows = np.repeat(np.arange(len(new_obs)), [len(_) for _ in target_pix])
+    target_pix  = np.concatenate(target_pix)
+
+    # (3) The pool of candidates is ...
+    # (i)  the accepted observations that could be near any of the new observations
+    #      (in position & time-window: from the DB's spatial engine)
+    # (ii) the new observations themselves
+    deltaDays       = (store.obscodes.timeDeltaSeconds(store['ObsCodeID'][new_rows]) + 1e-3) / 86400.
+    accepted_rows   = np.array(db.get_rows_near( store['UnitVector'][new_rows], store['Healpix'][new_rows],
+                                                 store.obscodes.arcsecRadius(store['ObsCodeID'][new_rows]),
+                                                 store['MJD'][new_rows] - deltaDays, store['MJD'][new_rows] + deltaDays ), dtype=np.int64)
+    n_accepted  = len(accepted_rows)
+    pool_rows   = np.concatenate([accepted_rows, new_rows])
+    A           = observation_arrays(store, pool_rows)
+
+    # (4) & (5) Pair each new observation with every candidate in its search region
+    # & refine the pairs (see find_pairs)
+    # - t : index of target in pool
+    # - c : index of candidate in pool
+    # - The pairs for different parts of the sky can be found in parallel
+    query_rows = target_rows + n_accepted
+    sizes      = {} if METRICS.enabled else None
+    if executor is None:
+        t, c = find_pairs(query_rows, target_pix, A, store.obscodes.compiled.equivalence_class, sizes=sizes)
+    else:
+        t, c = find_pairs_by_tile(executor, query_rows, target_pix, A, store.obscodes.compiled.equivalence_class,
+                                  sideHP=sideHP, tileSide=tileSide, sizes=sizes)
+    if sizes is not None:
+        METRICS.observe_shortlists(sizes)
+
+    # (6) Assemble the similar observations for each target
+    pool    = lambda i : store.view(pool_rows[i]) if i < n_accepted else new_obs[i - n_accepted]
+    similar = {o.ObsID:[] for o in new_obs}
+    for i,j in zip(t.tolist(), c.tolist()):
+        similar[new_obs[i - n_accepted].ObsID].append(pool(j))
+
+    # (7) Check explicit remeasurement indicators
+    # - As per Obs.find_similar
+    earlier = {}
+    for o in new_obs:
+        if o.Replaces is not None :
+            if o.Replaces in db.ACCEPTED:
+                similar[o.ObsID].append( db.ACCEPTED[o.Replaces] )
+            elif o.Replaces in earlier:
+                similar[o.ObsID].append( earlier[o.Replaces] )
+        earlier[o.ObsID] = o
+
+    # Ensure returned sets contain the target
+    return {o.ObsID : list(set(similar[o.ObsID] + [o])) for o in new_obs}
+
+
+def batch_observations(batches):
+    ''' All of the observations in the supplied batches, in processing order '''
+    return [o for b in batches for t in b.tracklets.values() for o in t.observations.values()]
+
+
+# -------------------------------------------------------------
+# Array-level functions
+# -------------------------------------------------------------
+def observation_arrays(store, rows):
+    '''
+    Gather the quantities needed for near-duplicate checking for the
+    supplied rows of the ObsStore
+
+    The obscode-dependent quantities (radius, time-delta) are gathered
+    from the compiled obscode look-up arrays
+
+    returns:
+    --------
+    dict of arrays
+     - ObsID, Healpix, UnitVector (N,3), MJD, ObsCodeID
+     - arcsecRadius, timeDeltaSeconds
+    '''
+    ObsCodeID = store['ObsCodeID'][rows]
+    return {
+        'ObsID'             : store['ObsID'][rows],
+        'Healpix'           : store['Healpix'][rows],
+        'UnitVector'        : store['UnitVector'][rows],
+        'MJD'               : store['MJD'][rows],
+        'ObsCodeID'         : ObsCodeID,
+        'arcsecRadius'      : store.obscodes.arcsecRadius(ObsCodeID),
+        'timeDeltaSeconds'  : store.obscodes.timeDeltaSeconds(ObsCodeID),
+    }
+
+def radec_to_healpix(RA, Dec, sideHP=32768, nestedHP=True):
+    '''
+    Healpix for RA, Dec [deg] (scalars or arrays)
+    N.B. healpy angles are (theta, phi) = (co-latitude, longitude) = (90-Dec, RA),
+         as for the unit-vectors (& so the search-regions, see search_region).
+         Passing (RA, 90-Dec) instead puts observations in the wrong pixels,
+         & healpy rejects it outright for RA > 180
+    '''
+    return hp.ang2pix(sideHP, np.radians(90.-np.asarray(Dec)), np.radians(RA), nest=nestedHP)
+
+# Maximum number of (pixel, radius class) search-regions that are cached
+SEARCH_REGION_CACHE_SIZE = 2**16
+
+def search_region(pixel, arcsecRadius, sideHP=32768, nestedHP=True):
+    '''
+    The healpix that need to be searched to find everything within
+    arcsecRadius of *any* position within the supplied pixel
+
+    Radii are rounded up to whole arc-seconds ("radius classes")
+    so that the cached regions get re-used
+
+    returns:
+    --------
+    read-only array of healpix
+    '''
+    return _search_region(int(pixel), float(np.ceil(arcsecRadius)), sideHP, nestedHP)
+
+@lru_cache(maxsize=SEARCH_REGION_CACHE_SIZE)
+def _search_region(pixel, arcsecRadius, sideHP, nestedHP):
+    ''' Disc centred on the pixel, padded by the maximum pixel radius '''
+    vec     = hp.pix2vec(sideHP, pixel, nest=nestedHP)
+    radius  = np.radians(arcsecRadius/3600.) + hp.max_pixrad(sideHP)
+    region  = hp.query_disc(sideHP, vec, radius, inclusive=True, nest=nestedHP)
+    region.setflags(write=False)
+    return region
+
+def search_pixels(Healpix, arcsecRadius, MJD_lo, MJD_hi, sideHP=32768, nestedHP=True):
+    '''
+    The (unique) healpix in the search-regions of one-or-more targets,
+    & a time-window for each pixel that encloses the windows of all of
+    the targets that search it
+
+    returns:
+    --------
+    healpix, MJD_lo & MJD_hi (one per healpix)
+    '''
+    Healpix         = np.atleast_1d(Healpix)
+    arcsecRadius    = np.broadcast_to(arcsecRadius, Healpix.shape)
+    if len(Healpix) == 1:
+        return search_region(Healpix[0], arcsecRadius[0], sideHP=sideHP, nestedHP=nestedHP), MJD_lo, MJD_hi
+    regions         = [search_region(h, r, sideHP=sideHP, nestedHP=nestedHP) for h, r in zip(Healpix.tolist(), arcsecRadius.tolist())]
+    pixels, inverse = np.unique(np.concatenate(regions), return_inverse=True)
+    targets         = np.repeat(np.arange(len(regions)), [len(_) for _ in regions])
+    lo, hi          = np.full(len(pixels), np.inf), np.full(len(pixels), -np.inf)
+    np.minimum.at(lo, inverse.reshape(-1), np.broadcast_to(MJD_lo, len(regions))[targets])
+    np.maximum.at(hi, inverse.reshape(-1), np.broadcast_to(MJD_hi, len(regions))[targets])
+    return pixels, lo, hi
+
+def join_on_healpix(query_rows, query_pix, pool_pix):
+    '''
+    Find all (query, pool) pairs that share a healpix
+
+    query_rows, query_pix : the search-region of each query as a flat
+                            list of (row, pixel) pairs
+    pool_pix              : healpix of each observation in the pool
+
+    returns:
+    --------
+    rows of the query & index into the pool for each matching pair
+    '''
+    order       = np.argsort(pool_pix, kind='stable')
+    sorted_pix  = pool_pix[order]
+    lo          = np.searchsorted(sorted_pix, query_pix, side='left')
+    counts      = np.searchsorted(sorted_pix, query_pix, side='right') - lo
+
+    # For each query pixel we want the positions lo, lo+1, ..., lo+count-1
+    ends        = np.cumsum(counts)
+    positions   = np.arange(ends[-1] if len(ends) else 0) + np.repeat(lo - ends + counts, counts)
+    return np.repeat(query_rows, counts), order[positions]
+
+def find_pairs(query_rows, query_pix, A, equivalence_class, sizes=None):
+    '''
+    Find the near-duplicate pairs amongst a pool of observations
+
+    query_rows, query_pix : the search-region of each target as a flat
+                            list of (row, pixel) pairs, where row is the
+                            index of the target in the pool
+    A                     : observation_arrays of the pool, in processing order
+    equivalence_class     : the compiled obscode equivalence classes
+    sizes                 : optional dict, filled with the shortlist size for each
+                            target after each filter (see metrics.SHORTLIST_FILTERS)
+
+    N.B. Only plain arrays are used (no db), so this can run in a worker process
+
+    returns:
+    --------
+    index in pool of the target & the candidate for each pair
+    '''
+    t, c = join_on_healpix(query_rows, query_pix, A['Healpix'])
+
+    # Only consider the *earlier* observations
+    keep = c < t
+    if sizes is not None:
+        targets = np.unique(query_rows)
+        count   = lambda : np.bincount(t[keep], minlength=len(A['MJD']))[targets]
+        sizes['healpix+time'] = count()
+
+    # Refine the pairs based on ...
+    # (i) Angular separation
+    keep &= close_angular_sepn( A['UnitVector'][t], A['UnitVector'][c],
+                                np.maximum(A['arcsecRadius'][t], A['arcsecRadius'][c]) )
+    if sizes is not None:
+        sizes['angular_sepn'] = count()
+    # (ii) Difference in time
+    keep &= np.abs(A['MJD'][c] - A['MJD'][t])*86400. <= A['timeDeltaSeconds'][t]
+    if sizes is not None:
+        sizes['time'] = count()
+    # (iii) Similarity in obsCode
+    keep &= equivalence_class[A['ObsCodeID'][t]] == equivalence_class[A['ObsCodeID'][c]]
+    if sizes is not None:
+        sizes['obscode'] = count()
+    return t[keep], c[keep]
+
+# Default side of the coarse healpix tiles used to partition the sky (~0.9 deg tiles)
+TILE_SIDE = 64
+
+def find_pairs_by_tile(executor, query_rows, query_pix, A, equivalence_class, sideHP=32768, tileSide=None, sizes=None):
+    '''
+    As find_pairs, but with the targets partitioned into coarse healpix tiles,
+    and the pairs for each tile found by the executor's workers
+
+    Each worker is sent the targets in its tile, plus a "halo" of candidates:
+    every pool observation in the search-region of any of the tile's targets.
+    The search-regions are padded by each target's radius (see search_region),
+    so the halo is always wide enough, whatever the largest radius is
+    Each target is in exactly one tile, so each pair is found exactly once
+    (& the shortlist sizes, if requested, are recorded once per target)
+
+    The pool is sorted by healpix once, so the halo of a tile is a set of
+    contiguous ranges (one per search-region pixel), found by binary search
+
+    N.B. Only the pairs are found in parallel. The similarity groups are then formed
+    serially, one observation at a time (see ObsGroup), as the group & status of each
+    observation depend on the processing of the tracklets that came before it
+
+    N.B. Tiles are nested-healpix parents of the (nested) observation healpix
+    '''
+    tileSide = TILE_SIDE if tileSide is None else tileSide
+    tiles    = A['Healpix'][query_rows] // (sideHP // tileSide)**2
+    if not len(tiles):
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+    # The pool sorted by healpix, & the (target, pixel) pairs grouped by tile (in tile order)
+    order       = np.argsort(A['Healpix'], kind='stable')
+    sorted_pix  = A['Healpix'][order]
+    by_tile     = np.argsort(tiles, kind='stable')
+    starts      = np.flatnonzero(np.r_[True, tiles[by_tile][1:] != tiles[by_tile][:-1]])
+
+    subs, tasks = [], []
+    for in_tile in np.split(by_tile, starts[1:]):
+        # The sub-pool (still in processing order): targets + halo
+        pixels  = np.unique(query_pix[in_tile])
+        lo      = np.searchsorted(sorted_pix, pixels, side='left')
+        halo    = order[_expand_ranges(lo, np.searchsorted(sorted_pix, pixels, side='right') - lo)]
+        sub     = np.union1d(query_rows[in_tile], halo)
+        subs.append(sub)
+        tasks.append( (np.searchsorted(sub, query_rows[in_tile]), query_pix[in_tile], {k: v[sub] for k, v in A.items()}, equivalence_class,
+                       None if sizes is None else {}) )
+
+    # Map the positions within each sub-pool back to the pool
+    results = list(executor.map(_find_pairs, tasks))
+    t, c    = zip(*[(sub[t], sub[c]) for sub, (t, c, _) in zip(subs, results)])
+    if sizes is not None:
+        sizes.update({f : np.concatenate([s[f] for _, _, s in results]) for f in results[0][2]})
+    return np.concatenate(t), np.concatenate(c)
+
+def _find_pairs(task):
+    ''' find_pairs in a worker: the shortlist sizes (if requested) are returned too '''
+    t, c = find_pairs(*task)
+    return t, c, task[-1]
+
+def find_pairs_sweep(A, equivalence_class, sideHP=32768, nestedHP=True, tileSide=None):
+    '''
+    Find *all* of the near-duplicate pairs amongst a pool of observations
+    (e.g. an entire archive: see backfill), with no (healpix, time) index
+
+    The pool is sorted by (coarse healpix tile, MJD). Each observation then
+    sweeps its time-window (+/- its timeDeltaSeconds) through the sorted pool,
+    once for each tile that its search-region touches, & the observations
+    found are refined as in find_pairs
+
+    The pairs are exactly those that find_pairs would give if each observation
+    in turn were the target (against the *earlier* observations in the pool)
+
+    A : observation_arrays of the pool, in processing order
+
+    returns:
+    --------
+    index in pool of the (later) target & the (earlier) candidate for each pair
+    '''
+    tileSide = TILE_SIDE if tileSide is None else tileSide
+    factor   = (sideHP // tileSide)**2
+    to_tile  = lambda pix : (pix if nestedHP else hp.ring2nest(sideHP, pix)) // factor
+    n        = len(A['MJD'])
+
+    # (1) The tiles touched by the search-region of each observation
+    # - Usually just its own tile: the search_region is only needed for
+    #   the observations near the edge of their tile
+    tiles       = to_tile(A['Healpix'])
+    edge        = np.flatnonzero(_near_tile_edge(A['Healpix'], A['arcsecRadius'], sideHP, nestedHP, tileSide))
+    edge_tiles  = [np.unique(to_tile(search_region(p, r, sideHP=sideHP, nestedHP=nestedHP)))
+                   for p, r in zip(A['Healpix'][edge].tolist(), A['arcsecRadius'][edge].tolist())]
+    counts      = np.ones(n, dtype=np.int64)
+    counts[edge]= [len(_) for _ in edge_tiles]
+    q_obs       = np.repeat(np.arange(n), counts)
+    q_tile      = tiles[q_obs]
+    if len(edge):
+        q_tile[_expand_ranges((np.cumsum(counts) - counts)[edge], counts[edge])] = np.concatenate(edge_tiles)
+
+    # (2) Sweep the time-window of each (observation, tile) through the sorted pool
+    # - N.B. The window is padded slightly against rounding (as for Obs.get_time_window)
+    order       = np.lexsort((A['MJD'], tiles))
+    deltaDays   = (A['timeDeltaSeconds'] + 1e-3) / 86400.
+    lo          = _searchsorted_lex(tiles[order], A['MJD'][order], q_tile, A['MJD'][q_obs] - deltaDays[q_obs], side='left')
+    hi          = _searchsorted_lex(tiles[order], A['MJD'][order], q_tile, A['MJD'][q_obs] + deltaDays[q_obs], side='right')
+    t, c        = np.repeat(q_obs, hi - lo), order[_expand_ranges(lo, hi - lo)]
+
+    # (3) Refine the pairs, exactly as in find_pairs
+    # - Only consider the *earlier* observations
+    keep = c < t
+    t, c = t[keep], c[keep]
+    keep = close_angular_sepn( A['UnitVector'][t], A['UnitVector'][c], np.maximum(A['arcsecRadius'][t], A['arcsecRadius'][c]) )
+    keep&= np.abs(A['MJD'][c] - A['MJD'][t])*86400. <= A['timeDeltaSeconds'][t]
+    keep&= equivalence_class[A['ObsCodeID'][t]] == equivalence_class[A['ObsCodeID'][c]]
+    t, c = t[keep], c[keep]
+
+    # (4) find_pairs only sees candidates in the search-region of the target
+    # - Guaranteed for anything within the target's own radius, so only
+    #   the (few) pairs that rely on the candidate's larger radius need checking
+    check = np.flatnonzero(~close_angular_sepn( A['UnitVector'][t], A['UnitVector'][c], A['arcsecRadius'][t] ))
+    if len(check):
+        outside = [ i for i, tt, cc in zip(check.tolist(), t[check].tolist(), c[check].tolist())
+                    if A['Healpix'][cc] not in search_region(A['Healpix'][tt], A['arcsecRadius'][tt], sideHP=sideHP, nestedHP=nestedHP) ]
+        keep = np.ones(len(t), dtype=bool)
+        keep[outside] = False
+        t, c = t[keep], c[keep]
+    return t, c
+
+def _near_tile_edge(pixel, arcsecRadius, sideHP, nestedHP, tileSide):
+    '''
+    Could the search-region of each pixel extend beyond its tile ?
+
+    The distance (in pixels) from each pixel to the edge of its tile (from the
+    pixel's x & y indices within the base-pixel) is compared with the
+    search-radius, using a (conservative) quarter of the typical pixel-width
+    '''
+    L       = sideHP // tileSide
+    x, y, _ = hp.pix2xyf(sideHP, pixel, nest=nestedHP)
+    x, y    = x % L, y % L
+    edge    = np.minimum(np.minimum(x, y), np.minimum(L - 1 - x, L - 1 - y))
+    width   = np.degrees(hp.nside2resol(sideHP))*3600. / 4.
+    reach   = np.ceil(arcsecRadius) + np.degrees(hp.max_pixrad(sideHP))*3600.
+    return edge * width <= reach
+
+def _expand_ranges(starts, counts):
+    ''' Concatenation of the ranges starts[i], starts[i]+1, ..., starts[i]+counts[i]-1 '''
+    ends = np.cumsum(counts)
+    return np.arange(ends[-1] if len(ends) else 0) + np.repeat(starts - ends + counts, counts)
+
+def _searchsorted_lex(tile, MJD, q_tile, q_MJD, side='left'):
+    '''
+    As np.searchsorted, for (tile, MJD) keys that are sorted lexicographically
+
+    The queries are sorted in with the keys (queries before equal keys for side='left',
+    after them for side='right'), & the position of each query is the number of keys before it
+    '''
+    n       = len(tile)
+    is_q    = np.r_[np.zeros(n, dtype=bool), np.ones(len(q_tile), dtype=bool)]
+    tie     = is_q if side == 'right' else ~is_q
+    order   = np.lexsort((tie, np.r_[MJD, q_MJD], np.r_[tile, q_tile]))
+    before  = np.cumsum(~is_q[order])
+    result  = np.empty(len(q_tile), dtype=np.int64)
+    result[order[is_q[order]] - n] = before[is_q[order]]
+    return result
+
+def close_angular_sepn(uv_a, uv_b, arcsecRadius):
+    '''
+    Check that the separation between unit vectors is within the allowed radius [arc-sec]
+
+    uv_a         : (3,) or (N,3) array of unit vectors
+    uv_b         : (N,3) array of unit vectors
+    arcsecRadius : scalar or (N,) array of per-row radii
+
+    Rather than calculating the angle (arccos is both slow & poorly conditioned
+    for the few-arc-second separations we care about), the squared chord-length
+    between the vectors is compared to the chord-length of the allowed radius
+
+    returns:
+    --------
+    (N,) boolean array
+    '''
+    diff = np.ascontiguousarray(uv_b) - uv_a
+    return np.einsum('ij,ij->i', diff, diff) < (2.*np.sin(np.radians(np.asarray(arcsecRadius)/3600.)/2.))**2
@@ -17,17 +17,86 @@ import sys, os
 import numpy as np
 from collections import namedtuple
 import healpy as hp
-from datetime import date, timedelta
+from datetime import date, datetime, timedelta, timezone
 import dateutil.parser
 
 # -------------------------------------------------------------
 # Local Imports
 # -------------------------------------------------------------
-from db import AcceptedObsID
+from db import AcceptedObsID, ObsStore
+import near_dups
+from near_dups import close_angular_sepn
+from metrics import METRICS
 #from obs_group import ObsGroup
 
 
 
+# -------------------------------------------------------------
+# Times are stored as MJD
+# -------------------------------------------------------------
+MJD_EPOCH = datetime(1858, 11, 17)
+
+def isot_to_mjd(isot):
+    '''
+    Convert ISO-format time-string to MJD (treating naive times as UTC)
+    N.B. datetime.fromisoformat handles the common formats (far faster than dateutil)
+    '''
+    try:
+        dt = datetime.fromisoformat(isot)
+    except ValueError:
+        dt = dateutil.parser.isoparse(isot)
+    if dt.tzinfo is not None:
+        dt = dt.astimezone(timezone.utc).replace(tzinfo=None)
+    return (dt - MJD_EPOCH) / timedelta(days=1)
+
+def mjd_to_datetime(mjd):
+    ''' Convert MJD to (naive, UTC) datetime '''
+    return MJD_EPOCH + timedelta(days=mjd)
+
+def isot_to_mjd_array(isot):
+    '''
+    Vectorized isot_to_mjd for an array of ISO-format UTC time-strings
+    (e.g. ADES obsTime: "2020-03-20T14:32:16.458Z")
+    '''
+    t = np.char.rstrip(np.asarray(isot, dtype=str), 'Z').astype('datetime64[us]')
+    return (t - np.datetime64(MJD_EPOCH, 'us')) / np.timedelta64(1, 'D')
+
+def calendar_to_mjd(year, month, day):
+    '''
+    MJD for (arrays of) Gregorian calendar dates, where day can be fractional
+    (e.g. MPC 80-column dates: "2020 03 20.60574")
+    Uses the integer day-number algorithm of Fliegel & van Flandern (1968)
+    '''
+    year, month, day = np.asarray(year, dtype=np.int64), np.asarray(month, dtype=np.int64), np.asarray(day, dtype=np.float64)
+    iday = np.floor(day).astype(np.int64)
+    a, y = (14 - month)//12, year + 4800 - (14 - month)//12
+    m    = month + 12*a - 3
+    JDN  = iday + (153*m + 2)//5 + 365*y + y//4 - y//100 + y//400 - 32045
+    return (JDN - 2400001) + (day - iday)
+
+# -------------------------------------------------------------
+# Descriptor mapping an Obs attribute onto a column of the ObsStore
+# -------------------------------------------------------------
+class StoreColumn():
+    '''
+    An attribute of Obs that is held in a column of the ObsStore
+    Values of -1 in integer columns are returned as None
+    '''
+    def __init__(self, column, nullable=True):
+        self.column     = column
+        self.nullable   = nullable
+
+    def __get__(self, obs, objtype=None):
+        if obs is None:
+            return self
+        value = obs._store.columns[self.column][obs._row].item()
+        return None if self.nullable and value == -1 else value
+
+    def __set__(self, obs, value):
+        obs._store.columns[self.column][obs._row] = -1 if value is None else value
+        if obs._store.dirty is not None:
+            obs._store.dirty.add(obs._row)
+
 # -------------------------------------------------------------
 # Obs Class <==> Accepted Observations Table
 # -------------------------------------------------------------
@@ -35,44 +104,112 @@ class Obs():
     '''
     Real obs will obviously need more attributes than this
     This is just the subset I needed to get my code working
+    
+    The data for each observation are held in a row of the columnar
+    db.OBSSTORE: an Obs instance is just a thin view onto that row
     '''
+    __slots__ = ('_store', '_row')
+
     def __init__(self,RA,Dec,ObsTime,ObsCode, Replaces, desig, Deleted, db):
 
-        # Generate a unique ID (as if from db)
-        self.ObsID      = AcceptedObsID.get_next_from_db()
-        
-        # Observation-level data
-        # Supplied at point of submissions
-        self.RA         = RA
-        self.Dec        = Dec
-        self.ObsTime    = dateutil.parser.isoparse(ObsTime)
-        self.ObsCode    = ObsCode
-        self.Replaces   = Replaces
-        self.desig      = desig
-        self.Deleted    = Deleted
+        # Store self in db, with ...
+        # (i)  a unique ID (as if from db)
+        # (ii) the observation-level data supplied at point of submission
+        self._store = db.OBSSTORE
+        self._row   = self._store.append(AcceptedObsID.get_next_from_db(),
+                                         RA, Dec, isot_to_mjd(ObsTime), ObsCode, Replaces, desig, Deleted)
 
-        # Calculated by us as/after we insert
-        self.SimilarityGroupID      = None
-        self.Healpix                = None
-        self.PROCESSING_COMPLETE    = False
+        # N.B. The quantities calculated by us as/after we insert ...
+        # - SimilarityGroupID, Healpix, PROCESSING_COMPLETE
+        # ... and the parent TrackletID & BatchID (set by the parent)
+        # all start as "unset" in the store
 
-        # Allow the parent TrackletID to be stored in the observation
-        #(this will be set by the parent)
-        self.TrackletID = None
-        self.BatchID    = None
+        # N.B. Flagged as ACCEPTED once its SimilarityGroupID is known
+        # - See ObsGroup & DB.accept_observation
 
-        # Store self in db
-        #db.ACCEPTED.append(self)
-        
+    @classmethod
+    def from_store(cls, store, row):
+        ''' View of an observation that is already in the store '''
+        obs = cls.__new__(cls)
+        obs._store, obs._row = store, row
+        return obs
+
+    @classmethod
+    def from_arrays(cls, RA, Dec, MJD, ObsCodes, Replaces, desigs, Deleted, db):
+        '''
+        Bulk equivalent of Obs(...) for a block of observations supplied as arrays
+        (e.g. from the readers in "ingest.py")
+        N.B. Times are supplied as MJD (rather than ISO strings)
+        returns a list of Obs (views)
+        '''
+        store   = db.OBSSTORE
+        rows    = store.append_many(AcceptedObsID.get_many_from_db(len(MJD)), RA, Dec, MJD, ObsCodes, Replaces, desigs, Deleted)
+        return [cls.from_store(store, row) for row in rows.tolist()]
+
+    def __eq__(self, other):
+        return isinstance(other, Obs) and self._store is other._store and self._row == other._row
+
+    def __hash__(self,):
+        return hash(self._row)
         
     def __str__(self,):
         return str(self.ObsID)
+
+    # -------------------------------------------------------------
+    # Attributes held in the ObsStore
+    # -------------------------------------------------------------
+    ObsID               = StoreColumn('ObsID')
+    RA                  = StoreColumn('RA', nullable=False)
+    Dec                 = StoreColumn('Dec', nullable=False)
+    MJD                 = StoreColumn('MJD', nullable=False)
+    ObsCodeID           = StoreColumn('ObsCodeID', nullable=False)
+    Replaces            = StoreColumn('Replaces')
+    SimilarityGroupID   = StoreColumn('SimilarityGroupID')
+    Healpix             = StoreColumn('Healpix')
+    TrackletID          = StoreColumn('TrackletID')
+    BatchID             = StoreColumn('BatchID')
+    Destination         = StoreColumn('Destination', nullable=False)
+
+    @property
+    def UnitVector(self,):
+        return self._store.columns['UnitVector'][self._row]
+
+    @property
+    def ObsTime(self,):
+        return mjd_to_datetime(self.MJD)
+
+    @property
+    def ObsCode(self,):
+        return self._store.ObsCodes[self._store.columns['ObsCodeID'][self._row]]
+
+    @property
+    def desig(self,):
+        DesigID = self._store.columns['DesigID'][self._row]
+        return None if DesigID == -1 else self._store.desigs[DesigID]
+
+    @desig.setter
+    def desig(self, desig):
+        self._store.columns['DesigID'][self._row] = self._store.get_DesigID(desig)
+        if self._store.dirty is not None:
+            self._store.dirty.add(self._row)
+
+    @property
+    def Deleted(self,):
+        return self._store.get_flag(self._row, ObsStore.DELETED)
+
+    @property
+    def PROCESSING_COMPLETE(self,):
+        return self._store.get_flag(self._row, ObsStore.PROCESSING_COMPLETE)
+
+    @PROCESSING_COMPLETE.setter
+    def PROCESSING_COMPLETE(self, value):
+        self._store.set_flag(self._row, ObsStore.PROCESSING_COMPLETE, value)
         
     # -------------------------------------------------------------
     # Core Functions: assign observations to groups
     # -------------------------------------------------------------
 
-    def find_similar(self,target_obs, previous_obs):
+    def find_similar(self,target_obs, db):
         ''' find observations that are related/near-duplicate to the supplied target observation
         
         A wrapper around an updated version of check-near-dups
@@ -82,8 +219,11 @@ class Obs():
         
         '''
         
+        # (0) Pick up any changes to the obscode configuration
+        target_obs._store.obscodes.refresh()
+        
         # (1) Check for near duplicates using a version of the cnd.py algorithm
-        similar_observations = self.upgraded_check_near_dups(target_obs, previous_obs)
+        similar_observations = self.upgraded_check_near_dups(target_obs, db)
         
         # (2) Check explicit remeasurement / similarity indicator(s)
         # N.B.
@@ -93,8 +233,8 @@ class Obs():
         # (2a) Here I check whether the incoming observation has been explicitly
         #      labelled as replacing a previously known observation
         #      (presumably labelled by submitting observer in some manner)
-        if target_obs.Replaces is not None :
-            similar_observations.extend( [_ for _ in previous_obs if _.ObsID == target_obs.Replaces] )
+        if target_obs.Replaces is not None and target_obs.Replaces in db.ACCEPTED :
+            similar_observations.append( db.ACCEPTED[target_obs.Replaces] )
         
         # Ensure returned set contains target_obs
         similar_observations.append(target_obs)
@@ -105,7 +245,7 @@ class Obs():
     # -------------------------------------------------------------
     # Upgraded check-near-dups logic ...
     # -------------------------------------------------------------
-    def upgraded_check_near_dups(self,target_obs, previous_obs):
+    def upgraded_check_near_dups(self,target_obs, db):
         ''' check for near duplicates
         
         *** THIS SHOULD PROBABLY BE IMPLEMENTED DIRECTLY IN SQL ***
@@ -126,18 +266,28 @@ class Obs():
         # Calc healpix for new object (saved as object attribute)
         self.set_observation_healpix(target_obs)
         
-        # Get shortlist of similar observations based on healpix
-        shortlist_prev_obs = self.get_similar_observations_based_on_healpix(target_obs,previous_obs)
+        # Get shortlist of similar observations based on position (& time)
+        shortlist_prev_obs = self.get_similar_observations_based_on_position(target_obs,db)
+        if METRICS.enabled:
+            sizes = {'healpix+time' : len(shortlist_prev_obs)}
+
         # Refine shortlist based on ...
         # (i) Angular separation
         if shortlist_prev_obs:
             shortlist_prev_obs = self.get_close_angular_sepn(target_obs , shortlist_prev_obs)
+        if METRICS.enabled:
+            sizes['angular_sepn'] = len(shortlist_prev_obs)
         # (ii) Difference in time
         if shortlist_prev_obs:
             shortlist_prev_obs = self.get_close_in_time(target_obs , shortlist_prev_obs)
+        if METRICS.enabled:
+            sizes['time'] = len(shortlist_prev_obs)
         # (iii) Similarity in obsCode
         if shortlist_prev_obs:
             shortlist_prev_obs = self.get_close_observatory_location(target_obs , shortlist_prev_obs)
+        if METRICS.enabled:
+            sizes['obscode'] = len(shortlist_prev_obs)
+            METRICS.observe_shortlists(sizes)
 
         return shortlist_prev_obs
 
@@ -146,102 +296,86 @@ class Obs():
         Set healpix for observations using standard parameters
         See original cnd.py for more details
         '''
-        obs.Healpix = hp.ang2pix(sideHP , np.radians(obs.RA) , np.radians(90.-obs.Dec), nest=nestedHP)
+        obs.Healpix = near_dups.radec_to_healpix(obs.RA, obs.Dec, sideHP=sideHP, nestedHP=nestedHP)
 
-    def get_similar_observations_based_on_healpix(self,target_obs,previous_obs):
+    def get_similar_observations_based_on_position(self,target_obs,db):
         '''
-        Get any known observations that are in healpix near to the target_obs
+        Get any known observations that are near to the target_obs
         See original cnd.py for more details
         ***         OBVIOUSLY THIS SHOULD BE A TRIVIAL SQL QUERY        ***
-        '''
-        return [obs for obs in previous_obs if obs.Healpix in self.get_nearby_healpix_list(target_obs) ]
-
-    def get_nearby_healpix_list(self,obs, sideHP=32768, nestedHP=True):
-        ''' See original cnd.py for more details '''
-        
-        # If arcsecRadius < hp.nside2resol(32768, arcmin = True)*60 [ which is ~ 6.4 arc-sec ], ...
-        # ... then only need to search adjacent HP
-        listHP = list(hp.get_all_neighbours(sideHP, obs.Healpix, nest=nestedHP ))
-        listHP.append(obs.Healpix)
-
-        # If arcsecRadius > hp.nside2resol(32768, arcmin = True)*60, then need to search neighbors of neighbours ...
-        arcsecRadius = self.get_arcsecRadius(obs)
-        if arcsecRadius > hp.nside2resol(sideHP, arcmin = True)*60 :
-            for i in range(int( arcsecRadius // (hp.nside2resol(sideHP, arcmin = True)*60) )):
-                tmpHP = [h for h in listHP]
-                for h in tmpHP:
-                    listHP.extend(list(hp.get_all_neighbours(sideHP, h, nest=nestedHP )))
-                listHP=list(set(listHP))
-        return listHP
-       
         
+        Uses the spatial engine of the DB (e.g. the composite (healpix, time)
+        index on the ACCEPTED table: see spatial.py), so only the observations
+        in the target's neighbourhood *and* time-window are ever looked at
+        (get_close_angular_sepn & get_close_in_time then do the exact checks)
+        '''
+        MJD_lo, MJD_hi = self.get_time_window(target_obs)
+        return db.get_obs_near( target_obs.UnitVector, target_obs.Healpix, self.get_arcsecRadius(target_obs), MJD_lo, MJD_hi )
+
+    def get_time_window(self, obs, padSeconds=1e-3):
+        ''' (MJD_lo, MJD_hi) that encloses +/- timeDeltaSeconds (padded slightly against rounding)'''
+        deltaDays = (self.get_timeDeltaSeconds(obs) + padSeconds) / 86400.
+        return obs.MJD - deltaDays, obs.MJD + deltaDays
+
     def get_close_angular_sepn(self,target_obs , shortlist_prev_obs):
         '''
         Select any observations that are within arcsecRadius of the target observation
         See original cnd.py for more details
-        '''
-        dotProducts         = np.clip([
-                                hp.ang2vec(np.radians(90 - target_obs.Dec), np.radians(target_obs.RA)).dot(uv) for uv in \
-                                        [ hp.ang2vec(np.radians(90 - o.Dec), np.radians(o.RA)) for o in shortlist_prev_obs ] ], -1,1)
         
-        angles              = np.degrees(np.arccos(dotProducts))*3600.
+        Uses the unit-vectors that were stored (once) when each observation was ingested
+        '''
+        store   = target_obs._store
+        rows    = np.array([o._row for o in shortlist_prev_obs])
         
-        allowed_radii_for_shortlist = [ np.max( [self.get_arcsecRadius(_) ,self.get_arcsecRadius(target_obs)]) for _ in shortlist_prev_obs ]
-        return [ obs for i,obs in enumerate(shortlist_prev_obs) if angles[i] < allowed_radii_for_shortlist[i] ]
+        allowed_radii_for_shortlist = np.maximum( self.get_arcsecRadiusArray(store, rows), self.get_arcsecRadius(target_obs) )
+        close   = close_angular_sepn( target_obs.UnitVector, store['UnitVector'][rows], allowed_radii_for_shortlist )
+        return [ obs for obs, c in zip(shortlist_prev_obs, close) if c ]
         
     def get_close_in_time(self,target_obs , shortlist_prev_obs ):
         '''
         Select any observations that are taken within timeDeltaSeconds of the target observation
         See original cnd.py for more details
         ***         OBVIOUSLY THIS SHOULD BE A TRIVIAL SQL QUERY                        ***
-        *** (PRESUMABLY COMBINED WITH get_similar_observations_based_on_healpix ABOVE ) ***
+        *** (PRESUMABLY COMBINED WITH get_similar_observations_based_on_position ABOVE ) ***
         '''
         # The allowed time-range is the time of the observation +/- the time-delta (in days)
-        deltaMins = self.get_timeDeltaSeconds(target_obs) / (60.)
+        deltaDays = self.get_timeDeltaSeconds(target_obs) / 86400.
 
-        # Now search the shortlist
-        return [obs for obs in shortlist_prev_obs if np.abs( obs.ObsTime - target_obs.ObsTime) <= timedelta(minutes=deltaMins) ]
+        # Now search the shortlist (on the MJD column of the store)
+        store   = target_obs._store
+        rows    = np.array([o._row for o in shortlist_prev_obs])
+        close   = np.abs( store['MJD'][rows] - target_obs.MJD ) <= deltaDays
+        return [ obs for obs, c in zip(shortlist_prev_obs, close) if c ]
 
     def get_close_observatory_location(self,target_obs , shortlist_prev_obs ):
         '''
         Select any observations that are taken from co-located ObsCodes
         ***         OBVIOUSLY THIS SHOULD BE A TRIVIAL SQL QUERY                        ***
-        *** (PRESUMABLY COMBINED WITH get_similar_observations_based_on_healpix ABOVE ) ***
+        *** (PRESUMABLY COMBINED WITH get_similar_observations_based_on_position ABOVE ) ***
         '''
-        return [obs for obs in shortlist_prev_obs if obs.ObsCode in self.get_ObsCodeList(target_obs) ]
-
-    # This dictionary would become a table of values
-    # in the main database
-    arcsecRadius_DICT = {
-    'C51' : 10.0,
-    'C57' : 20.0,
-    }
-    def get_arcsecRadius(self,obs, arcsecRadius=5.0):
-        ''' return allowed search-radius [arc-sec] : note that arcsecRadius_DICT is NOT complete'''
-        return arcsecRadius if obs.ObsCode not in self.arcsecRadius_DICT else self.arcsecRadius_DICT[obs.ObsCode]
-        
-    # This dictionary would become a table of values
-    # in the main database
-    timeDeltaSeconds_DICT = {
-    '704' : 8
-    }
-    def get_timeDeltaSeconds(self,obs, timeDeltaSeconds=30.0):
-        ''' return allowed search-radius [time]: note that timeDeltaSeconds_DICT is NOT complete'''
-        return timeDeltaSeconds if obs.ObsCode not in self.timeDeltaSeconds_DICT else self.timeDeltaSeconds_DICT[obs.ObsCode]
-
-    # This dictionary would become a table of values
-    # in the main database
-    obsCode_DICT = {
-        '568' : ['568','T09','T10','T12','T14'],
-        'T09' : ['568','T09'],
-        'T10' : ['568','T10'],
-        'T12' : ['568','T12'],
-        'T14' : ['568','T14'],
-    }
-    def get_ObsCodeList(self, obs):
-        ''' return allowed equivalent obs-codes : note that obsCode_DICT is NOT complete'''
-        return [obs.ObsCode] if obs.ObsCode not in self.obsCode_DICT else self.obsCode_DICT[obs.ObsCode]
+        store   = target_obs._store
+        rows    = np.array([o._row for o in shortlist_prev_obs])
+        close   = store.obscodes.equivalent( target_obs.ObsCodeID, store['ObsCodeID'][rows] )
+        return [ obs for obs, c in zip(shortlist_prev_obs, close) if c ]
 
+    # The obscode-dependent values used below live in a config file
+    # (obscodes.json), compiled into look-up arrays: see obscodes.py
+    def get_arcsecRadius(self,obs):
+        ''' return allowed search-radius [arc-sec] : note that obscodes.json is NOT complete'''
+        return obs._store.obscodes.arcsecRadius(obs.ObsCodeID)
 
+    def get_arcsecRadiusArray(self, store, rows):
+        ''' vectorized get_arcsecRadius for rows of the ObsStore '''
+        return store.obscodes.arcsecRadius(store['ObsCodeID'][rows])
+        
+    def get_timeDeltaSeconds(self,obs):
+        ''' return allowed search-radius [time]: note that obscodes.json is NOT complete'''
+        return obs._store.obscodes.timeDeltaSeconds(obs.ObsCodeID)
 
+    def get_timeDeltaSecondsArray(self, store, rows):
+        ''' vectorized get_timeDeltaSeconds for rows of the ObsStore '''
+        return store.obscodes.timeDeltaSeconds(store['ObsCodeID'][rows])
 
+    def get_ObsCodeList(self, obs):
+        ''' return allowed equivalent obs-codes : note that obscodes.json is NOT complete'''
+        return obs._store.obscodes.equivalent_ObsCodes(obs.ObsCode)
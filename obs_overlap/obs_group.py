@@ -10,13 +10,14 @@ observations will be assigned "credit" and "selected" status.
 # Third Party Imports
 # -------------------------------------------------------------
 import sys, os
-from collections import defaultdict, namedtuple
+from collections import defaultdict, namedtuple, OrderedDict
+from array import array
 import numpy as np
 
 # -------------------------------------------------------------
 # Local Imports
 # -------------------------------------------------------------
-from db import SimilarityGroupID
+from metrics import METRICS, CATEGORY_NAMES
 
 
 
@@ -36,18 +37,19 @@ class ObsGroup():
     Establishes the "credit" & "primary" observation for the group
     Categorizes the "overlap" nature of the group.
     '''
-    def __init__(self, new_obs, db):
+    def __init__(self, new_obs, db, similar_obs=None):
     
         # Work out the similarity group for the new observation
         # - The functionality is in "Obs" class. Not sure that makes sense ...
-        self.observations = {obs.ObsID:obs for obs in new_obs.find_similar( new_obs ,self.get_all_known_obs(db) ) }
+        # - Can be supplied pre-computed (e.g. for an entire batch by near_dups.find_similar_in_batches)
+        if similar_obs is None:
+            similar_obs = new_obs.find_similar( new_obs , db )
+        self.observations = {obs.ObsID:obs for obs in similar_obs }
     
         # Assign SimilarityGroupID
-        self.SimilarityGroupID = self.get_SimilarityGroupID( )
-        
-        # Take care to assign the SimilarityGroupID to all of the obs in self.observations
-        for _ in self.observations.values():
-            db.BATCHES[_.BatchID].tracklets[_.TrackletID].observations[_.ObsID].SimilarityGroupID = self.SimilarityGroupID
+        # - Takes care to assign the SimilarityGroupID to all of the obs in self.observations,
+        #   and to the members of any groups that the new observation has merged
+        self.SimilarityGroupID = self.get_SimilarityGroupID( db, BatchID=new_obs.BatchID )
         
         # Work out the credit & primary observation for the similarity group
         # - This sets self.credit_ObsID & self.primary_ObsID
@@ -58,30 +60,96 @@ class ObsGroup():
         # - This sets ... self.category, self.desig, self.TrackletIDs
         self.category, self.desig, self.TrackletIDs = None, None, None
         self.categorize_similarity_group_wrt_new_observation( db, new_obs )
+        if METRICS.enabled:
+            METRICS.count(f'ObsGroup.category.{CATEGORY_NAMES[self.category]}')
         
         # Save self in database
+        # - keeping only the ObsIDs of the similar observations, not the observations themselves
+        self.release_observations()
         db.OBSGROUPS[self.SimilarityGroupID]=self
+        
+        # The new observation is now accepted (& indexed)
+        db.accept_observation(new_obs)
+
+    @classmethod
+    def from_members(cls, SimilarityGroupID, observations):
+        '''
+        ObsGroup for an already-formed similarity group (e.g. see backfill)
+        N.B. Nothing is assigned (status, category, ...) & it is NOT saved in the db
+        '''
+        group = cls.__new__(cls)
+        group.observations      = {obs.ObsID:obs for obs in observations}
+        group.SimilarityGroupID = SimilarityGroupID
+        group.credit_ObsID, group.primary_ObsID = None, None
+        group.category, group.desig, group.TrackletIDs = None, None, None
+        return group
+
+    def release_observations(self,):
+        '''
+        Once the group is set-up, only the ObsIDs of its observations are kept (in self.ObsIDs)
+        N.B. db.OBSGROUPS holds a group for every SimilarityGroupID, so the (views of the)
+             observations would otherwise be kept for every accepted observation
+        '''
+        self.ObsIDs = array('q', self.observations)
+        del self.observations
+
+    def nbytes(self,):
+        ''' Approximate memory used by the group '''
+        return sys.getsizeof(self) + sys.getsizeof(self.__dict__) + sys.getsizeof(self.ObsIDs) + sys.getsizeof(self.TrackletIDs)
 
                     
-    def get_all_known_obs(self,db):
-        # We will need all observations known to this point
-        # Obviously my data structures could be nicer ...
-        known_obs = []
-        for bID, bb in db.BATCHES.items():
-            for tID, tt in bb.tracklets.items():
-                known_obs.extend( list(tt.observations.values() ) )
-        return known_obs
-        
     # -------------------------------------------------------------
     # Set the ObsGroupID for the set of input observations
     # -------------------------------------------------------------
-    def get_SimilarityGroupID(self, ):
+    def get_SimilarityGroupID(self, db, BatchID=None):
         '''
-        If SimilarityGroupID previously assigned, use minimum
+        If SimilarityGroupID(s) previously assigned, merge the groups (see db.SimilarityGroups)
         Otherwise, generate a new one
+
+        Only the observations that change group are (re-)labelled:
+        the previously ungrouped obs & the members of any absorbed groups
+        The OBSGROUPS entries of absorbed groups are removed (the merged
+        group is saved under the surviving SimilarityGroupID)
+
+        The status of the group (see GroupStatus) is brought up-to-date in the same way:
+        the statuses of any absorbed groups are merged in, & then the ungrouped obs added
+        Any resulting change to the primary observation is written to the
+        journal for the batch (BatchID) of the new observation (see PrimaryJournal)
         '''
+        groups    = db.SIMILARITYGROUPS
+        ungrouped = [obs for obs in self.observations.values() if obs.SimilarityGroupID is None]
         extant_SimilarityGroupIDs = self.check_extant_SimilarityGroupIDs( )
-        return SimilarityGroupID.get_next_from_db() if extant_SimilarityGroupIDs is None else np.min(extant_SimilarityGroupIDs)
+
+        if extant_SimilarityGroupIDs is None:
+            ID      = groups.new([obs.ObsID for obs in ungrouped])
+            relabel = [obs.ObsID for obs in ungrouped]
+            status  = db.GROUPSTATUS[ID] = GroupStatus()
+            primary = {ID : None}
+        else:
+            # N.B. The status of each group must be in hand before their members are merged
+            statuses = {root : db.GROUPSTATUS[root] for root in set(groups.find(_) for _ in extant_SimilarityGroupIDs)}
+            primary  = {root : status.primary_ObsID for root, status in statuses.items()}
+            ID, absorbed, moved = groups.union(extant_SimilarityGroupIDs)
+            groups.add(ID, [obs.ObsID for obs in ungrouped])
+            relabel = [obs.ObsID for obs in ungrouped] + moved
+            status  = statuses[ID]
+            start   = 0
+            for _ in absorbed:
+                db.OBSGROUPS.pop(_, None)
+                db.GROUPSTATUS.pop(_, None)
+                status.merge(db, moved[start:start + statuses[_].n_members])
+                start += statuses[_].n_members
+
+        status.add(db, ungrouped)
+        db.set_SimilarityGroupID(relabel, ID)
+        if BatchID is not None:
+            db.PRIMARY_JOURNAL.record(BatchID, ID, primary, status.primary_ObsID)
+
+        # Any fits that selected a replaced primary are out-of-date (see processing.FitCache)
+        replaced = [old for old in primary.values() if old is not None and old != status.primary_ObsID]
+        if replaced:
+            db.FIT_CACHE.invalidate(replaced)
+        return ID
         
     def check_extant_SimilarityGroupIDs(self,):
         ''' if we have a group, we want to assign the lowest extant SimilarityGroupID to all associated obs'''
@@ -107,6 +175,8 @@ class ObsGroup():
         if:   self.primary_ObsID==None  : => The entire group is not selectable
         else:
             if only a SINGLE obs        : => The group gets SINGLE status
+            (or only UNSELECTABLE others)  [ they are in neither DESIGNATED nor the ITF,
+                                             so there is nothing for the new obs to join ]
             else:
                 if any DESIGNATION      : => The group gets DESIGNATION status [ & a designation is set ]
                 else:
@@ -129,7 +199,9 @@ class ObsGroup():
         else:
 
             # Similarity group (excluding self)
-            similar_obs = [so for so in self.observations.values() if so.ObsID != new_obs.ObsID ]
+            # N.B. UNSELECTABLE observations are ignored: overlapping only with those is no overlap at all
+            # N.B. Obs.Destination uses the same values as self.category (-1 / 1 / 2 => UNSELECTABLE / DESIGNATED / ITF)
+            similar_obs = [so for so in self.observations.values() if so.ObsID != new_obs.ObsID and so.Destination != -1 ]
 
             # No overlap with any other objects : we hope that this is the most common case
             if len( similar_obs ) == 0 :
@@ -139,7 +211,7 @@ class ObsGroup():
             else :
             
                 # Does the observation overlap with anything that is DESIGNATED ?
-                overlapped_designations = list(set([so.desig for so in similar_obs if so.ObsID in db.DESIGNATED ]))
+                overlapped_designations = list(set([so.desig for so in similar_obs if so.Destination == 1 ]))
                 n_designated = len(overlapped_designations)
                 assert n_designated <= 1, f'db.DESIGNATED is corrupt (> 1 desig overlapped): {overlapped_designations}'
                 
@@ -148,7 +220,7 @@ class ObsGroup():
                     self.desig      = overlapped_designations[0]
 
                 # Does the observation overlap with anything in the ITF ?
-                self.TrackletIDs = list(set([so.TrackletID for so in similar_obs if so.ObsID in db.ITF ]))
+                self.TrackletIDs = list(set([so.TrackletID for so in similar_obs if so.Destination == 2 ]))
                 n_itf = len(self.TrackletIDs)
                 if n_itf:
 
@@ -197,109 +269,289 @@ class ObsGroup():
             (iii) Yet more complex criteria may be necessary at a later date
         
         '''
-        # The discovery credit goes to ...
-        credit_obs = self.assign_discovery_credit(db)
-        
-        # (1) There may be no usable observations
-        if credit_obs is None :
-            credit_ObsID, primary_ObsID = None, None
+        # The credit & primary observations are kept up-to-date by the
+        # (persistent) status of the similarity group, as observations are
+        # added & groups merged (see GroupStatus & get_SimilarityGroupID)
+        # N.B. They are therefore for the whole similarity group, not just
+        #      for the observations that are similar to the new observation
+        status = db.GROUPSTATUS[self.SimilarityGroupID]
+
+        # Set as properties of the object
+        self.credit_ObsID = status.credit_ObsID
+        self.primary_ObsID= status.primary_ObsID
         
+        return True
+
+
+# -------------------------------------------------------------
+# Persistent status of each similarity group
+# -------------------------------------------------------------
+# Max number of statuses held by a GroupStatusTable (the least-recently used are dropped beyond this)
+GROUPSTATUS_SIZE = 100000
+
+class GroupStatus():
+    '''
+    The state needed to keep the credit & primary observations of a similarity
+    group up-to-date as observations are added (& groups merged), in time
+    proportional to the change, rather than to the size of the group
+
+     - credit   : ObsID of the observation from the earliest submission (ignoring *Deleted* observations)
+                  (with the SubmissionMJD & actor of that submission)
+     - replaced : ObsIDs that have been explicitly replaced by members of the group (None if there are none)
+     - actors   : an ActorStatus for each actor (in the order they were first seen): the actor's
+                  ObsIDs (in the order they were added), its latest selectable observation & its
+                  champion (the best of its selectable observations, see compare_obs)
+
+    Selectable observations are those that are neither replaced nor deleted,
+    & the primary observation is then (as per ObsGroup.assign_status) the latest
+    from the credit actor, compared against the champions of the other actors
+
+    Only ObsIDs are held: the observations themselves are looked up (via db.rows_of)
+    when they need to be compared, or when an actor's latest / champion is
+    replaced & has to be re-found from the actor's other observations
+
+    Members are added in the order of SimilarityGroups.get_members (with the members
+    of a merged group following on). Ties in the submission times then go to the
+    first (credit) & last (latest) member, & the result is the same as re-building
+    the status from the members (see from_members)
+    '''
+    __slots__ = ('n_members', 'credit', 'credit_MJD', 'credit_actor', 'replaced', 'actors', 'primary')
+
+    def __init__(self,):
+        self.n_members      = 0
+        self.credit         = None
+        self.credit_MJD     = None
+        self.credit_actor   = None
+        self.replaced       = None
+        self.actors         = []
+        self.primary        = None
+
+    @classmethod
+    def from_members(cls, db, observations):
+        ''' Build the status of a group from all of its members '''
+        status = cls()
+        status.add(db, observations)
+        return status
+
+    @property
+    def credit_ObsID(self,):
+        return self.credit
+
+    @property
+    def primary_ObsID(self,):
+        return self.primary
+
+    def add(self, db, observations):
+        ''' Add observations to the group & re-select the primary observation '''
+        for obs in observations:
+            batch = db.BATCHES[obs.BatchID]
+            self._add(db, obs, batch.ActorID, batch.SubmissionMJD)
+        self._select_primary(db)
+
+    def merge(self, db, ObsIDs):
+        ''' Add all of the members of another group (e.g. a smaller group that has been absorbed) '''
+        self.add(db, [db.OBSSTORE.view(row) for row in db.rows_of(ObsIDs)])
+
+    def _add(self, db, obs, actor, SubmissionMJD):
+        ObsID = obs.ObsID
+        self.n_members += 1
+        A = self.actor_status(actor)
+        if A is None:
+            A = ActorStatus(actor, ObsID)
+            self.actors.append(A)
         else:
-            credit_ObsID = credit_obs.ObsID
-            
-            # Get the person/group that submitted the batch
-            credit_Actor = db.BATCHES[credit_obs.BatchID].ActorID
-        
-            # obs that have explicitly been replaced by some other obs
-            replaced_obsIDs = [obs.Replaces for obs in self.observations.values() if obs.Replaces is not None ]
-            # we only consider obs that are neither replaced nor deleted
-            selectable_obs  = [ obs for obs in self.observations.values() if obs.ObsID not in replaced_obsIDs and obs.Deleted is not True]
-         
+            A.ObsIDs.append(ObsID)
 
-            # (2) There may be no selectable -primary observations
-            if not selectable_obs:
-                primary_ObsID = None
+        # obs that have explicitly been replaced by some other obs
+        if obs.Replaces is not None and not self.is_replaced(obs.Replaces):
+            if self.replaced is None:
+                self.replaced = set()
+            self.replaced.add(obs.Replaces)
+            self._drop(db, obs.Replaces)
 
-            # (3) There may be both credit & primary observations ...
-            else:
+        # (NB - don't consider *Deleted* observations)
+        if obs.Deleted is True:
+            return
+        if self.credit is None or SubmissionMJD < self.credit_MJD:
+            self.credit, self.credit_MJD, self.credit_actor = ObsID, SubmissionMJD, actor
+
+        # we only consider obs that are neither replaced nor deleted
+        if not self.is_replaced(ObsID):
+            if A.latest is None or SubmissionMJD >= A.latest_MJD:
+                A.latest_MJD, A.latest = SubmissionMJD, ObsID
+            A.champion = ObsID if A.champion is None else compare_obs(view(db, A.champion), obs).ObsID
+
+    def is_replaced(self, ObsID):
+        return self.replaced is not None and ObsID in self.replaced
+
+    def actor_status(self, actor):
+        for A in self.actors:
+            if A.actor == actor:
+                return A
+        return None
+
+    def _drop(self, db, ObsID):
+        ''' An observation is no longer selectable: re-find the latest & champion of its actor (if necessary) '''
+        for A in self.actors:
+            if A.latest == ObsID or A.champion == ObsID:
+                selectable = [obs for obs in (db.OBSSTORE.view(row) for row in db.rows_of(A.ObsIDs)) if not self.is_replaced(obs.ObsID) and obs.Deleted is not True]
+                if A.latest == ObsID:
+                    A.latest_MJD, A.latest = None, None
+                    for obs in selectable:
+                        SubmissionMJD = db.BATCHES[obs.BatchID].SubmissionMJD
+                        if A.latest is None or SubmissionMJD >= A.latest_MJD:
+                            A.latest_MJD, A.latest = SubmissionMJD, obs.ObsID
+                if A.champion == ObsID:
+                    champion = None
+                    for obs in selectable:
+                        champion = obs if champion is None else compare_obs(champion, obs)
+                    A.champion = None if champion is None else champion.ObsID
+                return
+
+    def _select_primary(self, db):
+        ''' Latest from the credit actor, compared against the best from each of the other actors '''
+        primary_Obs = None
+        if self.credit is not None:
+
+            # Here we attempt to select the LATEST from the original submitter
+            latest = self.actor_status(self.credit_actor).latest
+            if latest is not None:
+                primary_Obs = view(db, latest)
+
+            # Here we check whether there are any other obs which are BETTER than the default
+            for A in self.actors:
+                if A.actor != self.credit_actor and A.champion is not None:
+                    primary_Obs = view(db, A.champion) if primary_Obs is None else compare_obs(primary_Obs, view(db, A.champion))
+        self.primary = None if primary_Obs is None else primary_Obs.ObsID
+
+    def nbytes(self,):
+        ''' Approximate memory used by the status '''
+        return sys.getsizeof(self) + sys.getsizeof(self.actors) + sys.getsizeof(self.replaced) + sum(A.nbytes() for A in self.actors)
+
+class ActorStatus():
+    ''' The observations of one actor in a similarity group (see GroupStatus) '''
+    __slots__ = ('actor', 'ObsIDs', 'latest_MJD', 'latest', 'champion')
+
+    def __init__(self, actor, ObsID):
+        self.actor      = actor
+        self.ObsIDs     = array('q', (ObsID,))
+        self.latest_MJD = None
+        self.latest     = None
+        self.champion   = None
+
+    def nbytes(self,):
+        return sys.getsizeof(self) + sys.getsizeof(self.ObsIDs) + sum(map(sys.getsizeof, self.ObsIDs))
+
+def view(db, ObsID):
+    ''' Obs (view) for an ObsID '''
+    return db.OBSSTORE.view(db.rows_of([ObsID])[0])
+
+
+class GroupStatusTable(OrderedDict):
+    '''
+    SimilarityGroupID (of the root group) -> GroupStatus
 
-                # divide obs according to the submitting_actor
-                obs_by_actor = defaultdict(list)
-                for obs in selectable_obs :
-                    obs_by_actor[ db.BATCHES[obs.BatchID].ActorID ].append(obs)
-
-                # Here we attempt to select the LATEST from the original submitter
-                primary_Obs = None
-                for actor, obs_list in obs_by_actor.items():
-                    if actor ==  credit_Actor:
-                        submissionsDates = np.asarray( [ db.BATCHES[obs.BatchID].SubmissionTime for obs in obs_list ] )
-                        # Sort together
-                        submissionsDates,sorted_obs_list = map(list, zip(*sorted(zip(submissionsDates,obs_list))))
-                        primary_Obs      = sorted_obs_list[-1] # LATEST
-                        
-                # Here we check whether there are any other obs which are BETTER than the default
-                for actor, obs_list in obs_by_actor.items():
-                    if actor !=  credit_Actor:
-                        for obs in obs_list:
-                            if primary_Obs is None :
-                                primary_Obs = obs
-                            else:
-                                primary_Obs = self.__compare_obs(primary_Obs, obs)
-                                
-                primary_ObsID=primary_Obs.ObsID
+    The status of any group that is not held (e.g. a group from an earlier
+    session, or one loaded by backfill) is re-built from its members
+    Only the size most-recently used statuses are held: the statuses of groups
+    that have not been touched since are dropped (& re-built if they are needed again)
+    '''
+    def __init__(self, db, size=GROUPSTATUS_SIZE):
+        super().__init__()
+        self.db, self.size = db, size
 
-        # Set as properties of the object
-        self.credit_ObsID = credit_ObsID
-        self.primary_ObsID= primary_ObsID
-        
-        return True
+    def __getitem__(self, SimilarityGroupID):
+        status = super().__getitem__(SimilarityGroupID)
+        self.move_to_end(SimilarityGroupID)
+        return status
 
+    def __setitem__(self, SimilarityGroupID, status):
+        super().__setitem__(SimilarityGroupID, status)
+        self.move_to_end(SimilarityGroupID)
+        while len(self) > self.size:
+            self.popitem(last=False)
 
-    # -------------------------------------------------------------
-    # Internal methods
-    # -------------------------------------------------------------
+    def __missing__(self, SimilarityGroupID):
+        rows    = self.db.rows_of(self.db.SIMILARITYGROUPS.get_members(SimilarityGroupID))
+        status  = self[SimilarityGroupID] = GroupStatus.from_members(self.db, [self.db.OBSSTORE.view(row) for row in rows])
+        return status
 
-    def __compare_obs( self, selected_Obs, obs):
-        '''
-        We want / need some ability to compare observations
-        
-        Perhaps we could use an approach similar to orbfit:
-         - use the observation with the lowest "weighted" uncertainty
-         
-        # -------------------------------------------------------------
-        # *** MICHAEL : MATT P. NEEDS TO FURTHER DEVELOP THIS LOGIC ***
-        #
-        # If there existed a "weighted_uncertainty" quantity ...
-        # return selected_Obs if selected_Obs.weighted_uncertainty <= obs.weighted_uncertainty else obs
-        # -------------------------------------------------------------
-         
-        For the sake of this demo, I will randomly select one of
-        the observations
-        '''
-        return selected_Obs if np.random.random() > 0.5 else obs
+    def nbytes(self,):
+        ''' Approximate memory used by the statuses that are held '''
+        return sys.getsizeof(self) + sum(status.nbytes() for status in self.values())
+
+
+# -------------------------------------------------------------
+# Journal of the changes to the primary observations
+# -------------------------------------------------------------
+class PrimaryJournal():
+    '''
+    Per-batch journal of the changes to the primary observations of the similarity groups
+
+    ObsGroup records (SimilarityGroupID, old primary ObsID, new primary ObsID)
+    whenever a new observation changes the primary of a group (including any
+    groups that it merges), so that the tracklet-processing can tell whether
+    any of the primaries of its observations have changed by looking up just
+    their groups (see Tracklet.primary_selected_observations_changed)
 
+    A new group has no earlier primary, so it is not a change (& is not recorded)
+    The records & the groups changed in each batch are only held until the batch
+    has been processed (see close_batches), so the journal does not grow with the db
 
+    save : optional function (BatchID, SimilarityGroupID, old, new) to write
+           each record elsewhere (see SQLiteDB), rather than holding it here
+    '''
+    def __init__(self, save=None):
+        self.records = defaultdict(list)    # BatchID -> [(SimilarityGroupID, old, new)]
+        self.changed = defaultdict(set)     # BatchID -> SimilarityGroupIDs whose primary has changed
+        self.save    = save
 
-    def assign_discovery_credit(self, db):
+    def record(self, BatchID, SimilarityGroupID, old, new):
         '''
-        For now I assign discovery credit to the earliest submissionDate
-        More complex criteria may be necessary at a later date
+        Record any change to the primary of a group
+        old : {SimilarityGroupID : old primary ObsID} for the group & any groups merged into it
+        N.B. An earlier change (in the batch) to any of the merged groups is a change to the merged group
         '''
-                
-        # Get the submission-date of the batch that contains the observations of interest
-        # (NB - don't consider *Deleted* observations)
-        submissionsDates = [db.BATCHES[o.BatchID].SubmissionTime for o in self.observations.values() if o.Deleted is not True]
+        changed = self.changed[BatchID]
+        for ID, old_primary in old.items():
+            if old_primary is not None and old_primary != new:
+                if self.save is None:
+                    self.records[BatchID].append((ID, old_primary, new))
+                else:
+                    self.save(BatchID, ID, old_primary, new)
+                changed.add(SimilarityGroupID)
+            elif ID in changed:
+                changed.add(SimilarityGroupID)
 
-        # All observations are deleted. No useful data
-        if len(submissionsDates) == 0 :
-            credit_obs = None
-        # Some usable observations exist: assign credit to earliest
-        else:
-            # Sort together
-            submissionsDates,grouped_observations = map(list, zip(*sorted(zip(submissionsDates, list(self.observations.values()) ))))
-            credit_obs = grouped_observations[0]
+    def primary_changed(self, BatchID, SimilarityGroupIDs):
+        ''' Has the primary of any of the groups changed in the batch ? '''
+        changed = self.changed.get(BatchID, ())
+        return any(ID in changed for ID in SimilarityGroupIDs)
 
-        return credit_obs
+    def close_batches(self,):
+        ''' The batches so far have been processed (e.g. at the end of a transaction): forget their records & the groups they changed '''
+        self.records.clear()
+        self.changed.clear()
 
 
+# -------------------------------------------------------------
+# Comparison of observations (for the primary observation)
+# -------------------------------------------------------------
+def compare_obs( selected_Obs, obs):
+    '''
+    We want / need some ability to compare observations
 
+    Perhaps we could use an approach similar to orbfit:
+     - use the observation with the lowest "weighted" uncertainty
+
+    # -------------------------------------------------------------
+    # *** MICHAEL : MATT P. NEEDS TO FURTHER DEVELOP THIS LOGIC ***
+    #
+    # If there existed a "weighted_uncertainty" quantity ...
+    # return selected_Obs if selected_Obs.weighted_uncertainty <= obs.weighted_uncertainty else obs
+    # -------------------------------------------------------------
+
+    For the sake of this demo, I will randomly select one of
+    the observations
+    '''
+    return selected_Obs if np.random.random() > 0.5 else obs
@@ -0,0 +1,188 @@
+'''
+The ObsCodeTable class in "obscodes.py" holds the observatory-code
+dependent parameters used when checking for near-duplicates
+(search-radius, time-delta, equivalent / co-located obscodes)
+
+These used to be hard-coded dictionaries on the Obs class.
+They are now read from a config file ("obscodes.json") and
+compiled into look-up arrays indexed by an integer ObsCodeID,
+so that the per-observation checks become array gathers.
+
+The config can be re-loaded without restarting (see refresh()):
+ObsCodeIDs are never re-assigned, so anything that has stored
+an ObsCodeID (e.g. the ObsStore) remains valid.
+
+'''
+
+# -------------------------------------------------------------
+# Third Party Imports
+# -------------------------------------------------------------
+import os
+import json
+import time
+from collections import namedtuple
+import numpy as np
+
+
+# Default location of the config file
+DEFAULT_CONFIG = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'obscodes.json')
+
+# The compiled look-up arrays (all indexed by ObsCodeID)
+# - equivalence_class[i] : the obscodes with the same class are allowed equivalents of each other
+#
+# N.B. The classes are the transitive closure of the configured equivalences,
+# i.e. the co-located sites (T09 ~ 568 ~ T10 => T09 ~ T10)
+compiled_obscodes = namedtuple('compiled_obscodes', ['arcsecRadius', 'timeDeltaSeconds', 'equivalence_class'])
+
+
+class ObsCodeTable():
+    '''
+    Observatory-code dependent parameters, compiled into arrays indexed by ObsCodeID
+    '''
+    def __init__(self, filepath=DEFAULT_CONFIG, check_interval=10.0):
+
+        self.filepath       = filepath
+        self.check_interval = check_interval
+
+        # Integer IDs for ObsCodes: assigned on first sight, never changed
+        self.ObsCodes, self.ObsCodeIDs = [], {}
+
+        # Load the config & compile the arrays
+        self.mtime, self.last_check = None, None
+        self.reload()
+
+    # -------------------------------------------------------------
+    # Config handling
+    # -------------------------------------------------------------
+    def reload(self,):
+        ''' (Re-)read the config file & re-compile the look-up arrays '''
+        with open(self.filepath) as fh:
+            config = json.load(fh)
+        self.check(config)
+        self.mtime      = os.path.getmtime(self.filepath)
+        self.last_check = time.monotonic()
+
+        # Make sure that every configured code has an ID
+        for key in ['arcsecRadius', 'timeDeltaSeconds', 'equivalentObsCodes']:
+            for ObsCode, value in config.get(key, {}).items():
+                self._assign_ObsCodeID(ObsCode)
+                if key == 'equivalentObsCodes':
+                    for c in value:
+                        self._assign_ObsCodeID(c)
+
+        self.config = config
+        self.compiled = self._compile()
+        return self.compiled
+
+    def check(self, config):
+        '''
+        Equivalent obscodes must share a search-radius: the shortlist of the
+        KDTreeEngine only reaches the target's own arcsecRadius (see spatial.KDTreeEngine)
+        '''
+        radius = lambda ObsCode : float(config.get('arcsecRadius', {}).get(ObsCode, config['defaults']['arcsecRadius']))
+        for ObsCode, ObsCodeList in config.get('equivalentObsCodes', {}).items():
+            different = [c for c in ObsCodeList if radius(c) != radius(ObsCode)]
+            assert not different, f'{self.filepath}: the arcsecRadius of {ObsCode} is not shared by its equivalent obscodes {different}'
+
+    def refresh(self,):
+        '''
+        Re-load the config if the file has changed
+        The file is only checked at most once every check_interval seconds,
+        so this is cheap enough to call for every observation / batch
+        '''
+        if time.monotonic() - self.last_check < self.check_interval:
+            return False
+        self.last_check = time.monotonic()
+        if os.path.getmtime(self.filepath) == self.mtime:
+            return False
+        self.reload()
+        return True
+
+    def _compile(self,):
+        '''
+        Compile the config into look-up arrays
+        The arrays are allocated with spare capacity (see _grow), so that
+        codes seen later can be added in place (see get_ObsCodeID)
+        '''
+        n = len(self.ObsCodes)
+        self.capacity = 0
+        self._grow(n)
+
+        arcsecRadius, timeDeltaSeconds, equivalence_class = self.arrays
+        for ObsCode, value in self.config.get('arcsecRadius', {}).items():
+            arcsecRadius[self.ObsCodeIDs[ObsCode]] = value
+        for ObsCode, value in self.config.get('timeDeltaSeconds', {}).items():
+            timeDeltaSeconds[self.ObsCodeIDs[ObsCode]] = value
+
+        # By default an ObsCode is in a class of its own (see _grow)
+        # - Equivalent codes have their classes merged, & each class is labelled by its lowest ObsCodeID
+        for ObsCode, ObsCodeList in self.config.get('equivalentObsCodes', {}).items():
+            merged = np.unique(equivalence_class[[self.ObsCodeIDs[c] for c in [ObsCode] + ObsCodeList]])
+            equivalence_class[:n][np.isin(equivalence_class[:n], merged)] = merged[0]
+
+        return self._compiled(n)
+
+    def _grow(self, n):
+        '''
+        Re-allocate the look-up arrays with (at least) the capacity for n codes
+        (at least doubling it), & with the default values for any new codes
+        '''
+        capacity, defaults = max(n, 2*self.capacity), self.config['defaults']
+        arrays = ( np.full(capacity, float(defaults['arcsecRadius'])),
+                   np.full(capacity, float(defaults['timeDeltaSeconds'])),
+                   np.arange(capacity, dtype=np.int32) )
+        if self.capacity:
+            for new, old in zip(arrays, self.arrays):
+                new[:self.capacity] = old
+        self.arrays, self.capacity = arrays, capacity
+
+    def _compiled(self, n):
+        ''' The look-up arrays for the first n codes '''
+        arcsecRadius, timeDeltaSeconds, equivalence_class = self.arrays
+        return compiled_obscodes(arcsecRadius[:n], timeDeltaSeconds[:n], equivalence_class[:n])
+
+    # -------------------------------------------------------------
+    # ObsCode <-> ObsCodeID
+    # -------------------------------------------------------------
+    def _assign_ObsCodeID(self, ObsCode):
+        if ObsCode not in self.ObsCodeIDs:
+            self.ObsCodeIDs[ObsCode] = len(self.ObsCodes)
+            self.ObsCodes.append(ObsCode)
+        return self.ObsCodeIDs[ObsCode]
+
+    def get_ObsCodeID(self, ObsCode):
+        '''
+        Integer ID for ObsCode
+        Previously unseen (i.e. unconfigured) codes get a new ID & default values
+        (only equivalent to themselves): the look-up arrays have spare capacity
+        for them, so this is (amortized) O(1), rather than a copy of the arrays
+        '''
+        if ObsCode not in self.ObsCodeIDs:
+            n = self._assign_ObsCodeID(ObsCode) + 1
+            if n > self.capacity:
+                self._grow(n)
+            self.compiled = self._compiled(n)
+        return self.ObsCodeIDs[ObsCode]
+
+    # -------------------------------------------------------------
+    # Look-ups (all accept scalar or array ObsCodeIDs)
+    # -------------------------------------------------------------
+    def arcsecRadius(self, ObsCodeID):
+        return self.compiled.arcsecRadius[ObsCodeID]
+
+    def timeDeltaSeconds(self, ObsCodeID):
+        return self.compiled.timeDeltaSeconds[ObsCodeID]
+
+    def equivalent(self, ObsCodeID_a, ObsCodeID_b):
+        ''' ObsCode b is an allowed equivalent of ObsCode a (see equivalence_class) '''
+        equivalence_class = self.compiled.equivalence_class
+        return equivalence_class[ObsCodeID_a] == equivalence_class[ObsCodeID_b]
+
+    def equivalent_ObsCodes(self, ObsCode):
+        ''' List of the ObsCodes that are allowed equivalents of ObsCode '''
+        ObsCodeID = self.get_ObsCodeID(ObsCode)
+        return [self.ObsCodes[i] for i in np.flatnonzero(self.compiled.equivalence_class == self.compiled.equivalence_class[ObsCodeID])]
+
+
+# The table used by default (e.g. by Obs & the ObsStore)
+OBSCODES = ObsCodeTable()
@@ -0,0 +1,190 @@
+'''
+The class in "predictions" caches the predicted sky positions of
+the designated objects, so that a new tracklet can be matched
+against the known objects (checkID-style) with a single look-up,
+rather than by looping over every designated object
+
+For this developmental code, the prediction for an object comes from
+the great-circle motion of its latest designated tracklet (see
+motion.fit_motion), extrapolated to each night within PREDICTION_DAYS
+of the tracklet (a real orbit would obviously do far better)
+
+Each prediction is stored against every (night, healpix) that its
+uncertainty region touches, so a look-up is just the (night, healpix)
+of the new tracklet, followed by an exact check of the few candidates
+
+'''
+
+# -------------------------------------------------------------
+# Third Party Imports
+# -------------------------------------------------------------
+import sys
+import numpy as np
+import healpy as hp
+
+# -------------------------------------------------------------
+# Local Imports
+# -------------------------------------------------------------
+from motion import extrapolate, sizeof_summary
+
+
+# Parameters of the PredictionCache
+PREDICTION_DAYS         = 15.   # Nights predicted (either side of the latest designated tracklet) [days]
+LINK_RADIUS_DEG         = 0.05  # Allowed separation between predicted & actual positions at dt = 0 [deg]
+RATE_ERROR_DEG_PER_DAY  = 0.05  # ... & the growth of that allowance with |dt| [deg/day]
+SIDE_HP                 = 64    # Side of the (nested) healpix used for the buckets (~0.9 deg)
+PIXEL_BITS              = 16    # Bits of a bucket key that hold the healpix (12*SIDE_HP**2 < 2**PIXEL_BITS)
+PENDING_SIZE            = 4096  # Number of bucket keys held (& searched by brute-force) before a merge
+
+
+def night(MJD):
+    ''' Night (bucket) of an MJD: the integer part (i.e. the UT date) '''
+    return int(np.floor(MJD))
+
+def bucket_key(night, pixel):
+    ''' (night, healpix) bucket(s) as int64 key(s) '''
+    return (np.asarray(night, dtype=np.int64) << PIXEL_BITS) | pixel
+
+
+# -------------------------------------------------------------
+# Cache of predicted positions for designated objects
+# -------------------------------------------------------------
+class PredictionCache():
+    '''
+    Predicted positions of the designated objects, bucketed by (night, healpix)
+
+    There is one prediction per object (i.e. per designation), made from its
+    latest designated tracklet (the one with the latest mean epoch). Other
+    tracklets of the object are not held: if the latest is removed from
+    DESIGNATED, the object has no prediction until another tracklet is added
+
+    The buckets are int64 keys (see bucket_key) in a sorted array, alongside
+    the slot of the object & the version of its prediction. New keys go into
+    a small buffer (searched by brute-force) that is merged into the sorted
+    arrays when it is full. Replacing or removing a prediction just bumps the
+    version of the object, so its old keys are ignored (& dropped at the next merge)
+    '''
+    def __init__(self,):
+        self.slots          = {}                                # designation -> slot
+        self.designations   = []                                # slot -> designation
+        self.sources        = []                                # slot -> (TrackletID, motion_summary) of the latest tracklet (or None)
+        self.source_of      = {}                                # TrackletID -> slot (for the latest tracklets)
+        self.versions       = np.zeros(16, dtype=np.int32)      # slot -> version of its prediction
+        self.keys           = np.empty(0, dtype=np.int64)       # sorted bucket keys ...
+        self.key_slots      = np.empty(0, dtype=np.int32)       # ... & the slot ...
+        self.key_versions   = np.empty(0, dtype=np.int32)       # ... & version of the prediction that each belongs to
+        self.pending        = np.empty((PENDING_SIZE, 3), dtype=np.int64)   # (key, slot, version) of the keys since the last merge
+        self.n_pending      = 0
+
+    def __contains__(self, designation):
+        return designation in self.slots and self.sources[self.slots[designation]] is not None
+
+    def __len__(self,):
+        return len(self.source_of)
+
+    def add(self, designation, TrackletID, summary):
+        ''' Add a designated tracklet: it replaces the prediction for its object if it is the latest '''
+        self.remove(TrackletID)
+        slot = self.slots.get(designation)
+        if slot is None:
+            slot = self._new_slot(designation)
+        source = self.sources[slot]
+        if source is not None:
+            if source[1].MJD >= summary.MJD:
+                return
+            del self.source_of[source[0]]
+        self.sources[slot], self.source_of[TrackletID] = (TrackletID, summary), slot
+        self.versions[slot] += 1
+        self._insert(self._keys(summary), slot)
+
+    def add_many(self, designations, TrackletIDs, summaries):
+        ''' Add many designated tracklets (only making the prediction from the latest of each object) '''
+        latest = {}
+        for designation, TrackletID, summary in zip(designations, TrackletIDs, summaries):
+            if designation not in latest or summary.MJD > latest[designation][1].MJD:
+                latest[designation] = (TrackletID, summary)
+        for designation, (TrackletID, summary) in latest.items():
+            self.add(designation, TrackletID, summary)
+
+    def remove(self, TrackletID):
+        ''' Remove the prediction made from a tracklet (if it is the latest of its object) '''
+        slot = self.source_of.pop(TrackletID, None)
+        if slot is not None:
+            self.sources[slot] = None
+            self.versions[slot] += 1
+
+    def _new_slot(self, designation):
+        slot = self.slots[designation] = len(self.designations)
+        self.designations.append(designation)
+        self.sources.append(None)
+        if slot == len(self.versions):
+            self.versions = np.concatenate([self.versions, np.zeros(slot, dtype=np.int32)])
+        return slot
+
+    def _keys(self, summary):
+        ''' Bucket keys of the region that the object could be in during each night within PREDICTION_DAYS '''
+        # Predicted position at the middle of each night ...
+        nights  = np.arange(night(summary.MJD - PREDICTION_DAYS), night(summary.MJD + PREDICTION_DAYS) + 1)
+        dt      = nights + 0.5 - summary.MJD
+        pos     = extrapolate(np.tile(summary.UnitVector, (len(nights), 1)), np.tile(summary.Velocity, (len(nights), 1)), dt)
+
+        # ... & the region that the object could be in at any time during the night
+        radius  = np.radians(LINK_RADIUS_DEG + RATE_ERROR_DEG_PER_DAY*(np.abs(dt) + 0.5) + summary.rate*0.5)
+        pixels  = [hp.query_disc(SIDE_HP, p, r, inclusive=True, nest=True) for p, r in zip(pos, radius.tolist())]
+        return bucket_key(np.repeat(nights, [len(pix) for pix in pixels]), np.concatenate(pixels))
+
+    def _insert(self, keys, slot):
+        ''' Add the keys of the current version of a slot's prediction '''
+        if self.n_pending + len(keys) > PENDING_SIZE:
+            self._merge()
+        if len(keys) > PENDING_SIZE:
+            self._merge(keys, slot)
+            return
+        rows = slice(self.n_pending, self.n_pending + len(keys))
+        self.pending[rows, 0], self.pending[rows, 1], self.pending[rows, 2] = keys, slot, self.versions[slot]
+        self.n_pending += len(keys)
+
+    def _merge(self, keys=None, slot=0):
+        ''' Merge the buffer (& any extra keys of a slot) into the sorted arrays, dropping out-of-date keys '''
+        pending = self.pending[:self.n_pending]
+        extra   = np.empty(0, dtype=np.int64) if keys is None else keys
+        K       = np.concatenate([self.keys, pending[:, 0], extra])
+        S       = np.concatenate([self.key_slots, pending[:, 1].astype(np.int32), np.full(len(extra), slot, dtype=np.int32)])
+        V       = np.concatenate([self.key_versions, pending[:, 2].astype(np.int32), np.full(len(extra), self.versions[slot], dtype=np.int32)])
+        current = np.flatnonzero(V == self.versions[S])
+        order   = current[np.argsort(K[current], kind='stable')]
+        self.keys, self.key_slots, self.key_versions = K[order], S[order], V[order]
+        self.n_pending = 0
+
+    def query(self, summary):
+        '''
+        Designations of the objects whose predicted position at the epoch of the
+        supplied summary is within LINK_RADIUS_DEG + RATE_ERROR_DEG_PER_DAY * |dt|
+        of the summary's position
+
+        returns:
+        --------
+        list of designations (nearest first)
+        '''
+        key     = int(bucket_key(night(summary.MJD), int(hp.vec2pix(SIDE_HP, *summary.UnitVector, nest=True))))
+        lo, hi  = np.searchsorted(self.keys, [key, key + 1])
+        pending = self.pending[:self.n_pending]
+        pending = pending[pending[:, 0] == key]
+        slots   = np.concatenate([self.key_slots[lo:hi][self.key_versions[lo:hi] == self.versions[self.key_slots[lo:hi]]],
+                                  pending[pending[:, 2] == self.versions[pending[:, 1]], 1]]).tolist()
+        if not slots:
+            return []
+        S       = [self.sources[slot][1] for slot in slots]
+        dt      = summary.MJD - np.array([s.MJD for s in S])
+        pos     = extrapolate(np.array([s.UnitVector for s in S]), np.array([s.Velocity for s in S]), dt)
+        sepn    = np.degrees(np.arccos(np.clip(pos @ np.array(summary.UnitVector), -1., 1.)))
+        close   = (np.abs(dt) <= PREDICTION_DAYS + 1.) & (sepn <= LINK_RADIUS_DEG + RATE_ERROR_DEG_PER_DAY*np.abs(dt))
+        return [self.designations[slots[i]] for i in np.flatnonzero(close)[np.argsort(sepn[close], kind='stable')]]
+
+    def nbytes(self,):
+        ''' Approximate memory used by the cache (the bucket keys, & the latest tracklet of each object) '''
+        arrays = self.keys.nbytes + self.key_slots.nbytes + self.key_versions.nbytes + self.pending.nbytes + self.versions.nbytes
+        tables = sum(sys.getsizeof(t) for t in [self.slots, self.designations, self.sources, self.source_of])
+        summaries = sum(sys.getsizeof(s) + sizeof_summary(s[1]) for s in self.sources if s is not None)
+        return arrays + tables + summaries
+
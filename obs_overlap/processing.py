@@ -15,12 +15,19 @@ are basically stub-functions / pseudo-code
 # Third Party Imports
 # -------------------------------------------------------------
 import numpy as np ; np.random.seed(0)
-from collections import namedtuple
+import hashlib
+from collections import namedtuple, OrderedDict, defaultdict
+
+# -------------------------------------------------------------
+# Local Imports
+# -------------------------------------------------------------
+from metrics import METRICS
 
 # -------------------------------------------------------------
 # Some named tuples used within Tracklet class
 # -------------------------------------------------------------
 suggested_itf    = namedtuple('suggested_itf',    ['MULTIPLE','TrackletIDList'])
+suggested_desig  = namedtuple('suggested_desig',  ['VALID','DESIG'])
 
 def attempt_to_link_multiple_overlap(tracklet):
     '''
@@ -40,33 +47,40 @@ def speculative_search(tracklet, db):
     (b) pyTrax-type approaches
      - check ITF tracklets against this tracklet
     
-    For this developmental / psuedo-code, I will just
-    randomly assign a result
+    For this developmental / psuedo-code, the designated objects & ITF tracklets
+    with a consistent motion are found, but then I just randomly assign a result
     '''
     print(" *** speculative_search *** ")
-    # (1) Ignore the possibility of checkID matches
-    #    => Don't bother populating "suggested_desig"
-    
-    # (2) Pretend that pyTrax has run, and assign
-    # a random chance of success, and then subsequently,
-    # randomly assign an ITF tracklet
-    result_dict = { 'PASSED':  True if np.random.random() > 0.95 and list(db.ITF.keys()) else False }
+    summary = tracklet.motion_summary()
+
+    # (1) checkID: look up the designated objects that are predicted to be
+    # near this tracklet (see predictions.PredictionCache)
+    # - If there are any, suggest the nearest & let the orbit-fit decide
+    # - Only done once per tracklet: if the fit fails, we come back here
+    #   (with the suggestion marked invalid) & go on to the ITF search
+    if tracklet.checkID_desigs is None:
+        tracklet.checkID_desigs = db.DESIGNATED_PREDICTIONS.query(summary)
+        if tracklet.checkID_desigs:
+            tracklet.suggested_desig = suggested_desig(True, tracklet.checkID_desigs[0])
+            return { 'PASSED': True }
+
+    # (2) Find the ITF tracklets whose motion, extrapolated to the epoch of this
+    # tracklet, brings them close to it (see motion.MotionIndex)
+    # - Only these few candidates would need a full pyTrax-type check
+    candidates = db.ITF_MOTION.query(summary, exclude={tracklet.TrackletID})
 
-    # (3) Populate other necessary quantities ...
+    # (3) Pretend that pyTrax has run on the candidates, and assign
+    # a random chance of success
+    result_dict = { 'PASSED':  True if np.random.random() > 0.95 and candidates else False }
+
+    # (4) Populate other necessary quantities ...
     if result_dict['PASSED'] :
     
-        # Instead of finding an ITF tracklet with a consistent motion,
+        # Instead of checking the candidates' motion in detail,
         # just randomly choose one for the sake of development
-        randomObsID = np.random.choice( list(db.ITF.keys()) )
-        print('randomObsID=',randomObsID)
-
-        # Find the TrackletID of that selected observation
-        for b in db.BATCHES.values():
-            for t in b.tracklets.values():
-                for o in t.observations.values():
-                    if o.ObsID == randomObsID:
-                        TrackletID = o.TrackletID
-                        break
+        TrackletID = int(np.random.choice(candidates))
+        if METRICS.enabled:
+            METRICS.count('speculative_search.itf_link')
         
         # Populating the suggested_itf namedtuple with a single TrackletID
         tracklet.suggested_itf = suggested_itf(False, [TrackletID])
@@ -92,6 +106,8 @@ def comprehensive_check_and_orbitfit(tracklet):
     randomly assign a result (skewed towards assuming the
     fit worked)
     
+    tracklet : Tracklet, or orbitfit_request (e.g. when run by an OrbitFitter)
+    
     '''
     # (0) Set default quantities in results_dict ...
     result_dict = { 'PASSED' : False ,
@@ -105,22 +121,206 @@ def comprehensive_check_and_orbitfit(tracklet):
     if result_dict['PASSED'] :
     
         # (2a) Get the deignation out of the supplied structures
-        if tracklet.suggested_desig.DESIG is not None :
-            result_dict['designation'] = tracklet.suggested_desig.DESIG
-        elif tracklet.overlap_desig is not None :
-            result_dict['designation'] = tracklet.overlap_desig.DESIGLIST[0]
-        else:
-            # might only have suggest itf ...
-            pass
+        # - might only have suggest itf ...
+        #   => a new object, which would be given a new designation
+        result_dict['designation'] = fit_designation(tracklet)
+        if result_dict['designation'] is None :
+            result_dict['designation'] = new_designation(tracklet)
         
         # (2b) Get the ITF tracklet IDs out of the supplied structures
         # NB
         #   If this were a real fit, the tracklet ideas would not be simply
         #   "passed-through", but instead, only a subset of trackletIDs
         #   would be selected *if* they fitted the orbit 
-        if tracklet.overlap_itf is not None :
-            result_dict['other_TrackletIDs'].extend( tracklet.overlap_itf.TrackletIDList )
-        if tracklet.suggested_itf is not None :
-            result_dict['other_TrackletIDs'].extend( tracklet.suggested_itf.TrackletIDList )
+        result_dict['other_TrackletIDs'].extend( fit_other_TrackletIDs(tracklet) )
 
     return result_dict
+
+def fit_designation(tracklet):
+    ''' The designated object (if any) whose observations are fitted together with the tracklet '''
+    if tracklet.suggested_desig.VALID and tracklet.suggested_desig.DESIG is not None :
+        return tracklet.suggested_desig.DESIG
+    elif tracklet.overlap_desig is not None :
+        return tracklet.overlap_desig.DESIGLIST[0]
+    return None
+
+def new_designation(tracklet):
+    '''
+    Stand-in for the designation that a new object would be given
+    (issuing designations is not part of this code)
+
+    DESIGNATED observations must carry a designation: the overlap of later
+    tracklets is categorized by it (see ObsGroup.categorize_similarity_group_wrt_new_observation),
+    & the fits / predictions of the object are keyed by it
+    This one is unique & reproducible (it is made from the TrackletID)
+    '''
+    return f'NEW{tracklet.TrackletID:07d}'
+
+def fit_other_TrackletIDs(tracklet):
+    ''' The (ITF) tracklets that are fitted together with the tracklet '''
+    TrackletIDs = []
+    if tracklet.overlap_itf is not None :
+        TrackletIDs.extend( tracklet.overlap_itf.TrackletIDList )
+    if tracklet.suggested_itf is not None :
+        TrackletIDs.extend( tracklet.suggested_itf.TrackletIDList )
+    return TrackletIDs
+
+
+# -------------------------------------------------------------
+# Cache of orbit-fit results
+# -------------------------------------------------------------
+
+# Number of results held by a FitCache
+FIT_CACHE_SIZE = 4096
+
+class FitCache():
+    '''
+    Results of comprehensive_check_and_orbitfit, keyed by what goes into the fit,
+    so that the same set of observations is not fitted again: e.g. when a
+    tracklet comes back around to the same designation (after its suggested
+    designation is reset), or when a tracklet is resubmitted
+
+    The key is a hash of the canonical (sorted) form of
+     - the designation being fitted (see fit_designation),
+       or the tracklet itself if it would be a new object,
+     - the other tracklets being fitted (see fit_other_TrackletIDs), &
+     - the selected observations: the (current) primary observations of the
+       similarity groups of all of the observations in those tracklets
+
+    Entries are evicted least-recently-used beyond maxsize, & are invalidated
+     - when any of their primary observations is replaced (see ObsGroup.get_SimilarityGroupID)
+     - when the observations of their designation change (see Tracklet.assign_to_DESIGNATED etc)
+       N.B. A successful fit is then stored again (see Tracklet.tracklet_processing_C____),
+       as the designation has only gained the observations that were fitted
+
+    A key is registered when it is looked-up, so that a fit which is still running
+    (see OrbitFitter) is only stored if nothing has invalidated it in the meantime
+    '''
+    def __init__(self, maxsize=FIT_CACHE_SIZE):
+        self.maxsize        = maxsize
+        self.entries        = OrderedDict()     # key -> [result_dict (or None while pending), primary ObsIDs, designation]
+        self.ObsID_keys     = defaultdict(set)  # primary ObsID -> keys
+        self.desig_keys     = defaultdict(set)  # designation -> keys
+
+    def __len__(self,):
+        return len(self.entries)
+
+    def lookup(self, tracklet, db):
+        '''
+        returns:
+        --------
+        key, result_dict (None if the fit has to be done: then store the result against the key)
+        '''
+        designation = fit_designation(tracklet)
+        TrackletIDs = sorted(set(fit_other_TrackletIDs(tracklet)))
+        groups      = {obs.SimilarityGroupID for t in [tracklet] + [db.TRACKLETS[_] for _ in TrackletIDs] for obs in t.observations.values()}
+        ObsIDs      = np.unique(np.array([ID for ID in (db.GROUPSTATUS[_].primary_ObsID for _ in groups) if ID is not None], dtype=np.int64))
+
+        h = hashlib.blake2b(digest_size=16)
+        h.update(repr((designation, tracklet.TrackletID if designation is None else None, TrackletIDs)).encode())
+        h.update(ObsIDs.tobytes())
+        key = h.digest()
+
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            result_dict = self.entries[key][0]
+            return key, None if result_dict is None else dict(result_dict, other_TrackletIDs=list(result_dict['other_TrackletIDs']))
+
+        self.entries[key] = [None, ObsIDs.tolist(), designation]
+        for ObsID in self.entries[key][1]:
+            self.ObsID_keys[ObsID].add(key)
+        self.desig_keys[designation].add(key)
+        while len(self.entries) > self.maxsize:
+            self._remove(next(iter(self.entries)))
+        return key, None
+
+    def store(self, key, result_dict):
+        ''' Store the result of a fit (unless its key has been invalidated / evicted since it was looked-up) '''
+        if key in self.entries:
+            self.entries[key][0] = dict(result_dict, other_TrackletIDs=list(result_dict['other_TrackletIDs']))
+
+    def invalidate(self, ObsIDs=(), designations=()):
+        ''' Remove the results of any fits that selected the (primary) observations / fitted the designations '''
+        keys = set()
+        for ObsID in ObsIDs:
+            keys.update(self.ObsID_keys.get(ObsID, ()))
+        for designation in designations:
+            keys.update(self.desig_keys.get(designation, ()))
+        for key in keys:
+            self._remove(key)
+
+    def _remove(self, key):
+        _, ObsIDs, designation = self.entries.pop(key)
+        for ObsID in ObsIDs:
+            self.ObsID_keys[ObsID].discard(key)
+            if not self.ObsID_keys[ObsID]:
+                del self.ObsID_keys[ObsID]
+        self.desig_keys[designation].discard(key)
+        if not self.desig_keys[designation]:
+            del self.desig_keys[designation]
+
+
+# -------------------------------------------------------------
+# Running the orbit-fits on a pool of workers
+# -------------------------------------------------------------
+
+# Everything that comprehensive_check_and_orbitfit needs to know about a tracklet
+# - Unlike the Tracklet itself (whose observations are views of the db), this can be
+#   sent to a worker process
+orbitfit_request = namedtuple('orbitfit_request', ['TrackletID', 'suggested_desig', 'overlap_desig', 'overlap_itf', 'suggested_itf',
+                                                   'RA', 'Dec', 'MJD', 'ObsCode'])
+
+def make_orbitfit_request(tracklet):
+    observations = list(tracklet.observations.values())
+    return orbitfit_request(tracklet.TrackletID, tracklet.suggested_desig, tracklet.overlap_desig,
+                            tracklet.overlap_itf, tracklet.suggested_itf,
+                            [o.RA for o in observations], [o.Dec for o in observations],
+                            [o.MJD for o in observations], [o.ObsCode for o in observations])
+
+class OrbitFitter():
+    '''
+    Runs the (slow) orbit-fits on a pool of workers, so that the rest of
+    the processing does not have to wait for them
+
+    executor : a concurrent.futures executor (e.g. ThreadPoolExecutor / ProcessPoolExecutor)
+
+    Each fit is submitted together with a callback that carries on with
+    the processing of the tracklet (& so updates the db)
+    The callbacks are always run in the calling (main) thread: either
+     - when process_completed() is called (for any fits that are done), or
+     - when the fit is waited for (wait_for / wait_all)
+    '''
+    def __init__(self, executor):
+        self.executor = executor
+        self.pending  = {}
+
+    def submit(self, tracklet, callback):
+        ''' Submit the fit for a tracklet: callback(orbit_fit_dict) is run once it is done '''
+        future = self.executor.submit(comprehensive_check_and_orbitfit, make_orbitfit_request(tracklet))
+        self.pending[tracklet.TrackletID] = (future, callback)
+        return future
+
+    def process_completed(self,):
+        ''' Run the callbacks for any fits that are done (without waiting for the rest) '''
+        for TrackletID in [TrackletID for TrackletID, (future, _) in self.pending.items() if future.done()]:
+            # N.B. A callback can wait for (& so resume) the others
+            if TrackletID in self.pending:
+                self._resume(TrackletID)
+
+    def wait_for(self, TrackletIDs):
+        '''
+        Wait for the fits (if any) of the supplied tracklets & run their callbacks
+        N.B. A callback can submit a further fit for the same tracklet
+        '''
+        for TrackletID in TrackletIDs:
+            while TrackletID in self.pending:
+                self._resume(TrackletID)
+
+    def wait_all(self,):
+        ''' Wait for all of the fits & run their callbacks '''
+        while self.pending:
+            self._resume(next(iter(self.pending)))
+
+    def _resume(self, TrackletID):
+        future, callback = self.pending.pop(TrackletID)
+        return callback(future.result())
@@ -0,0 +1,192 @@
+'''
+The classes in "spatial" are the interchangeable "spatial engines"
+that supply the near-duplicate shortlist: the ACCEPTED observations
+that could be near (in both position & time) to one-or-more targets
+
+ - HealpixEngine : composite (healpix, time) index (see HealpixTimeIndex)
+ - KDTreeEngine  : KD-trees over the (unit-vector, time) of the observations
+
+Every engine has the same (duck-typed) interface
+ - add(ObsID, UnitVector, Healpix, MJD)
+ - query(UnitVector, Healpix, arcsecRadius, MJD_lo, MJD_hi) -> ObsIDs
+ - nbytes()
+and the shortlist that query returns is a superset: the exact angular,
+time & obscode checks are always applied afterwards (see Obs.upgraded_check_near_dups)
+
+Which is faster depends on the sky-density & the mix of search-radii:
+the engine is chosen when the DB is created (DB(spatial='kdtree'), see SPATIAL_ENGINES)
+
+'''
+
+# -------------------------------------------------------------
+# Third Party Imports
+# -------------------------------------------------------------
+import sys
+from bisect import bisect_left, bisect_right
+from array import array
+import numpy as np
+from scipy.spatial import cKDTree
+
+# -------------------------------------------------------------
+# Local Imports
+# -------------------------------------------------------------
+import near_dups
+
+
+# -------------------------------------------------------------
+# This class acts like a composite (healpix, time) index
+# -------------------------------------------------------------
+class HealpixTimeIndex():
+    '''
+    Composite index on the (Healpix, MJD) columns of the accepted observations
+
+    For each healpix, holds the MJDs (sorted) & the corresponding ObsIDs,
+    so that a single look-up applies both the healpix-neighbourhood and the
+    time-window, and observations from other nights are never returned
+    '''
+    def __init__(self,):
+        self.pixels = {}
+
+    def __len__(self,):
+        return sum(len(ObsIDs) for _, ObsIDs in self.pixels.values())
+
+    def add(self, pixel, MJD, ObsID):
+        ''' Insert an observation, keeping the pixel's entries sorted by MJD '''
+        if pixel not in self.pixels:
+            self.pixels[pixel] = (array('d'), array('q'))
+        MJDs, ObsIDs = self.pixels[pixel]
+        i = bisect_right(MJDs, MJD)
+        MJDs.insert(i, MJD)
+        ObsIDs.insert(i, ObsID)
+
+    def query(self, listHP, MJD_lo=-np.inf, MJD_hi=np.inf):
+        '''
+        ObsIDs in any of the (unique) healpix in listHP with MJD_lo <= MJD <= MJD_hi
+        MJD_lo & MJD_hi can be scalars, or arrays giving a window per pixel
+        '''
+        MJD_lo, MJD_hi = np.broadcast_to(MJD_lo, np.shape(listHP)), np.broadcast_to(MJD_hi, np.shape(listHP))
+        ObsIDs = []
+        for h, lo, hi in zip(listHP, MJD_lo, MJD_hi):
+            if h in self.pixels:
+                MJDs, IDs = self.pixels[h]
+                ObsIDs.extend( IDs[bisect_left(MJDs, lo):bisect_right(MJDs, hi)] )
+        return ObsIDs
+
+    def nbytes(self,):
+        ''' Approximate memory used by the index '''
+        return sys.getsizeof(self.pixels) + sum(sys.getsizeof(v) + sys.getsizeof(v[0]) + sys.getsizeof(v[1]) for v in self.pixels.values())
+
+
+# -------------------------------------------------------------
+# Spatial engines
+# -------------------------------------------------------------
+class HealpixEngine():
+    '''
+    Shortlist from the (healpix, time) index: the observations in the
+    search-region pixels of the targets (see near_dups.search_region),
+    within the time-window of the targets that search each pixel
+    '''
+    def __init__(self, sideHP=32768, nestedHP=True):
+        self.sideHP, self.nestedHP = sideHP, nestedHP
+        self.index = HealpixTimeIndex()
+
+    def __len__(self,):
+        return len(self.index)
+
+    def add(self, ObsID, UnitVector, Healpix, MJD):
+        self.index.add(Healpix, MJD, ObsID)
+
+    def query(self, UnitVector, Healpix, arcsecRadius, MJD_lo, MJD_hi):
+        ''' ObsIDs that could be within arcsecRadius & [MJD_lo, MJD_hi] of any of the targets '''
+        pixels, MJD_lo, MJD_hi = near_dups.search_pixels(Healpix, arcsecRadius, MJD_lo, MJD_hi, sideHP=self.sideHP, nestedHP=self.nestedHP)
+        return self.index.query(pixels, MJD_lo, MJD_hi)
+
+    def nbytes(self,):
+        return self.index.nbytes()
+
+
+# Parameters of the KDTreeEngine
+# - CHORD_PER_DAY : scaling of time (MJD) into the same units as the unit-vectors, chosen so
+#                   that the default time-window (+/-30s) & search-radius (5") are similar in size
+# - BUFFER_SIZE   : number of insertions held (& searched by brute-force) before building a tree
+# - LEAF_SIZE     : leaf-size of the trees
+CHORD_PER_DAY   = 0.07
+BUFFER_SIZE     = 256
+LEAF_SIZE       = 16
+
+class KDTreeEngine():
+    '''
+    Shortlist from KD-trees over (x, y, z, MJD * CHORD_PER_DAY) of the observations
+
+    Each query is a box (the L-infinity ball) around the target that encloses
+    both the chord-length of the search-radius & the (scaled) time-window
+
+    The trees are immutable, so insertions go into a small buffer (searched by
+    brute force) & when that is full it is built into a tree. Trees of similar
+    size are then merged & re-built ("logarithmic method"), so there are only
+    ever O(log N) trees to search, & each observation is re-built O(log N) times
+
+    N.B. The shortlist is everything within the target's own arcsecRadius (& time-window):
+    the (equivalent) obscodes in the config share a search-radius (see ObsCodeTable.check),
+    so the near-duplicates found are the same as those from the HealpixEngine
+    '''
+    def __init__(self, buffer_size=BUFFER_SIZE, leafsize=LEAF_SIZE):
+        self.leafsize   = leafsize
+        self.trees      = []                                    # [(cKDTree, ObsIDs)], largest first
+        self.buffer     = np.empty((buffer_size, 4))            # coordinates of the insertions since the last build
+        self.buffer_IDs = np.empty(buffer_size, dtype=np.int64)
+        self.n_buffer   = 0
+
+    def __len__(self,):
+        return sum(len(ObsIDs) for _, ObsIDs in self.trees) + self.n_buffer
+
+    def add(self, ObsID, UnitVector, Healpix, MJD):
+        self.buffer[self.n_buffer, :3]  = UnitVector
+        self.buffer[self.n_buffer, 3]   = MJD * CHORD_PER_DAY
+        self.buffer_IDs[self.n_buffer]  = ObsID
+        self.n_buffer += 1
+        if self.n_buffer == len(self.buffer):
+            self._build()
+
+    def _build(self,):
+        ''' Build the buffer into a tree, merged with any trees that are no larger '''
+        coords, ObsIDs = self.buffer[:self.n_buffer].copy(), self.buffer_IDs[:self.n_buffer].copy()
+        while self.trees and len(self.trees[-1][1]) <= len(ObsIDs):
+            tree, IDs      = self.trees.pop()
+            coords, ObsIDs = np.concatenate([tree.data, coords]), np.concatenate([IDs, ObsIDs])
+        self.trees.append((cKDTree(coords, leafsize=self.leafsize, balanced_tree=False), ObsIDs))
+        self.n_buffer = 0
+
+    def query(self, UnitVector, Healpix, arcsecRadius, MJD_lo, MJD_hi):
+        ''' ObsIDs that could be within arcsecRadius & [MJD_lo, MJD_hi] of any of the targets '''
+        UnitVector  = np.atleast_2d(UnitVector)
+        MJD_lo, MJD_hi = np.asarray(MJD_lo, dtype=np.float64), np.asarray(MJD_hi, dtype=np.float64)
+        centre      = np.empty((len(UnitVector), 4))
+        centre[:, :3], centre[:, 3] = UnitVector, (MJD_lo + MJD_hi) * (CHORD_PER_DAY/2.)
+        chord       = 2.*np.sin(np.radians((np.asarray(arcsecRadius) + 1e-3)/3600.)/2.)
+        halfwidth   = np.maximum(chord, (MJD_hi - MJD_lo) * (CHORD_PER_DAY/2.)) * np.ones(len(centre))
+
+        found = []
+        for tree, ObsIDs in self.trees:
+            found.extend(ObsIDs[i] for i in tree.query_ball_point(centre, halfwidth, p=np.inf, return_sorted=False))
+        if self.n_buffer:
+            buffer, IDs = self.buffer[:self.n_buffer], self.buffer_IDs[:self.n_buffer]
+            for start in range(0, len(centre), BUFFER_SIZE):
+                near = (np.abs(buffer - centre[start:start+BUFFER_SIZE, None, :]) <= halfwidth[start:start+BUFFER_SIZE, None, None]).all(axis=2)
+                found.append(IDs[near.any(axis=0)])
+        if not found:
+            return []
+        # N.B. Only the shortlists of different targets can overlap
+        ObsIDs = np.concatenate(found)
+        return (np.unique(ObsIDs) if len(centre) > 1 else ObsIDs).tolist()
+
+    def nbytes(self,):
+        ''' Approximate memory used by the trees (data, index & ObsIDs) & the buffer '''
+        return sum(tree.data.nbytes + tree.indices.nbytes + ObsIDs.nbytes for tree, ObsIDs in self.trees) + self.buffer.nbytes + self.buffer_IDs.nbytes
+
+
+# Engines that can be selected for a DB
+SPATIAL_ENGINES = {
+    'healpix'   : HealpixEngine,
+    'kdtree'    : KDTreeEngine,
+}
@@ -0,0 +1,536 @@
+'''
+The SQLiteDB class in "sqlite_db.py" is a version of the DB class
+(see "db.py") that is backed by a local SQLite file
+
+ - The accepted observations, batches, tracklets & similarity-groups are
+   all tables. The destination of each observation (DESIGNATED / ITF /
+   UNSELECTABLE) is a column of the accepted observations
+ - The accepted observations are indexed on (Healpix, MJD) and also
+   have an R*Tree on (unit-vector, MJD) boxes, so the near-duplicate
+   shortlist is a single indexed SQL query
+ - Changes are grouped into transactions (see SQLiteDB.transaction)
+
+The in-memory ObsStore is retained, but only as a cache of the
+observations that are being worked on: observations from earlier
+sessions are loaded from the file as & when they are needed.
+Similarly, recent Batch / Tracklet / ObsGroup objects are held in
+memory, while earlier batches & tracklets are re-loaded from the
+tables on demand.
+Once the cache holds more than cache_rows accepted observations, they are
+evicted when the next transaction is committed (see SQLiteDB.evict), so the
+memory used is bounded, rather than growing with the observations touched.
+
+'''
+
+# -------------------------------------------------------------
+# Third Party Imports
+# -------------------------------------------------------------
+import sqlite3
+from collections import namedtuple
+from itertools import chain
+from contextlib import contextmanager
+import numpy as np
+import healpy as hp
+
+# -------------------------------------------------------------
+# Local Imports
+# -------------------------------------------------------------
+from db import DB, ObsStore, AcceptedTable, ObservationTable, DestinationTable, SimilarityGroups, radec_to_unitvector, memory_totals
+from db import UNSELECTABLE, UNASSIGNED, DESIGNATED, ITF
+from db import BatchID, TrackletID, AcceptedObsID, SimilarityGroupID
+from tracklet import Tracklet
+from obs_group import PrimaryJournal
+from motion import fit_motion, MotionIndex
+from predictions import PredictionCache
+from processing import FitCache
+import near_dups
+
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS batches (
+    BatchID             INTEGER PRIMARY KEY,
+    SubmissionTime      TEXT,
+    ActorID             TEXT,
+    SubmissionMJD       REAL
+);
+CREATE TABLE IF NOT EXISTS tracklets (
+    TrackletID          INTEGER PRIMARY KEY,
+    BatchID             INTEGER
+);
+CREATE TABLE IF NOT EXISTS accepted_obs (
+    ObsID               INTEGER PRIMARY KEY,
+    RA                  REAL,
+    Dec                 REAL,
+    MJD                 REAL,
+    ObsCode             TEXT,
+    Healpix             INTEGER,
+    SimilarityGroupID   INTEGER,
+    BatchID             INTEGER,
+    TrackletID          INTEGER,
+    Replaces            INTEGER,
+    desig               TEXT,
+    Flags               INTEGER,
+    Destination         INTEGER
+);
+CREATE INDEX IF NOT EXISTS accepted_obs_healpix_mjd ON accepted_obs (Healpix, MJD);
+CREATE INDEX IF NOT EXISTS accepted_obs_tracklet    ON accepted_obs (TrackletID);
+CREATE VIRTUAL TABLE IF NOT EXISTS accepted_obs_rtree USING rtree(
+    ObsID, xmin, xmax, ymin, ymax, zmin, zmax, MJDmin, MJDmax
+);
+CREATE TABLE IF NOT EXISTS similarity_groups (
+    SimilarityGroupID   INTEGER PRIMARY KEY,
+    CreditObsID         INTEGER,
+    PrimaryObsID        INTEGER,
+    category            INTEGER,
+    desig               TEXT
+);
+CREATE TABLE IF NOT EXISTS primary_changes (
+    BatchID             INTEGER,
+    SimilarityGroupID   INTEGER,
+    OldPrimaryObsID     INTEGER,
+    NewPrimaryObsID     INTEGER
+);
+'''
+
+# Columns of accepted_obs (in order)
+ACCEPTED_COLUMNS = ['ObsID','RA','Dec','MJD','ObsCode','Healpix','SimilarityGroupID',
+                    'BatchID','TrackletID','Replaces','desig','Flags','Destination']
+
+# Earlier batches are re-loaded as simple records
+batch_record = namedtuple('batch_record', ['BatchID', 'SubmissionMJD', 'ActorID'])
+
+# Max number of parameters per query
+CHUNK = 500
+
+# Max number of accepted observations held by the (cache) ObsStore before they are evicted (see SQLiteDB.evict)
+CACHE_ROWS = 1000000
+
+# Number of observations read from the file at a time when re-building the motion summaries (see SQLiteDB._load_motion)
+MOTION_CHUNK = 100000
+
+
+# -------------------------------------------------------------
+# Dict-like wrappers around tables
+# -------------------------------------------------------------
+class SQLiteDestinationTable(DestinationTable):
+    '''
+    Dict-like view of the observations in one destination: ObsID -> True
+    Iterates over the accepted observations in the file (see DestinationTable)
+    '''
+    def __iter__(self,):
+        self.db.flush()
+        return (ObsID for (ObsID,) in self.db.conn.execute('SELECT ObsID FROM accepted_obs WHERE Destination=?', (self.destination,)).fetchall())
+
+
+class SQLiteBackedDict(dict):
+    '''
+    In-memory dict of objects (batches, tracklets, groups) that writes
+    a row to a table whenever an object is stored, that (optionally)
+    re-loads objects from the table if they are not in memory, and
+    that (optionally) deletes the row when an object is removed
+    '''
+    def __init__(self, save, load=None, delete=None):
+        super().__init__()
+        self.save, self.load, self.delete = save, load, delete
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.save(value)
+
+    def __delitem__(self, key):
+        self.pop(key)
+
+    def pop(self, key, *default):
+        if self.delete is not None:
+            self.delete(key)
+        return super().pop(key, *default)
+
+    def __missing__(self, key):
+        value = None if self.load is None else self.load(key)
+        if value is None:
+            raise KeyError(key)
+        super().__setitem__(key, value)
+        return value
+
+
+class SQLiteAcceptedTable(AcceptedTable):
+    '''
+    Dict-like view of the ACCEPTED observations: ObsID -> Obs
+    Observations that are not yet in the (cache) ObsStore are loaded from the file
+    '''
+    def __init__(self, db):
+        super().__init__(db.OBSSTORE)
+        self.db = db
+
+    def row_of(self, ObsID):
+        rows = self.db.rows_of([ObsID])
+        return rows[0] if rows and self.store.get_flag(rows[0], ObsStore.ACCEPTED) else None
+
+    def __iter__(self,):
+        return (ObsID for (ObsID,) in self.db.conn.execute('SELECT ObsID FROM accepted_obs').fetchall())
+
+    def __len__(self,):
+        return self.db.conn.execute('SELECT COUNT(*) FROM accepted_obs').fetchone()[0]
+
+
+class SQLiteObservationTable(ObservationTable):
+    '''
+    Registry of all observations (see ObservationTable)
+    Iterates over the observations in the (cache) ObsStore & the accepted observations in the file
+    '''
+    def __iter__(self,):
+        cached = set(self.db.OBSSTORE['ObsID'].tolist())
+        stored = (ObsID for (ObsID,) in self.db.conn.execute('SELECT ObsID FROM accepted_obs').fetchall() if ObsID not in cached)
+        return chain(cached, stored)
+
+    def __len__(self,):
+        return sum(1 for _ in self)
+
+
+# -------------------------------------------------------------
+# This class acts like a set of DB tables (in an SQLite file)
+# -------------------------------------------------------------
+class SQLiteDB(DB):
+    '''
+    SQLite-backed version of DB
+
+    shortlist : how the near-duplicate shortlist is queried
+     - 'healpix' : join of the search-region pixels (& time-windows)
+                   against the (Healpix, MJD) index
+     - 'rtree'   : R*Tree query on the (unit-vector, MJD) box enclosing
+                   the search-region, restricted to the search-region pixels
+
+    cache_rows : max number of accepted observations in the (cache) ObsStore: beyond
+                 this, they are evicted when a transaction is committed (see evict)
+    '''
+    def __init__(self, filepath=':memory:', shortlist='healpix', sideHP=32768, nestedHP=True, cache_rows=CACHE_ROWS):
+        super().__init__()
+        assert shortlist in ['healpix', 'rtree'], f'unknown shortlist method: {shortlist}'
+        self.filepath, self.shortlist   = filepath, shortlist
+        self.sideHP, self.nestedHP      = sideHP, nestedHP
+        self.cache_rows                 = cache_rows
+
+        self.conn = sqlite3.connect(filepath)
+        self.conn.executescript(SCHEMA)
+        self.conn.execute('CREATE TEMP TABLE IF NOT EXISTS query_pixels (Healpix INTEGER PRIMARY KEY, MJD_lo REAL, MJD_hi REAL)')
+        self.conn.commit()
+
+        # Don't re-use IDs that are already in the file
+        for generator, table, column in [   (BatchID,           'batches',          'BatchID'),
+                                            (TrackletID,        'tracklets',        'TrackletID'),
+                                            (AcceptedObsID,     'accepted_obs',     'ObsID'),
+                                            (SimilarityGroupID, 'similarity_groups','SimilarityGroupID')]:
+            maxID = self.conn.execute(f'SELECT MAX({column}) FROM {table}').fetchone()[0]
+            if maxID is not None:
+                generator.total = max(generator.total, maxID)
+
+        # Observations: the ObsStore is just a cache of the accepted_obs table
+        # - No in-memory spatial index is needed: see get_rows_near
+        self.OBSSTORE       = ObsStore(ordered=False, track_dirty=True)
+        self.ACCEPTED       = SQLiteAcceptedTable(self)
+        self.OBSERVATIONS   = SQLiteObservationTable(self)
+        self.OBS_TRACKLETS  = SQLiteObservationTable(self, 'TrackletID')
+        self.SPATIAL        = None
+
+        # Other tables
+        self.BATCHES        = SQLiteBackedDict(self._save_batch, self._load_batch)
+        self.TRACKLETS      = SQLiteBackedDict(self._save_tracklet, self._load_tracklet)
+        self.OBSGROUPS      = SQLiteBackedDict(self._save_obsgroup, delete=self._delete_obsgroup)
+        self.SIMILARITYGROUPS = SimilarityGroups(load=self._load_similarity_group_members)
+        self.DESIGNATED     = SQLiteDestinationTable(self, DESIGNATED)
+        self.ITF            = SQLiteDestinationTable(self, ITF)
+        self.UNSELECTABLE   = SQLiteDestinationTable(self, UNSELECTABLE)
+        self.PRIMARY_JOURNAL = PrimaryJournal(save=self._save_primary_change)
+
+        # The number of observations in each destination, the motion index of the
+        # ITF tracklets & the predictions for the designated objects are held in memory: re-build them
+        self._load_summaries()
+
+    # -------------------------------------------------------------
+    # Transactions
+    # -------------------------------------------------------------
+    @contextmanager
+    def transaction(self,):
+        '''
+        Commit all of the changes made within the block (or roll them back on error)
+        N.B. On a roll-back, the in-memory state is re-loaded from the file too (see reload),
+             so the observations of the batch have to be ingested again
+        N.B. The cache may be emptied on commit (see evict), so Obs / Tracklet / ObsGroup
+             objects should not be held from one transaction to the next
+        '''
+        try:
+            yield self
+            self.commit()
+        except BaseException:
+            self.conn.rollback()
+            self.reload()
+            raise
+        self.PRIMARY_JOURNAL.close_batches()
+
+    def commit(self,):
+        self.flush()
+        self.conn.commit()
+        if len(self.OBSSTORE) > self.cache_rows and np.count_nonzero(self.OBSSTORE['Flags'] & ObsStore.ACCEPTED) > self.cache_rows:
+            self.evict()
+
+    def evict(self,):
+        '''
+        Evict the accepted observations from the (cache) ObsStore, along with the
+        in-memory batches, tracklets, groups & similarity-group members that refer
+        to them: all of these are re-loaded from the file as & when they are needed
+        (The group statuses, destination counts, motion index & predictions only
+        hold IDs & are kept)
+
+        Observations that are not yet accepted (e.g. those of batches that have been
+        ingested ahead of their processing) are not in the file: they are moved to the
+        new (cache) ObsStore, & the tracklets (& batches) that hold them are kept, with
+        their observations re-pointed to the new rows
+
+        N.B. Any other Obs (views), Tracklet or ObsGroup objects from before this must not be used afterwards
+
+        returns:
+        --------
+        the number of observations evicted
+        '''
+        self.flush()
+        store   = self.OBSSTORE
+        pending = np.flatnonzero((store['Flags'] & ObsStore.ACCEPTED) == 0)
+
+        # The tracklets of the pending observations (& all of their observations) are kept
+        pending_rows = set(pending.tolist())
+        tracklets    = [t for t in self.TRACKLETS.values() if t._observations is not None and not pending_rows.isdisjoint(obs._row for obs in t._observations.values())]
+        TrackletIDs  = set(t.TrackletID for t in tracklets)
+        batches      = [b for b in self.BATCHES.values() if not TrackletIDs.isdisjoint(getattr(b, 'tracklets', ()))]
+        rows         = np.union1d(pending, [obs._row for t in tracklets for obs in t._observations.values()]).astype(np.int64)
+
+        new_row = np.full(len(store), -1, dtype=np.int64)
+        new_row[rows] = np.arange(len(rows))
+        self._empty_cache(store.copy_rows(rows, ordered=False, track_dirty=True))
+        for t in tracklets:
+            for obs in t._observations.values():
+                obs._store, obs._row = self.OBSSTORE, int(new_row[obs._row])
+            dict.__setitem__(self.TRACKLETS, t.TrackletID, t)
+        for b in batches:
+            dict.__setitem__(self.BATCHES, b.BatchID, b)
+        return len(store) - len(rows)
+
+    def reload(self,):
+        '''
+        Discard the in-memory state & re-build it from the file (e.g. after a roll-back)
+         - the (cache) ObsStore, the batches, tracklets, groups & similarity-group members,
+           the group statuses & the orbit-fits are emptied (& re-loaded / re-built as & when they are needed)
+         - the destination counts, the motion index & the predictions are re-built (see _load_summaries)
+
+        N.B. Any Obs (views), Tracklet or ObsGroup objects from before this must not be used afterwards
+        '''
+        self._empty_cache()
+        self.GROUPSTATUS.clear()
+        self.PRIMARY_JOURNAL    = PrimaryJournal(save=self._save_primary_change)
+        self.FIT_CACHE          = FitCache(self.FIT_CACHE.maxsize)
+        self._load_summaries()
+
+    def _empty_cache(self, store=None):
+        ''' Replace the (cache) ObsStore (by default, with an empty one), & empty the in-memory batches, tracklets, groups & similarity-group members '''
+        self.OBSSTORE = self.ACCEPTED.store = ObsStore(ordered=False, track_dirty=True) if store is None else store
+        for table in [self.BATCHES, self.TRACKLETS, self.OBSGROUPS]:
+            dict.clear(table)
+        self.SIMILARITYGROUPS.parent.clear()
+        self.SIMILARITYGROUPS.members.clear()
+
+    def _load_summaries(self,):
+        ''' (Re-)build the destination counts, the motion index of the ITF tracklets & the predictions for the designated objects '''
+        self.DESTINATIONS.counts = [0] * len(self.DESTINATIONS.counts)
+        for destination, n in self.conn.execute('SELECT Destination, COUNT(*) FROM accepted_obs WHERE Destination != ? GROUP BY Destination', (UNASSIGNED,)):
+            self.DESTINATIONS.counts[destination - UNSELECTABLE] = n
+        self.ITF_MOTION, self.DESIGNATED_PREDICTIONS = MotionIndex(), PredictionCache()
+        for TrackletIDs, _, summaries in self._load_motion(ITF):
+            self.ITF_MOTION.add_many(TrackletIDs, summaries)
+        for TrackletIDs, desigs, summaries in self._load_motion(DESIGNATED):
+            self.DESIGNATED_PREDICTIONS.add_many(desigs, TrackletIDs, summaries)
+
+    def flush(self,):
+        ''' Write any modified (accepted) observations back to the accepted_obs table '''
+        store = self.OBSSTORE
+        rows  = [row for row in store.dirty if store.get_flag(row, ObsStore.ACCEPTED)]
+        store.dirty.clear()
+        records = [dict(zip(ACCEPTED_COLUMNS, self._accepted_record(row))) for row in rows]
+        self.conn.executemany(
+            'UPDATE accepted_obs SET Healpix=?, SimilarityGroupID=?, BatchID=?, TrackletID=?, desig=?, Flags=?, Destination=? WHERE ObsID=?',
+            [ tuple(r[k] for k in ['Healpix','SimilarityGroupID','BatchID','TrackletID','desig','Flags','Destination','ObsID']) for r in records ] )
+
+    # -------------------------------------------------------------
+    # Accepted observations
+    # -------------------------------------------------------------
+    def accept_observation(self, obs):
+        '''
+        Flag an observation as ACCEPTED & insert it into the accepted_obs
+        table (& therefore its indexes)
+        Assumes obs.Healpix has already been set
+        '''
+        self.ACCEPTED.add(obs._row)
+        record = self._accepted_record(obs._row)
+        self.conn.execute(f'INSERT OR REPLACE INTO accepted_obs ({",".join(ACCEPTED_COLUMNS)}) VALUES ({",".join("?"*len(ACCEPTED_COLUMNS))})', record)
+        x, y, z = obs.UnitVector.tolist()
+        self.conn.execute('INSERT OR REPLACE INTO accepted_obs_rtree VALUES (?,?,?,?,?,?,?,?,?)',
+                          (record[0], x, x, y, y, z, z, obs.MJD, obs.MJD))
+
+    def _accepted_record(self, row):
+        ''' Row of the ObsStore as a record for the accepted_obs table '''
+        store, C = self.OBSSTORE, self.OBSSTORE.columns
+        DesigID, Replaces = int(C['DesigID'][row]), int(C['Replaces'][row])
+        return (int(C['ObsID'][row]), float(C['RA'][row]), float(C['Dec'][row]), float(C['MJD'][row]),
+                store.ObsCodes[C['ObsCodeID'][row]], int(C['Healpix'][row]), int(C['SimilarityGroupID'][row]),
+                int(C['BatchID'][row]), int(C['TrackletID'][row]), None if Replaces == -1 else Replaces,
+                None if DesigID == -1 else store.desigs[DesigID], int(C['Flags'][row]), int(C['Destination'][row]))
+
+    def rows_of(self, ObsIDs):
+        '''
+        ObsStore rows for the supplied ObsIDs
+        Any accepted observations that are not yet in the ObsStore are loaded from the file
+        '''
+        store   = self.OBSSTORE
+        rows    = [store.row_of(ObsID) for ObsID in ObsIDs]
+        missing = [int(ObsID) for ObsID, row in zip(ObsIDs, rows) if row is None]
+        for i in range(0, len(missing), CHUNK):
+            chunk = missing[i:i+CHUNK]
+            for r in self.conn.execute(f'SELECT {",".join(ACCEPTED_COLUMNS)} FROM accepted_obs WHERE ObsID IN ({",".join("?"*len(chunk))})', chunk):
+                rec = dict(zip(ACCEPTED_COLUMNS, r))
+                row = store.append(rec['ObsID'], rec['RA'], rec['Dec'], rec['MJD'], rec['ObsCode'], rec['Replaces'], rec['desig'], None)
+                for k in ['Healpix', 'SimilarityGroupID', 'BatchID', 'TrackletID', 'Flags', 'Destination']:
+                    store.columns[k][row] = rec[k]
+        return [row for row in (store.row_of(ObsID) for ObsID in ObsIDs) if row is not None]
+
+    def get_rows_near(self, UnitVector, Healpix, arcsecRadius, MJD_lo, MJD_hi):
+        '''
+        Get the OBSSTORE rows of the ACCEPTED observations that could be within
+        arcsecRadius & the time-window [MJD_lo, MJD_hi] of any of the targets
+        I.e. those in the search-region pixels of the targets (see get_rows_in_healpix)
+        '''
+        return self.get_rows_in_healpix( *near_dups.search_pixels(Healpix, arcsecRadius, MJD_lo, MJD_hi, sideHP=self.sideHP, nestedHP=self.nestedHP) )
+
+    def get_rows_in_healpix(self, listHP, MJD_lo=-np.inf, MJD_hi=np.inf):
+        '''
+        Get the OBSSTORE rows of the ACCEPTED observations that fall in any of the
+        supplied (unique) healpix, optionally restricted to a time-window
+        (either a single window, or one per healpix)
+
+        This is a single (indexed) SQL query: see "shortlist" in the class docstring
+        N.B. For the 'rtree' shortlist, the time-window is the one enclosing all
+        of the per-pixel windows: the near-dup checks will apply the exact windows
+        '''
+        if len(listHP) == 0:
+            return []
+        MJD_lo = np.broadcast_to(MJD_lo, np.shape(listHP)).clip(-1e300, 1e300)
+        MJD_hi = np.broadcast_to(MJD_hi, np.shape(listHP)).clip(-1e300, 1e300)
+        self.conn.execute('DELETE FROM query_pixels')
+        self.conn.executemany('INSERT INTO query_pixels VALUES (?,?,?)',
+                              zip(np.asarray(listHP).tolist(), MJD_lo.tolist(), MJD_hi.tolist()))
+
+        if self.shortlist == 'healpix':
+            cursor = self.conn.execute('''
+                SELECT o.ObsID FROM query_pixels q JOIN accepted_obs o
+                ON o.Healpix = q.Healpix AND o.MJD BETWEEN q.MJD_lo AND q.MJD_hi''')
+        else:
+            # Box enclosing all of the pixels (padded by the max pixel radius)
+            vec     = np.array(hp.pix2vec(self.sideHP, np.asarray(listHP), nest=self.nestedHP)).T.reshape(-1,3)
+            pad     = 2.*np.sin(hp.max_pixrad(self.sideHP)/2.)
+            lo, hi  = (vec.min(axis=0) - pad).tolist(), (vec.max(axis=0) + pad).tolist()
+            cursor  = self.conn.execute('''
+                SELECT o.ObsID FROM accepted_obs_rtree r JOIN accepted_obs o ON o.ObsID = r.ObsID
+                WHERE r.xmax >= ? AND r.xmin <= ? AND r.ymax >= ? AND r.ymin <= ?
+                AND   r.zmax >= ? AND r.zmin <= ? AND r.MJDmax >= ? AND r.MJDmin <= ?
+                AND   o.Healpix IN (SELECT Healpix FROM query_pixels)''',
+                (lo[0], hi[0], lo[1], hi[1], lo[2], hi[2], float(MJD_lo.min()), float(MJD_hi.max())))
+        return self.rows_of([ObsID for (ObsID,) in cursor.fetchall()])
+
+    # -------------------------------------------------------------
+    # Batches, Tracklets & ObsGroups
+    # -------------------------------------------------------------
+    def _save_batch(self, batch):
+        self.conn.execute('INSERT OR REPLACE INTO batches VALUES (?,?,?,?)',
+                          (batch.BatchID, batch.SubmissionTime.isoformat(), batch.ActorID, batch.SubmissionMJD))
+        # The tracklets were stored before they knew their BatchID
+        self.conn.executemany('UPDATE tracklets SET BatchID=? WHERE TrackletID=?',
+                              [(batch.BatchID, TrackletID_) for TrackletID_ in batch.tracklets])
+
+    def _load_batch(self, BatchID):
+        r = self.conn.execute('SELECT BatchID, SubmissionMJD, ActorID FROM batches WHERE BatchID=?', (int(BatchID),)).fetchone()
+        return None if r is None else batch_record(*r)
+
+    def _save_tracklet(self, tracklet):
+        self.conn.execute('INSERT OR REPLACE INTO tracklets VALUES (?,?)',
+                          (tracklet.TrackletID, tracklet.BatchID))
+
+    def _load_tracklet(self, TrackletID_):
+        ''' Re-build an earlier Tracklet from its accepted observations '''
+        r = self.conn.execute('SELECT TrackletID, BatchID FROM tracklets WHERE TrackletID=?', (int(TrackletID_),)).fetchone()
+        if r is None:
+            return None
+        ObsIDs  = [ObsID for (ObsID,) in self.conn.execute('SELECT ObsID FROM accepted_obs WHERE TrackletID=?', (r[0],))]
+        t       = Tracklet.__new__(Tracklet)
+        t.TrackletID, t.BatchID = r
+        t.observations = {self.OBSSTORE.view(row).ObsID : self.OBSSTORE.view(row) for row in self.rows_of(ObsIDs)}
+        t.overlap_category = t.overlap_desig = t.suggested_desig = t.overlap_itf = t.suggested_itf = t.checkID_desigs = None
+        return t
+
+    def _save_obsgroup(self, obsgroup):
+        self.conn.execute('INSERT OR REPLACE INTO similarity_groups VALUES (?,?,?,?,?)',
+                          (int(obsgroup.SimilarityGroupID),
+                           None if obsgroup.credit_ObsID  is None else int(obsgroup.credit_ObsID),
+                           None if obsgroup.primary_ObsID is None else int(obsgroup.primary_ObsID),
+                           obsgroup.category, obsgroup.desig))
+
+    def _delete_obsgroup(self, SimilarityGroupID_):
+        self.conn.execute('DELETE FROM similarity_groups WHERE SimilarityGroupID=?', (int(SimilarityGroupID_),))
+
+    def _save_primary_change(self, BatchID_, SimilarityGroupID_, old, new):
+        self.conn.execute('INSERT INTO primary_changes VALUES (?,?,?,?)',
+                          (int(BatchID_), int(SimilarityGroupID_),
+                           None if old is None else int(old),
+                           None if new is None else int(new)))
+
+    def _load_motion(self, destination, chunk=MOTION_CHUNK):
+        '''
+        Fit the motion of all of the tracklets in a destination, reading the
+        observations from the file ~chunk at a time (& fitting each chunk at once)
+
+        yields:
+        --------
+        lists of TrackletIDs, designations & motion summaries (for the whole tracklets in each chunk)
+        '''
+        cursor  = self.conn.execute('SELECT a.TrackletID, a.desig, a.RA, a.Dec, a.MJD FROM accepted_obs a WHERE a.Destination=? ORDER BY a.TrackletID', (destination,))
+        records = []
+        while True:
+            fetched  = cursor.fetchmany(chunk)
+            records += fetched
+            if not records:
+                return
+            # The last tracklet may continue into the next chunk (unless the rows have run out)
+            end = len(records)
+            if len(fetched) == chunk:
+                while end and records[end-1][0] == records[-1][0]:
+                    end -= 1
+                if not end:
+                    continue
+            TrackletIDs, desigs, RA, Dec, MJD = map(np.array, zip(*records[:end]))
+            starts  = np.flatnonzero(np.r_[True, TrackletIDs[1:] != TrackletIDs[:-1]])
+            yield TrackletIDs[starts].tolist(), desigs[starts].tolist(), fit_motion(radec_to_unitvector(RA.astype(float), Dec.astype(float)), MJD.astype(float), starts)
+            records = records[end:]
+
+    def _load_similarity_group_members(self, SimilarityGroupID_):
+        '''
+        Members of a similarity group from an earlier session
+        N.B. Groups are merged by re-labelling the members of the absorbed
+        groups, so the members are all of the obs that carry the ID
+        '''
+        self.flush()
+        return [ObsID for (ObsID,) in self.conn.execute('SELECT ObsID FROM accepted_obs WHERE SimilarityGroupID=?', (int(SimilarityGroupID_),))]
+
+    def memory_report(self,):
+        '''
+        Approximate memory used by the (cache) ObsStore & the rest of the in-memory structures
+        (as for DB.memory_report), plus the size of the SQLite file (which is not in bytes_total)
+        '''
+        report = self.OBSSTORE.memory_report()
+        report['bytes_sqlite'] = self.conn.execute('PRAGMA page_count').fetchone()[0] * self.conn.execute('PRAGMA page_size').fetchone()[0]
+        return memory_totals(self, report)
@@ -16,13 +16,16 @@ had their "ObsGroup" status calculated / set
 import sys, os
 import numpy as np ; np.random.seed(0)
 from collections import namedtuple
+from array import array
 
 # -------------------------------------------------------------
 # Local Imports
 # -------------------------------------------------------------
-from db import TrackletID
+from db import TrackletID, DESIGNATED, ITF, UNSELECTABLE
 import obs_group
 import processing
+import motion
+from metrics import METRICS
 
 
 # -------------------------------------------------------------
@@ -72,8 +75,39 @@ class Tracklet():
         self.overlap_itf        = None
         self.suggested_itf      = None
 
+        # Designations of known objects predicted to be near this tracklet (see processing.speculative_search)
+        self.checkID_desigs     = None
+
         # Store self in db
         db.TRACKLETS[self.TrackletID] = self
+
+    @property
+    def observations(self,):
+        '''
+        Dictionary of the contained observations: ObsID -> Obs
+         - once processing is complete, re-built from db.ACCEPTED (see release_observations)
+        '''
+        if self._observations is None:
+            return {ObsID : self._accepted[ObsID] for ObsID in self._ObsIDs}
+        return self._observations
+
+    @observations.setter
+    def observations(self, observations):
+        self._observations = observations
+
+    def release_observations(self, db):
+        '''
+        Once processing is complete, only the ObsIDs of the observations are kept
+        N.B. db.TRACKLETS holds every tracklet, so the (views of the)
+             observations would otherwise be kept for every accepted observation
+        '''
+        if self._observations is not None:
+            self._ObsIDs, self._accepted, self._observations = array('q', self._observations), db.ACCEPTED, None
+
+    def nbytes(self,):
+        ''' Approximate memory used by the tracklet '''
+        return sys.getsizeof(self) + sys.getsizeof(self.__dict__) + (sys.getsizeof(self._ObsIDs) if self._observations is None else
+                                                                     sys.getsizeof(self._observations) + sum(map(sys.getsizeof, self._observations.values())))
     
     def do_name_comprehension(self,):
         '''
@@ -91,6 +125,11 @@ class Tracklet():
         self.suggested_desig = suggested_desig( True if desig is not None and desig[:3] == 'K20' else False, desig )
         return self.suggested_desig
         
+    def motion_summary(self,):
+        ''' Great-circle fit to the motion of the tracklet (see motion.fit_motion) '''
+        obs = list(self.observations.values())
+        return motion.fit_motion([o.UnitVector for o in obs], [o.MJD for o in obs])[0]
+
     def consistent_designations(self,):
         '''
         Are the designations in overlap_desig & suggested_desig consistent ?
@@ -98,14 +137,16 @@ class Tracklet():
         return True if not self.overlap_desig.MULTIPLE and self.overlap_desig.DESIGLIST[0] == self.suggested_desig.DESIG else False
                  
 
-    def primary_selected_observations_changed():
+    def primary_selected_observations_changed(self, db):
         '''
         I think I want a function that will say whether the
         addition of the new observations (in this tracklet)
         changed the selection of *any* of the primary observations
 
+        The changes in each batch are journaled by ObsGroup (see obs_group.PrimaryJournal),
+        so this just looks up the groups of the observations: O(tracklet size)
         '''
-        return True if np.any([obs.ObsID == db.GROUPS[obs.SimilarityGroupID].PrimaryObsID for obs in self.observations.values()]) else False
+        return db.PRIMARY_JOURNAL.primary_changed(self.BatchID, [obs.SimilarityGroupID for obs in self.observations.values()])
         
         
     # -------------------------------------------------------------
@@ -113,7 +154,7 @@ class Tracklet():
     # previously submitted tracklets
     # -------------------------------------------------------------
 
-    def tracklet_processing_A____Top_level_process_handler(self,  param_dict , db):
+    def tracklet_processing_A____Top_level_process_handler(self,  param_dict , db, fitter=None):
         '''
         Populate tracklet-variables with hints as to the potential designated
         objects and/or tracklets that might be joined with this new tracklet
@@ -123,6 +164,11 @@ class Tracklet():
         (ii) Suggested designations (e.g. from the submitter)
         
         Then runs the logic to decide how to fit/process tracklet
+        
+        fitter : optional processing.OrbitFitter
+         - If supplied, any orbit-fit is submitted to the fitter's pool of workers,
+           and the processing of this tracklet is completed when the fit is done
+           (see tracklet_processing_C____)
         '''
         
         # (1) Categorize the overlap between the constituent observations and
@@ -131,7 +177,9 @@ class Tracklet():
         # self.overlap_category,
         # self.overlap_desig,
         # self.overlap_itfvariable
-        self.categorize_overlap(db)
+        # - unless already done with the rest of the batch (see set_up_independent_tracklets)
+        if self.overlap_category is None:
+            self.categorize_overlap(db)
         
         # (2) Do some form of name comprehension similar to "processobs"
         # N.B. Irrespective of overlap category ...
@@ -146,10 +194,10 @@ class Tracklet():
         #     Some initial ideas behind this can be found in ...
         #     https://drive.google.com/file/d/1QqseCpV7PedW341iKPiv447uVElefs93/view?usp=sharing
         #
-        return self.tracklet_processing_B____Decide_if_and_how_to_fit(db)
+        return self.tracklet_processing_B____Decide_if_and_how_to_fit(db, fitter)
         
         
-    def tracklet_processing_B____Decide_if_and_how_to_fit(self,db):
+    def tracklet_processing_B____Decide_if_and_how_to_fit(self,db, fitter=None):
         '''
         Torturous logic to decide on what should be done w.r.t.
         orbit-fitting, etc, to allow us to decide what object (if any)
@@ -169,14 +217,9 @@ class Tracklet():
         
         '''
 
-        # Allow the possibility of doing things differently depending on whether or not
-        # we are back-filling from previously-published stuff in the database
-        """
-        if 'MODE' in param_dict and param_dict['MODE'] == 'BACKFILL':
-            pass#print('BACKFILL Mode: Lengthy checks will be SUPPRESSED')
-        else:
-            pass#print('Standard Processing Mode for New Observations')
-        """
+        # N.B. Tracklets that are back-filled from previously-published stuff
+        # do NOT come through here: the whole archive is processed in bulk,
+        # with a reduced set of checks & no orbit-fits (see backfill.py)
 
         # If tracklet is not selectable, assign as such and quit.
         if not self.SELECTABLE:
@@ -203,12 +246,12 @@ class Tracklet():
                         # If only DESIGNATED (D) (i.e. we've seen everything before),
                         if not self.overlap_category.ITF and not self.overlap_category.SINGLE:
                         
-                            # Only bother with refitting if some of the new observations
-                            # have become the primary
-                            if self.primary_selected_observations_changed():
+                            # Only bother with refitting if the primary of any of the
+                            # groups of the new observations has changed
+                            if self.primary_selected_observations_changed(db):
                                 result_dict = {'FINISHED':False } ### Do orbit fit
                             else:
-                                self.assign_to_DESIGNATED(db,designation_dict)
+                                self.assign_to_DESIGNATED(db,self.suggested_desig.DESIG)
                                 result_dict = {'FINISHED':True }
 
                         # If here, then DI or DS => Something new to try with the known designated object
@@ -225,13 +268,13 @@ class Tracklet():
                     #
                     else:
                         self.suggested_desig = suggested_desig(False, self.suggested_desig[1])
-                        return self.tracklet_processing_B____Decide_if_and_how_to_fit(db)
+                        return self.tracklet_processing_B____Decide_if_and_how_to_fit(db, fitter)
 
             # If it overlaps multiple designated objects ,
             # I think we might want to label this tracklet as wrong
             # (but perhaps try "linking"?)
             else:
-                link_dict = processing.attempt_to_link_multiple_overlap()
+                link_dict = processing.attempt_to_link_multiple_overlap(self)
                 if link_dict['PASS']:
                     result_dict = {'FINISHED': False } ### Do orbit fit
                 else:
@@ -250,6 +293,10 @@ class Tracklet():
 
                 # Perform speculative "checkID" & "pyTrax" type searches
                 # - Assume *speculative_search()* updates tracklet attributes
+                # - The searches look at all of the designated objects & ITF tracklets,
+                #   so any (pending) orbit-fits that would change them must be finished first
+                if fitter is not None:
+                    fitter.wait_all()
                 search_dict = processing.speculative_search(self, db)
                 if search_dict['PASSED']:
                     result_dict = {'FINISHED':False } ### Do orbit fit
@@ -281,15 +328,39 @@ class Tracklet():
         if 'FINISHED' in result_dict and result_dict['FINISHED'] :
             self.terminate_processing(db)
             return result_dict
-        else:
-            orbit_fit_dict = processing.comprehensive_check_and_orbitfit(self)
-
 
+        # A fit of exactly the same observations is not repeated (see processing.FitCache)
+        key, orbit_fit_dict = db.FIT_CACHE.lookup(self, db)
+        if METRICS.enabled:
+            METRICS.count('orbitfit.cache.' + ('miss' if orbit_fit_dict is None else 'hit'))
+
+        # The orbit-fit is *much* slower than everything else
+        # - If there is a fitter, the fit is submitted to its pool of workers
+        #   & the processing resumes in *tracklet_processing_C____* when the fit is done
+        # - N.B. Tracklets that need no fit (above) never wait behind the fits
+        if orbit_fit_dict is not None:
+            return self.tracklet_processing_C____Interpret_orbit_fit(db, orbit_fit_dict, fitter)
+        elif fitter is not None:
+            fitter.submit(self, lambda orbit_fit_dict : self.tracklet_processing_C____Interpret_orbit_fit(db, self._cached_fit(db, key, orbit_fit_dict), fitter))
+            result_dict['SUBMITTED'] = True
+            return result_dict
+        else:
+            orbit_fit_dict = self._cached_fit(db, key, processing.comprehensive_check_and_orbitfit(self))
+            return self.tracklet_processing_C____Interpret_orbit_fit(db, orbit_fit_dict)
 
+    def _cached_fit(self, db, key, orbit_fit_dict):
+        ''' Store the result of a fit in the db.FIT_CACHE (& pass it on) '''
+        db.FIT_CACHE.store(key, orbit_fit_dict)
+        return orbit_fit_dict
 
 
+    def tracklet_processing_C____Interpret_orbit_fit(self, db, orbit_fit_dict, fitter=None):
+        '''
+        Interpret results from orbit fit and take appropriate action
 
-        # Interpret results from orbit fit and take appropriate action
+        This function assumes that the function *tracklet_processing_B____* has
+        decided that an orbit-fit was needed, & that the fit has been done
+        '''
         if orbit_fit_dict['PASSED']:
             
             # Promote this new tracklet to designated status
@@ -302,7 +373,20 @@ class Tracklet():
                 t = db.TRACKLETS[other_TrackletID]
                 print('other_TrackletID in orbit_fit_dict', )
                 t.assign_to_DESIGNATED(db, orbit_fit_dict['designation'])
-        
+
+            # ITF tracklets that share a similarity group with any of the above
+            # are (near-)duplicates of them, so they have to follow them into DESIGNATED
+            # - otherwise a group would contain both DESIGNATED & ITF observations, &
+            #   any later observation in it fails the "impossible" check in
+            #   ObsGroup.categorize_similarity_group_wrt_new_observation
+            for t in self.itf_tracklets_sharing_groups(db, [self.TrackletID] + list(orbit_fit_dict['other_TrackletIDs'])):
+                t.assign_to_DESIGNATED(db, orbit_fit_dict['designation'])
+
+            # The designation has only gained the observations that were fitted (or duplicates of them),
+            # so the same fit would give the same result (see processing.FitCache)
+            key, _ = db.FIT_CACHE.lookup(self, db)
+            db.FIT_CACHE.store(key, orbit_fit_dict)
+
 
         else:
             if self.overlap_category.SINGLE and not self.overlap_category.DESIGNATED :
@@ -315,7 +399,7 @@ class Tracklet():
                 # *** *** ***      recursive function call     *** *** ***
                 #
                 self.suggested_desig = suggested_desig(False, self.suggested_desig[1])
-                return self.tracklet_processing_B____Decide_if_and_how_to_fit(db)
+                return self.tracklet_processing_B____Decide_if_and_how_to_fit(db, fitter)
                 
             else:
                 
@@ -352,6 +436,31 @@ class Tracklet():
         result_dict = {'FINISHED':True }
         return result_dict
 
+    def itf_tracklets_sharing_groups(self, db, TrackletIDs):
+        '''
+        The ITF tracklets that share a similarity group with any of the
+        supplied tracklets (or with any of the ITF tracklets so found)
+        These have to be designated along with them (see tracklet_processing_C____),
+        as no similarity group may hold both DESIGNATED & ITF observations
+
+        returns:
+        --------
+        list of Tracklet objects
+        '''
+        found, todo = {}, list(TrackletIDs)
+        seen = set(todo)
+        while todo:
+            groups = set(obs.SimilarityGroupID for obs in db.TRACKLETS[todo.pop()].observations.values())
+            for SimilarityGroupID in groups:
+                rows = np.asarray(db.rows_of(db.SIMILARITYGROUPS.get_members(SimilarityGroupID)), dtype=np.int64)
+                rows = rows[db.OBSSTORE.columns['Destination'][rows] == ITF]
+                for TrackletID in db.OBSSTORE.columns['TrackletID'][rows].tolist():
+                    if TrackletID not in seen:
+                        seen.add(TrackletID)
+                        found[TrackletID] = db.TRACKLETS[TrackletID]
+                        todo.append(TrackletID)
+        return list(found.values())
+
     def assign_to_DESIGNATED(self,db,designation):
         '''
         Tracklet is being assigned to DESIGNATED
@@ -368,14 +477,21 @@ class Tracklet():
         for k,v in self.__dict__.items():
             print('\t'*3, k,v)
             
+        if METRICS.enabled:
+            METRICS.count('destination.DESIGNATED', len(self.observations))
+
+        # It's no longer in the ITF (if it was), & predictions can be made from it
+        db.ITF_MOTION.remove(self.TrackletID)
+        db.DESIGNATED_PREDICTIONS.add(designation, self.TrackletID, self.motion_summary())
+
+        # Any fits of its old & new designations are out-of-date (see processing.FitCache)
+        db.FIT_CACHE.invalidate(designations={designation} | {obs.desig for obs in self.observations.values()} - {None})
+
+        # Put it in the DESIGNATED table (& so take it out of any other)
+        db.DESTINATIONS.assign([obs._row for obs in self.observations.values()], DESIGNATED)
         for ObsID,obs  in self.observations.items():
-            # Put it in the DESIGNATED table
-            db.DESIGNATED[ObsID] = True
             # Make sure it knows its own designation
             self.observations[ObsID].desig = designation
-            # Ensure it's not in the ITF
-            if ObsID in db.ITF:
-                del db.ITF[ObsID]
             
     def assign_to_UNSELECTABLE(self,db):
         '''
@@ -390,14 +506,19 @@ class Tracklet():
         for k,v in self.__dict__.items():
             print('\t'*3, k,v)
             
+        if METRICS.enabled:
+            METRICS.count('destination.UNSELECTABLE', len(self.observations))
+
+        # It's no longer in the ITF or DESIGNATED (if it was)
+        db.ITF_MOTION.remove(self.TrackletID)
+        db.DESIGNATED_PREDICTIONS.remove(self.TrackletID)
+
+        # Any fits of its old designation are out-of-date (see processing.FitCache)
+        db.FIT_CACHE.invalidate(designations={obs.desig for obs in self.observations.values()} - {None})
+
+        # Put it in the UNSELECTABLE table (& so take it out of any other)
+        db.DESTINATIONS.assign([obs._row for obs in self.observations.values()], UNSELECTABLE)
         for ObsID,obs  in self.observations.items():
-            db.UNSELECTABLE[ObsID] = True
-            # Ensure it's not in the ITF
-            if ObsID in db.ITF:
-                del db.ITF[ObsID]
-            # Ensure its not in the DESIGNATED table
-            if ObsID in db.DESIGNATED:
-                del db.DESIGNATED[ObsID]
             # Ensure it's not confused about its own identity
             self.observations[ObsID].desig = None
             
@@ -415,12 +536,19 @@ class Tracklet():
         for k,v in self.__dict__.items():
             print('\t'*3, k,v)
             
+        if METRICS.enabled:
+            METRICS.count('destination.ITF', len(self.observations))
+
+        # Index its motion, for speculative linking (see processing.speculative_search)
+        db.ITF_MOTION.add(self.TrackletID, self.motion_summary())
+        db.DESIGNATED_PREDICTIONS.remove(self.TrackletID)
+
+        # Any fits of its old designation are out-of-date (see processing.FitCache)
+        db.FIT_CACHE.invalidate(designations={obs.desig for obs in self.observations.values()} - {None})
+
+        # Put it in the ITF table (& so take it out of any other)
+        db.DESTINATIONS.assign([obs._row for obs in self.observations.values()], ITF)
         for ObsID,obs  in self.observations.items():
-            # Put it in the ITF table
-            db.ITF[ObsID] = True
-            # Ensure its not in the DESIGNATED table
-            if ObsID in db.DESIGNATED:
-                del db.DESIGNATED[ObsID]
             # Ensure it's not confused about its own identity
             self.observations[ObsID].desig = None
             
@@ -434,15 +562,19 @@ class Tracklet():
         
         For this developmental sketch, perhaps nothing much is needed
         '''
+        # Here I am checking that each observation gets put into one and only one destination "table"
+        # - I.e. it has to be assigned to DESIGNATED, ITF or UNSELECTABLE
+        # - N.B. An observation only has one Destination, so it can't be in more than one
+        assert db.DESTINATIONS.all_assigned([obs._row for obs in self.observations.values()]), \
+            f'Observations of tracklet {self.TrackletID} have not been assigned a destination'
+
         for ObsID,obs  in self.observations.items():
-        
-            # Here I am checking that each observation gets put into one and only one destination "table"
-            # - I.e. it has to be assigned to DESIGNATED, ITF or DELETED
-            #in_destinations = [ObsID in db.ITF[ObsID], ObsID in db.DELETED[ObsID], ObsID in db.DESIGNATED[ObsID] ]
-            #assert len( [ _ for _ in in_destinations if _ ]) == 1 , f'Incorrect number of destination counts : {in_destinations} '
             
             # Here I am adding a flag to signify processing is complete
             self.observations[ObsID].PROCESSING_COMPLETE = True
+
+        # Only the ObsIDs are kept from here on
+        self.release_observations(db)
             
   
             
@@ -463,81 +595,172 @@ class Tracklet():
          - 'ITF' => ll obs overlap with previously submitted obs that are in the ITF
 
         '''
-        # Default values ...
-        SELECTABLE = SINGLE = DESIGNATED = ITF = False
+        categorize_tracklet_overlap(self, db)
 
-        # For each observation, use the *categorize_similarity_group_for_observation* function to
-        # work out if there is some overlap, and if so, what it overlaps with
-        overlaps, desigs, itf_tracklets = [],[],[]
-        for obs in self.observations.values():
-        
-            #print('obs.__dict__', obs.__dict__)
-            #print()
-            #print(obs.SimilarityGroupID)
-            #print()
-            #   print('db.OBSGROUPS', type(db.OBSGROUPS), db.OBSGROUPS.keys())
-        
-            OG = db.OBSGROUPS[obs.SimilarityGroupID]
-            
-            overlaps.append( OG.category )
-            if OG.desig is not None:
-                desigs.append( OG.desig )
-            if OG.TrackletIDs is not None:
-                itf_tracklets.extend( OG.TrackletIDs )
-
-        # Categorization of overlap for entire tracklet
-        # I find this complicated to think about, so I'm going to try and be very clear in the layout of my logic
-        #
-        #
-        # (0) Unselectable Tracklet
-        #  - We are not in the business of subdividing tracklets
-        #  - If any of the component observations are unselectable, then so is the entire tracklet
-        if -1 not in overlaps:
-            SELECTABLE = True
-            
-            # (A) Completely disjoint/all-singles: no overlap with known observations
-            if     set(overlaps) == {0} :
-                SINGLE = True
-            # (B) All observations overlap only with designated objects
-            elif   set(overlaps) == {1} :
-                DESIGNATED = True
-            # (C) Some observations overlap with designated objects AND the rest are SINGLE
-            elif   set(overlaps) == {0,1} :
-                DESIGNATED=SINGLE=True
-            # (D) Some observations overlap with designated objects AND some overlap with ITF tracklets
-            #     Not bothered about whether any are single are not.
-            elif   set(overlaps) == {0,1,2}:
-                DESIGNATED=SINGLE=ITF=True
-            elif   set(overlaps) == {1,2}  :
-                DESIGNATED=ITF=True
-            # (E) Some observations overlap with ITF tracklets AND some are SINGLE
-            elif   set(overlaps) == {0,2} :
-                SINGLE=ITF=True
-            # (F) All observations overlap only with ITF tracklets
-            elif   set(overlaps) == {2} :
-                ITF=True
-            else:
-                assert False, 'Should not see this message: poor categorization'
+        return self.overlap_category, self.overlap_desig, self.overlap_itf
 
-            assert not (SINGLE == DESIGNATED == ITF == False) , 'Nothing was set in categorize_overlap() '
 
-        # Store overall category data
-        self.SELECTABLE   = SELECTABLE
-        self.overlap_category = overlap_category(SINGLE , DESIGNATED , ITF)
-        
-        # Record any overlap with designated objects
-        if DESIGNATED:
-            desigs = list(set([d for d in desigs if d != None]))
-            MULTIPLE = True if len(desigs) > 1 else False
-            self.overlap_desig = overlap_desig(MULTIPLE , desigs)
-            
-        # Record any overlap with ITF tracklets
-        if ITF:
-            itf_tracklets = list(set(itf_tracklets))
-            MULTIPLE = True if len(itf_tracklets) > 1 else False
-            self.overlap_itf = overlap_itf(MULTIPLE , itf_tracklets)
+    
 
-        return self.overlap_category, self.overlap_desig, self.overlap_itf
 
+# -------------------------------------------------------------
+# Categorization of the overlap of tracklets
+# -------------------------------------------------------------
 
-    
+# Bit for each ObsGroup.category (-1, 0, 1, 2) of the observations in a tracklet
+UNSELECTABLE_BIT, SINGLE_BIT, DESIGNATED_BIT, ITF_BIT = 1, 2, 4, 8
+OVERLAP_BITS = np.array([UNSELECTABLE_BIT, SINGLE_BIT, DESIGNATED_BIT, ITF_BIT], dtype=np.int8)
+
+# The overlap_category for each bitmask of the categories present (nothing is set if unselectable)
+OVERLAP_CATEGORIES = [overlap_category(*[not present & UNSELECTABLE_BIT and bool(present & bit) for bit in (SINGLE_BIT, DESIGNATED_BIT, ITF_BIT)])
+                      for present in range(16)]
+
+def categorize_tracklet_overlap(t, db):
+    '''
+    Categorize the overlap of the tracklet (as per Tracklet.categorize_overlap)
+    from the similarity-groups of its observations: sets the SELECTABLE,
+    overlap_category, overlap_desig & overlap_itf of the tracklet
+
+    The group categories of all of the observations are OR-ed together (as bits,
+    see OVERLAP_BITS), & each case is just which categories are present
+     - (0) Unselectable      : if any of the observations are unselectable, so is the entire
+                               tracklet (we are not in the business of subdividing tracklets)
+     - (A) SINGLE            : no overlap with known observations
+     - (B) DESIGNATED        : all observations overlap only with designated objects
+     - (C) DESIGNATED+SINGLE : some overlap with designated objects & the rest are SINGLE
+     - (D) DESIGNATED+ITF    : some overlap with designated objects & some with ITF tracklets (+/- SINGLE)
+     - (E) SINGLE+ITF        : some overlap with ITF tracklets & the rest are SINGLE
+     - (F) ITF               : all observations overlap only with ITF tracklets
+    and the overlapped designations & ITF tracklets are the (sorted) unique values
+
+    N.B. The categories of the groups are those from when the observations were added
+    (see ObsGroup.categorize_similarity_group_wrt_new_observation), so a tracklet must be
+    categorized after its ObsGroups are set-up & before any later observations change them
+     - see categorize_overlaps for the tracklets of a batch that can be done all at once
+    '''
+    present, desigs, itf = 0, [], []
+    for obs in t.observations.values():
+        OG = db.OBSGROUPS[obs.SimilarityGroupID]
+        present |= 1 << (OG.category + 1)
+        if OG.desig is not None:
+            desigs.append(OG.desig)
+        if OG.TrackletIDs is not None:
+            itf.extend(OG.TrackletIDs)
+    _set_overlap(t, present, sorted(set(desigs)) if len(desigs) > 1 else desigs, sorted(set(itf)) if len(itf) > 1 else itf)
+
+def independent_tracklets(b, db, similar):
+    '''
+    The tracklets of the batch whose overlap does not depend on the processing of the
+    other tracklets in the batch, given the similar observations of each of its observations
+    (as from near_dups.find_similar_in_batches)
+     - none of their observations are similar to those of another tracklet in the batch,
+       & none are similar to the members of a group that another tracklet touches
+       [ so no other tracklet can change their groups ]
+     - none of their observations are similar to ITF observations
+       [ which any tracklet can move to DESIGNATED, see Tracklet.tracklet_processing_C____ ]
+
+    The ObsGroups of these can be set-up, & their overlap categorized all at once,
+    before any of the tracklets of the batch are processed (see set_up_independent_tracklets)
+    '''
+    tracklets = list(b.tracklets.values())
+    n_similar = [sum(len(similar[ObsID]) for ObsID in t.observations) for t in tracklets]
+    rows      = np.array([obs._row for t in tracklets for ObsID in t.observations for obs in similar[ObsID]], dtype=np.int64)
+    tracklet  = np.repeat(np.arange(len(tracklets)), n_similar)
+    store     = db.OBSSTORE
+    group     = store['SimilarityGroupID'][rows]
+    grouped   = group >= 0
+
+    # Dependent: similar to an ITF observation, or to an (as yet ungrouped) observation of another tracklet in the batch
+    dependent = np.zeros(len(tracklets), dtype=bool)
+    dependent[tracklet[store['Destination'][rows] == ITF]] = True
+    own       = np.array([t.TrackletID for t in tracklets], dtype=np.int64)[tracklet]
+    dependent[tracklet[~grouped & (store['TrackletID'][rows] != own)]] = True
+
+    # ... or to the members of a group (i.e. of its root) that is touched by another tracklet
+    if grouped.any():
+        roots, root = np.unique(group[grouped], return_inverse=True)
+        roots       = np.array([db.SIMILARITYGROUPS.find(ID) for ID in roots.tolist()])[root.reshape(-1)]
+        pairs       = np.unique(np.stack([roots, tracklet[grouped]]), axis=1)
+        _, first, n = np.unique(pairs[0], return_index=True, return_counts=True)
+        shared      = np.isin(pairs[0], pairs[0][first[n > 1]])
+        dependent[pairs[1][shared]] = True
+    return [t for t, d in zip(tracklets, dependent.tolist()) if not d]
+
+def set_up_independent_tracklets(b, db, similar):
+    '''
+    Set-up the ObsGroups of the independent tracklets of the batch (see independent_tracklets),
+    & categorize their overlap all at once (see categorize_overlaps)
+
+    returns:
+    --------
+    TrackletIDs : set of the TrackletIDs that have been set-up
+     - The ObsGroups of the other tracklets are set-up as each is processed (as usual)
+    '''
+    tracklets = independent_tracklets(b, db, similar)
+    for t in tracklets:
+        for ObsID, obs in t.observations.items():
+            obs_group.ObsGroup(obs, db, similar_obs=similar[ObsID])
+    categorize_overlaps(tracklets, db)
+    return set(t.TrackletID for t in tracklets)
+
+def categorize_overlaps(tracklets, db):
+    '''
+    Categorize the overlap of each of the tracklets, as per categorize_tracklet_overlap,
+    but with reductions over the (columns of the) observations of all of them at once
+
+    N.B. Only for tracklets whose ObsGroups are all set-up, & which no later observations
+    can change (e.g. see independent_tracklets)
+    '''
+    if not tracklets:
+        return
+    n_obs     = np.array([len(t.observations) for t in tracklets])
+    rows      = np.array([obs._row for t in tracklets for obs in t.observations.values()], dtype=np.int64)
+    groups, group = np.unique(db.OBSSTORE['SimilarityGroupID'][rows], return_inverse=True)
+    group     = group.reshape(-1)
+    obsgroups = [db.OBSGROUPS[ID] for ID in groups.tolist()]
+    category  = np.array([OG.category for OG in obsgroups], dtype=np.int8)
+    assert ((category >= -1) & (category <= 2)).all(), 'Should not see this message: poor categorization'
+    present   = np.bitwise_or.reduceat(OVERLAP_BITS[category[group] + 1], np.cumsum(n_obs) - n_obs).tolist()
+
+    # Unique (tracklet, group) pairs, & then the designation / ITF tracklets of each pair's group
+    tracklet, group = np.divmod(np.unique(np.repeat(np.arange(len(tracklets)), n_obs) * len(groups) + group), len(groups))
+    desig_of  = [OG.desig for OG in obsgroups]
+    itf_of    = [OG.TrackletIDs or () for OG in obsgroups]
+    n_itf     = np.array([len(IDs) for IDs in itf_of])
+    with_desig= np.flatnonzero(np.array([desig is not None for desig in desig_of])[group])
+    with_itf  = np.flatnonzero(n_itf[group])
+    desigs    = _unique_per_tracklet(len(tracklets), tracklet[with_desig], [desig_of[g] for g in group[with_desig].tolist()])
+    itf       = _unique_per_tracklet(len(tracklets), np.repeat(tracklet[with_itf], n_itf[group[with_itf]]), [ID for g in group[with_itf].tolist() for ID in itf_of[g]])
+    for args in zip(tracklets, present, desigs, itf):
+        _set_overlap(*args)
+
+def _set_overlap(t, present, desigs, itf):
+    '''
+    Set the SELECTABLE, overlap_category, overlap_desig & overlap_itf of a tracklet from the
+    bitmask of the categories present (see OVERLAP_BITS), & the designations / ITF tracklets overlapped
+    '''
+    assert 0 < present < 16, 'Should not see this message: poor categorization'
+    t.SELECTABLE        = SELECTABLE = not present & UNSELECTABLE_BIT
+    t.overlap_category  = OVERLAP_CATEGORIES[present]
+    if METRICS.enabled:
+        METRICS.count('Tracklet.overlap.' + ('+'.join(k for k, v in t.overlap_category._asdict().items() if v) if SELECTABLE else 'UNSELECTABLE'))
+
+    # Record any overlap with designated objects / ITF tracklets
+    if t.overlap_category.DESIGNATED:
+        t.overlap_desig = overlap_desig(len(desigs) > 1, desigs)
+    if t.overlap_category.ITF:
+        t.overlap_itf   = overlap_itf(len(itf) > 1, itf)
+
+def _unique_per_tracklet(n_tracklets, tracklet, values):
+    '''
+    The unique values (sorted) for each of n_tracklets, given the values & the tracklet of each
+    '''
+    if not len(values):
+        return [[] for _ in range(n_tracklets)]
+
+    # Code the values (e.g. designations), & keep the unique (tracklet, code) pairs
+    uniq, code  = np.unique(np.array(values), return_inverse=True)
+    tracklet, code = np.divmod(np.unique(tracklet * len(uniq) + code.reshape(-1)), len(uniq))
+    bounds      = np.searchsorted(tracklet, np.arange(n_tracklets + 1))
+    uniq        = uniq[code].tolist()
+    return [uniq[a:b] for a, b in zip(bounds[:-1].tolist(), bounds[1:].tolist())]
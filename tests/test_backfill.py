@@ -0,0 +1,82 @@
+
+# -------------------------------------------------------------
+# Third Party Imports
+# -------------------------------------------------------------
+import sys, os, io, contextlib
+
+# -------------------------------------------------------------
+# Local Imports
+# -------------------------------------------------------------
+sys.path.append(os.path.join(
+                    os.path.dirname(
+                        os.path.dirname(
+                            os.path.realpath(__file__))), 'obs_overlap'))
+sys.path.append(os.path.join(
+                    os.path.dirname(
+                        os.path.dirname(
+                            os.path.realpath(__file__))), 'benchmarks'))
+
+from db import DB
+from sqlite_db import SQLiteDB
+from obs_group import ObsGroup
+from tracklet import set_up_independent_tracklets
+import near_dups
+import backfill
+from synthetic import SyntheticSurvey, DEFAULT_CONFIG
+
+
+# Dense sky, plenty of duplicates, remeasurements & deletions
+CONFIG = DEFAULT_CONFIG._replace(n_obs=4000, obs_per_batch=300, n_fields=10,
+                                 p_exact=0.15, p_near=0.2, p_replaces=0.05, p_deleted=0.05, p_extend=0.1, p_desig=0.5)
+
+
+def process(batches, db):
+    ''' process the batches one observation at a time (through ObsGroup & the tracklet-processing) '''
+    for b in batches:
+        with db.transaction():
+            similar = near_dups.find_similar_in_batches([b], db)
+            ahead   = set_up_independent_tracklets(b, db, similar)
+            for t in b.tracklets.values():
+                if t.TrackletID not in ahead:
+                    for ObsID, obs in t.observations.items():
+                        ObsGroup(obs, db, similar_obs=similar[ObsID])
+                t.tracklet_processing_A____Top_level_process_handler({}, db)
+
+def partition(batches, db):
+    ''' the similarity group of each observation, labelled in order of first appearance '''
+    labels = {}
+    return [labels.setdefault(db.SIMILARITYGROUPS.find(obs.SimilarityGroupID), len(labels))
+            for obs in near_dups.batch_observations(batches)]
+
+def test_backfill_same_groups():
+    '''
+    Backfilling the archive gives the same similarity groups as processing it
+    (see backfill module docstring), both into a DB & into a SQLiteDB
+    '''
+    for seed in (1, 2):
+        config = CONFIG._replace(seed=seed)
+        groups = []
+        for mode in ('process', 'backfill', 'backfill_sqlite'):
+            db = SQLiteDB(':memory:') if mode == 'backfill_sqlite' else DB()
+            with contextlib.redirect_stdout(io.StringIO()):
+                batches = list(SyntheticSurvey(config).gen_batches(db))
+                if mode == 'process':
+                    process(batches, db)
+                else:
+                    summary = backfill.backfill(batches, db)
+                    assert summary['n_obs'] == len(near_dups.batch_observations(batches))
+                    assert sum(summary['tracklets'].values()) == sum(len(b.tracklets) for b in batches)
+            groups.append(partition(batches, db))
+        assert groups[0] == groups[1] == groups[2], f'seed={seed}: backfill groups differ from processing'
+
+def test_backfill_empty():
+    ''' an empty archive gives the same summary keys as any other '''
+    summary = backfill.backfill([], DB())
+    assert summary == {'n_obs': 0, 'n_pairs': 0, 'n_groups': 0,
+                       'tracklets': {'DESIGNATED': 0, 'ITF': 0, 'UNSELECTABLE': 0}, 'flagged': {}}
+
+
+if __name__ == '__main__':
+    test_backfill_empty()
+    test_backfill_same_groups()
+    print('ok')
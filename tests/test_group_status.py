@@ -0,0 +1,131 @@
+
+# -------------------------------------------------------------
+# Third Party Imports
+# -------------------------------------------------------------
+import sys, os, io, contextlib
+import numpy as np
+
+# -------------------------------------------------------------
+# Local Imports
+# -------------------------------------------------------------
+sys.path.append(os.path.join(
+                    os.path.dirname(
+                        os.path.dirname(
+                            os.path.realpath(__file__))), 'obs_overlap'))
+sys.path.append(os.path.join(
+                    os.path.dirname(
+                        os.path.dirname(
+                            os.path.realpath(__file__))), 'benchmarks'))
+
+from db import DB
+from sqlite_db import SQLiteDB
+import obs_group
+from obs_group import ObsGroup
+from tracklet import set_up_independent_tracklets
+import near_dups
+import backfill
+from synthetic import SyntheticSurvey, DEFAULT_CONFIG
+
+
+# Dense sky, plenty of duplicates, remeasurements & deletions (=> large groups, with replaced & deleted members)
+CONFIG = DEFAULT_CONFIG._replace(n_obs=3000, obs_per_batch=300, n_fields=10,
+                                 p_exact=0.2, p_near=0.2, p_replaces=0.1, p_deleted=0.05, p_extend=0.15, p_desig=0.5)
+
+
+# -------------------------------------------------------------
+# Deterministic comparison of observations
+# -------------------------------------------------------------
+# N.B. obs_group.compare_obs picks at random, so the incremental & full results
+#      can only be compared with a deterministic stand-in
+def score(obs):
+    return (obs.ObsID * 7919) % 13
+
+def compare_obs(selected_Obs, obs):
+    ''' the lowest score (ties to the one already selected) '''
+    return selected_Obs if score(selected_Obs) <= score(obs) else obs
+
+
+# -------------------------------------------------------------
+# Full re-computation of the status of a group
+# -------------------------------------------------------------
+def full_status(db, members):
+    '''
+    (credit_ObsID, primary_ObsID) of a group, from all of its members (in the order of SimilarityGroups.get_members)
+     - credit  : from the earliest submission (first on ties), ignoring deleted observations
+     - primary : the latest (last on ties) selectable observation from the credit actor,
+                 then compared against each of the selectable observations of the other actors
+    '''
+    MJD     = lambda obs: db.BATCHES[obs.BatchID].SubmissionMJD
+    actor   = lambda obs: db.BATCHES[obs.BatchID].ActorID
+    usable  = [obs for obs in members if obs.Deleted is not True]
+    if not usable:
+        return None, None
+    credit  = usable[int(np.argmin([MJD(obs) for obs in usable]))]
+
+    replaced    = {obs.Replaces for obs in members if obs.Replaces is not None}
+    selectable  = [obs for obs in members if obs.ObsID not in replaced and obs.Deleted is not True]
+    own         = [obs for obs in selectable if actor(obs) == actor(credit)]
+    primary     = own[int(np.argsort([MJD(obs) for obs in own], kind='stable')[-1])] if own else None
+    for a in dict.fromkeys(actor(obs) for obs in members):
+        if a != actor(credit):
+            for obs in selectable:
+                if actor(obs) == a:
+                    primary = obs if primary is None else compare_obs(primary, obs)
+    return credit.ObsID, None if primary is None else primary.ObsID
+
+
+# -------------------------------------------------------------
+# Tests
+# -------------------------------------------------------------
+def process(batches, db, similar=True):
+    ''' process the batches one observation at a time (through ObsGroup & the tracklet-processing) '''
+    for b in batches:
+        with db.transaction():
+            similar_obs = near_dups.find_similar_in_batches([b], db) if similar else None
+            ahead       = set_up_independent_tracklets(b, db, similar_obs) if similar else set()
+            for t in b.tracklets.values():
+                if t.TrackletID not in ahead:
+                    for ObsID, obs in t.observations.items():
+                        ObsGroup(obs, db, similar_obs=None if similar_obs is None else similar_obs[ObsID])
+                t.tracklet_processing_A____Top_level_process_handler({}, db)
+
+def mismatches(db):
+    ''' the groups whose (incrementally maintained) credit & primary differ from a full re-computation '''
+    bad = []
+    for root, members in db.SIMILARITYGROUPS.members.items():
+        OG = db.OBSGROUPS[root]
+        if (OG.credit_ObsID, OG.primary_ObsID) != full_status(db, [db.OBSSTORE.view(row) for row in db.rows_of(members)]):
+            bad.append(root)
+    return bad
+
+def test_group_status_matches_full_recompute():
+    '''
+    The incrementally-maintained status of every group is that of a full re-computation,
+    processing in batches / serially, into a DB / SQLiteDB, with the status table
+    evicting (& so re-building) statuses, & for a backfill
+    '''
+    random_compare_obs, obs_group.compare_obs = obs_group.compare_obs, compare_obs
+    try:
+        for seed in (1, 2):
+            config = CONFIG._replace(seed=seed)
+            for mode in ('batch', 'serial', 'sqlite', 'evicting', 'backfill'):
+                db = SQLiteDB(':memory:') if mode == 'sqlite' else DB()
+                if mode == 'evicting':
+                    db.GROUPSTATUS.size = 20
+                with contextlib.redirect_stdout(io.StringIO()):
+                    batches = list(SyntheticSurvey(config).gen_batches(db))
+                    if mode == 'backfill':
+                        backfill.backfill(batches, db)
+                    else:
+                        process(batches, db, similar=mode != 'serial')
+                assert max(len(members) for members in db.SIMILARITYGROUPS.members.values()) > 2
+                assert not db.PRIMARY_JOURNAL.records and not db.PRIMARY_JOURNAL.changed
+                bad = mismatches(db)
+                assert not bad, f'seed={seed}, mode={mode}: {len(bad)} groups differ from a full re-computation'
+    finally:
+        obs_group.compare_obs = random_compare_obs
+
+
+if __name__ == '__main__':
+    test_group_status_matches_full_recompute()
+    print('ok')
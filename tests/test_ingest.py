@@ -0,0 +1,114 @@
+
+# -------------------------------------------------------------
+# Third Party Imports
+# -------------------------------------------------------------
+import sys, os, io, tempfile
+import numpy as np
+
+# -------------------------------------------------------------
+# Local Imports
+# -------------------------------------------------------------
+sys.path.append(os.path.join(
+                    os.path.dirname(
+                        os.path.dirname(
+                            os.path.realpath(__file__))), 'obs_overlap'))
+
+from db import DB
+import ingest
+
+
+# Three tracklets in 80-column format
+# - K20A00B : packed provisional designation, 2 obs from 568
+# - 00433   : (packed) permanent number, 3 obs from F51
+# - NE00030 : temporary designation, a two-line satellite observation from 250
+OBS80 = '''\
+     K20A00B  C2020 03 20.60574 10 10 10.123+20 20 20.12         20.5 V      568
+     K20A00B  C2020 03 20.62657 10 10 09.871+20 20 31.04         20.6 V      568
+00433         C2020 03 20.40011 04 55 02.11 -03 43 29.3          13.4 V      F51
+00433         C2020 03 20.41052 04 55 02.64 -03 43 25.1          13.4 V      F51
+00433         C2020 03 20.42093 04 55 03.17 -03 43 20.9          13.5 V      F51
+     NE00030  S2000 02 13.24690 01 20 39.41 +04 01 51.5          18.8 R      250
+     NE00030  s2000 02 13.24690 1 - 3377.1121 + 5507.6961 + 1712.0722        250
+'''
+
+# The first four of the same observations in ADES PSV format
+# N.B. Two header blocks, with the fields in different orders
+PSV = '''\
+# version=2017
+# observatory
+! mpcCode 568
+permID |provID     |trkSub  |mode|stn |obsTime                 |ra          |dec         |mag  |band
+       |2020 AB    |        |CCD |568 |2020-03-20T14:32:15.936Z|152.5421792 |+20.3389222 |20.5 |V
+       |2020 AB    |        |CCD |568 |2020-03-20T15:02:15.648Z|152.5411292 |+20.3419556 |20.6 |V
+# observatory
+! mpcCode F51
+trkSub  |stn |obsTime                 |ra          |dec         |permID |mode
+a1234   |F51 |2020-03-20T09:36:09.504Z|73.7587917  |-3.7248056  |433    |CCD
+a1234   |F51 |2020-03-20T09:51:08.928Z|73.7610000  |-3.7236389  |433    |CCD
+'''
+
+
+def test_read_obs80():
+    ''' positions, times, obscodes & designations from 80-column lines (skipping the second lines) '''
+    assert all(len(line) == 80 for line in OBS80.splitlines())
+    chunks = list(ingest.read_obs80(io.StringIO(OBS80)))
+    assert len(chunks) == 1
+    chunk = chunks[0]
+    assert chunk['ObsCode'].tolist() == ['568']*2 + ['F51']*3 + ['250']
+    assert chunk['desig'].tolist()   == ['K20A00B']*2 + ['00433']*3 + [None]
+    assert np.allclose(chunk['MJD'][[0, 2, 5]], [58928.60574, 58928.40011, 51587.24690], rtol=0, atol=1e-9)
+    assert np.allclose(chunk['RA'][[0, 2]],  [15.*(10 + 10/60. + 10.123/3600.), 15.*(4 + 55/60. + 2.11/3600.)], rtol=0, atol=1e-9)
+    assert np.allclose(chunk['Dec'][[0, 2]], [20 + 20/60. + 20.12/3600., -(3 + 43/60. + 29.3/3600.)], rtol=0, atol=1e-9)
+    assert ingest.tracklet_starts(chunk['TrackletKey']).tolist() == [0, 2, 5]
+
+def test_read_ades_psv():
+    ''' the PSV observations match the same 80-column ones, with the tracklets keyed by trkSub (else desig) '''
+    chunks = list(ingest.read_ades_psv(io.StringIO(PSV)))
+    assert len(chunks) == 1
+    chunk, obs80 = chunks[0], next(ingest.read_obs80(io.StringIO(OBS80)))
+    assert chunk['ObsCode'].tolist() == ['568']*2 + ['F51']*2
+    assert chunk['desig'].tolist()   == ['2020 AB']*2 + ['433']*2
+    assert chunk['TrackletKey'].tolist() == ['2020 AB|568']*2 + ['a1234|F51']*2
+    for name, atol in (('MJD', 1e-8), ('RA', 1e-6), ('Dec', 1e-6)):
+        assert np.allclose(chunk[name], obs80[name][:4], rtol=0, atol=atol), name
+
+    # The header of a block carries over the chunk-boundaries
+    for chunksize in range(1, 12):
+        chunks = list(ingest.read_ades_psv(io.StringIO(PSV), chunksize=chunksize))
+        for name in ingest.CHUNK_COLUMNS:
+            assert np.concatenate([c[name] for c in chunks]).tolist() == chunk[name].tolist(), f'chunksize={chunksize}: {name}'
+
+def test_read_submission():
+    ''' the format is detected from the first line '''
+    with tempfile.TemporaryDirectory() as tmp:
+        for text, n in ((OBS80, 6), (PSV, 4)):
+            path = os.path.join(tmp, 'submission.txt')
+            with open(path, 'w') as fh:
+                fh.write(text)
+            assert len(next(ingest.read_submission(path))['MJD']) == n
+
+def test_gen_batches_carries_tracklets():
+    '''
+    tracklets are never split between batches, whatever the chunk-size
+    (e.g. with chunksize=2, the 00433 tracklet spans the 2nd & 3rd chunks)
+    '''
+    for chunksize in range(1, 8):
+        db      = DB()
+        batches = list(ingest.gen_batches(ingest.read_obs80(io.StringIO(OBS80), chunksize=chunksize), db, '2020-04-20T14:32:16.458361', 'A0'))
+        tracklets = [t for b in batches for t in b.tracklets.values()]
+        assert [len(t.observations) for t in tracklets] == [2, 3, 1], f'chunksize={chunksize}'
+        assert [{obs.desig for obs in t.observations.values()} for t in tracklets] == [{'K20A00B'}, {'00433'}, {None}]
+        assert [{obs.ObsCode for obs in t.observations.values()} for t in tracklets] == [{'568'}, {'F51'}, {'250'}]
+        for b in batches:
+            for t in b.tracklets.values():
+                assert t.BatchID == b.BatchID and db.TRACKLETS[t.TrackletID] is t
+                assert all(obs.BatchID == b.BatchID and obs.TrackletID == t.TrackletID for obs in t.observations.values())
+    assert len(list(ingest.gen_batches(ingest.read_obs80(io.StringIO(OBS80), chunksize=2), DB(), '2020-04-20T14:32:16.458361', 'A0'))) == 3
+
+
+if __name__ == '__main__':
+    test_read_obs80()
+    test_read_ades_psv()
+    test_read_submission()
+    test_gen_batches_carries_tracklets()
+    print('ok')
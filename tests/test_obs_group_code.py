@@ -4,6 +4,7 @@
 # -------------------------------------------------------------
 import sys, os
 from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
 
 # -------------------------------------------------------------
 # Local Imports
@@ -17,11 +18,15 @@ print(os.path.join(
             os.path.dirname(
                 os.path.realpath(__file__))), 'obs_overlap'))
                 
-from db import DB
+from db import DB, DESIGNATED, ITF, UNSELECTABLE
+from sqlite_db import SQLiteDB
 from obs import Obs
 import obs_group
+import near_dups
+import processing
 from batch import Batch
 from tracklet import Tracklet
+import tracklet
 
 
 def gen_input_data(db):
@@ -158,53 +163,86 @@ if __name__ == '__main__':
 
     
     # Create a "DB" (just a class)
-    db = DB()
+    # - Or, if run as "python3 test_obs_group_code.py sqlite [rtree]",
+    #   a DB backed by an (in-memory) SQLite file
+    # - Or, if run as "python3 test_obs_group_code.py kdtree",
+    #   with a KD-tree (rather than healpix) spatial engine
+    db = DB(spatial='kdtree' if 'kdtree' in sys.argv[1:] else 'healpix') if 'sqlite' not in sys.argv[1:] else SQLiteDB(':memory:', shortlist='rtree' if 'rtree' in sys.argv[1:] else 'healpix')
+
+    # Optionally find the near-duplicates for each part of the sky in parallel
+    executor = ProcessPoolExecutor() if 'parallel' in sys.argv[1:] else None
+
+    # Optionally run the orbit-fits on a pool of workers
+    fitter = processing.OrbitFitter(ProcessPoolExecutor()) if 'fitpool' in sys.argv[1:] else None
 
     # Iterate through the input data
     # - We'll also print a bunch of data to illustrate progress
     for b in gen_input_data(db):
         print(f'BatchID={b.BatchID}')
 
-        for TrackletID,t in b.tracklets.items():
-            print(f'\t TrackletID={t.TrackletID}')
+        # Process each batch within a single transaction
+        with db.transaction():
+
+            # Find the similar observations for the entire batch at once
+            similar = near_dups.find_similar_in_batches([b], db, executor=executor)
+
+            # The tracklets that no others in the batch can affect are set-up
+            # (& their overlap categorized) all at once
+            ahead = tracklet.set_up_independent_tracklets(b, db, similar)
+
+            for TrackletID,t in b.tracklets.items():
+                print(f'\t TrackletID={t.TrackletID}')
 
-            # Do OBSERVATION-level processing ...
-            # ~~~ I.e. Processing that would be done at the point of ingestion into
-            #          the ACCEPTED OBSERVATION table
-            for ObsID,o in t.observations.items():
-                print(f'\t\t ObsID={o.ObsID}')
+                # Any (pending) orbit-fits for tracklets that these observations overlap must be finished first
+                if fitter is not None:
+                    fitter.wait_for( set(o.TrackletID for ObsID in t.observations for o in similar[ObsID]) )
 
-                # Set-up an ObsGroup : this will assign SimilarityGroupID, etc
-                OG = obs_group.ObsGroup(o,db)
-                print(f'\t\t\t SimilarityGroupID={ OG.SimilarityGroupID }')
-                print(f'\t\t\t ObsIDs of similar_obs={ [ ObsID for ObsID in OG.observations] }')
-                print(f'\t\t\t credit_ObsID={db.OBSGROUPS[OG.SimilarityGroupID].credit_ObsID}')
-                print(f'\t\t\t primary_ObsID={db.OBSGROUPS[OG.SimilarityGroupID].primary_ObsID}')
+                # Do OBSERVATION-level processing ...
+                # ~~~ I.e. Processing that would be done at the point of ingestion into
+                #          the ACCEPTED OBSERVATION table
+                for ObsID,o in t.observations.items():
+                    print(f'\t\t ObsID={o.ObsID}')
 
+                    # Set-up an ObsGroup : this will assign SimilarityGroupID, etc
+                    # (unless already done, above)
+                    OG = obs_group.ObsGroup(o,db, similar_obs=similar[ObsID]) if TrackletID not in ahead else db.OBSGROUPS[o.SimilarityGroupID]
+                    print(f'\t\t\t SimilarityGroupID={ OG.SimilarityGroupID }')
+                    print(f'\t\t\t ObsIDs of similar_obs={ [ ObsID for ObsID in OG.ObsIDs] }')
+                    print(f'\t\t\t credit_ObsID={db.OBSGROUPS[OG.SimilarityGroupID].credit_ObsID}')
+                    print(f'\t\t\t primary_ObsID={db.OBSGROUPS[OG.SimilarityGroupID].primary_ObsID}')
 
 
 
-            # Now do the TRACKLET-level processing
-            # NB This requires that observation-level & observation-group
-            #    quantities have been previously calculated
-            result_dict = t.tracklet_processing_A____Top_level_process_handler( {} , db)
+
+                # Now do the TRACKLET-level processing
+                # NB This requires that observation-level & observation-group
+                #    quantities have been previously calculated
+                result_dict = t.tracklet_processing_A____Top_level_process_handler( {} , db, fitter)
+                if fitter is not None:
+                    fitter.process_completed()
+
+            # Finish the batch
+            if fitter is not None:
+                fitter.wait_all()
             
             
     # By this point, all tracklets have been processed
     # Now summarize the destination "tables"
+    # - Each observation has a single destination & each table keeps count of its observations
     print('\n'*2 , '*** Summary of observation destinations ... *** ')
-    C = Counter()
-    for b in db.BATCHES.values():
-        for t in b.tracklets.values():
-            for o in t.observations.values():
-                C['TOT'] +=1
-                if o.ObsID in db.DESIGNATED:
-                    C['DES'] +=1
-                if o.ObsID in db.ITF:
-                    C['ITF'] +=1
-                if o.ObsID in db.UNSELECTABLE:
-                    C['UNN'] +=1
+    rows = [o._row for b in db.BATCHES.values() for t in b.tracklets.values() for o in t.observations.values()]
+    assert db.DESTINATIONS.all_assigned(rows)
+    C = Counter(TOT=len(rows))
+    tables = {DESIGNATED : ('DES', db.DESIGNATED), ITF : ('ITF', db.ITF), UNSELECTABLE : ('UNN', db.UNSELECTABLE)}
+    for d in dict.fromkeys(db.OBSSTORE.columns['Destination'][rows].tolist()):
+        name, table = tables[d]
+        C[name] = len(table)
 
     for k,v in C.items():
         print(k,v)
     assert C['DES'] + C['ITF'] + C['UNN'] == C['TOT']
+
+    # Memory used by the (columnar) accepted observations table
+    print('\n'*2 , '*** Memory report ... *** ')
+    for k,v in db.memory_report().items():
+        print(k,v)
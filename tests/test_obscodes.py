@@ -0,0 +1,39 @@
+
+# -------------------------------------------------------------
+# Third Party Imports
+# -------------------------------------------------------------
+import sys, os
+
+# -------------------------------------------------------------
+# Local Imports
+# -------------------------------------------------------------
+sys.path.append(os.path.join(
+                    os.path.dirname(
+                        os.path.dirname(
+                            os.path.realpath(__file__))), 'obs_overlap'))
+
+from obscodes import ObsCodeTable
+
+
+def test_equivalence_classes():
+    '''
+    the configured equivalences become classes of co-located obscodes, & any
+    other code (however many are added later) is only equivalent to itself
+    '''
+    table = ObsCodeTable()
+    ID    = table.get_ObsCodeID
+    assert sorted(table.equivalent_ObsCodes('T09')) == sorted(table.equivalent_ObsCodes('568')) == ['568', 'T09', 'T10', 'T12', 'T14']
+    assert table.equivalent(ID('T09'), ID('T10')) and table.equivalent(ID('568'), ID('T14'))
+    assert not table.equivalent(ID('568'), ID('F51'))
+
+    # Enough new codes for the look-up arrays to grow (see ObsCodeTable._grow)
+    new = [ID(f'X{i:02d}') for i in range(2 * table.capacity)]
+    assert table.equivalent(new, new).all()
+    assert not table.equivalent(new[0], new[1:]).any()
+    assert not table.equivalent(ID('568'), new).any()
+    assert table.equivalent_ObsCodes('X00') == ['X00'] and table.equivalent(ID('T09'), ID('T12'))
+
+
+if __name__ == '__main__':
+    test_equivalence_classes()
+    print('ok')
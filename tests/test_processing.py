@@ -0,0 +1,240 @@
+
+# -------------------------------------------------------------
+# Third Party Imports
+# -------------------------------------------------------------
+import sys, os, io, contextlib, time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+# -------------------------------------------------------------
+# Local Imports
+# -------------------------------------------------------------
+sys.path.append(os.path.join(
+                    os.path.dirname(
+                        os.path.dirname(
+                            os.path.realpath(__file__))), 'obs_overlap'))
+sys.path.append(os.path.join(
+                    os.path.dirname(
+                        os.path.dirname(
+                            os.path.realpath(__file__))), 'benchmarks'))
+
+import db as DB_IDs
+from db import DB, DESIGNATED
+import obs_group
+from obs_group import ObsGroup
+import tracklet
+from tracklet import Tracklet
+import near_dups
+import processing
+from obs import Obs
+from batch import Batch
+from metrics import METRICS
+from synthetic import SyntheticSurvey, DEFAULT_CONFIG
+
+random_speculative_search = processing.speculative_search
+
+
+# Dense sky, plenty of duplicates & designations (=> every overlap category)
+CONFIG = DEFAULT_CONFIG._replace(n_obs=4000, obs_per_batch=300, n_fields=10,
+                                 p_exact=0.2, p_near=0.2, p_replaces=0.1, p_deleted=0.05, p_extend=0.15, p_desig=0.5)
+
+
+# -------------------------------------------------------------
+# Deterministic stand-ins
+# -------------------------------------------------------------
+# N.B. obs_group.compare_obs, comprehensive_check_and_orbitfit & speculative_search pick at random, &
+#      the random numbers are drawn in a different order when the fits are run by an OrbitFitter
+#      (e.g. a failed fit goes on to a speculative search in its callback): so the two paths can
+#      only be compared with deterministic stand-ins
+def compare_obs(selected_Obs, obs):
+    return selected_Obs if (selected_Obs.ObsID * 7919) % 13 <= (obs.ObsID * 7919) % 13 else obs
+
+FITTED = []
+
+def orbitfit(tracklet):
+    ''' comprehensive_check_and_orbitfit, passing / failing by TrackletID (& taking a variable time) '''
+    FITTED.append(tracklet.TrackletID)
+    time.sleep(0.001 * ((tracklet.TrackletID * 7919) % 5))
+    result_dict = {'PASSED': (tracklet.TrackletID * 7919) % 7 != 0, 'designation': None, 'other_TrackletIDs': []}
+    if result_dict['PASSED']:
+        result_dict['designation'] = processing.fit_designation(tracklet) or processing.new_designation(tracklet)
+        result_dict['other_TrackletIDs'].extend(processing.fit_other_TrackletIDs(tracklet))
+    return result_dict
+
+SEARCHES = Counter()
+
+def speculative_search(tracklet, db):
+    ''' processing.speculative_search, with the random numbers seeded by TrackletID & attempt '''
+    SEARCHES[tracklet.TrackletID] += 1
+    np.random.seed(1000 * tracklet.TrackletID + SEARCHES[tracklet.TrackletID])
+    return random_speculative_search(tracklet, db)
+
+@contextlib.contextmanager
+def stand_ins():
+    random_compare_obs, obs_group.compare_obs = obs_group.compare_obs, compare_obs
+    random_orbitfit, processing.comprehensive_check_and_orbitfit = processing.comprehensive_check_and_orbitfit, orbitfit
+    processing.speculative_search = speculative_search
+    try:
+        yield
+    finally:
+        obs_group.compare_obs = random_compare_obs
+        processing.comprehensive_check_and_orbitfit = random_orbitfit
+        processing.speculative_search = random_speculative_search
+
+
+# -------------------------------------------------------------
+# Helpers
+# -------------------------------------------------------------
+def no_orbitfit(tracklet):
+    raise AssertionError(f'TrackletID={tracklet.TrackletID} was fitted')
+
+def tracklet_at(db, RA, Dec, desig=None):
+    return Tracklet([Obs(RA + 0.1*i, Dec + 0.1*i, f'2020-03-20T1{4+i}:32:16.458361', '568', None, desig, None, db) for i in range(3)], db)
+
+def group(b, db):
+    ''' set-up the ObsGroups of the observations of a batch '''
+    with contextlib.redirect_stdout(io.StringIO()):
+        similar = near_dups.find_similar_in_batches([b], db)
+        for t in b.tracklets.values():
+            for ObsID, obs in t.observations.items():
+                ObsGroup(obs, db, similar_obs=similar[ObsID])
+
+def fit_ready(t, db):
+    ''' categorize a (grouped) tracklet & read its designation, as tracklet_processing_A____ does ahead of the fit '''
+    t.categorize_overlap(db)
+    t.do_name_comprehension()
+    return t
+
+def process(batches, db, fitter=None):
+    '''
+    process the batches (as in test_obs_group_code), optionally running the fits on the fitter
+
+    returns:
+    --------
+    (ObsID, Destination, desig) of each observation, in order
+    '''
+    with contextlib.redirect_stdout(io.StringIO()):
+        for b in batches:
+            with db.transaction():
+                similar = near_dups.find_similar_in_batches([b], db)
+                ahead   = tracklet.set_up_independent_tracklets(b, db, similar)
+                for t in b.tracklets.values():
+                    if fitter is not None:
+                        fitter.wait_for({o.TrackletID for ObsID in t.observations for o in similar[ObsID]})
+                    if t.TrackletID not in ahead:
+                        for ObsID, obs in t.observations.items():
+                            ObsGroup(obs, db, similar_obs=similar[ObsID])
+                    t.tracklet_processing_A____Top_level_process_handler({}, db, fitter)
+                    if fitter is not None:
+                        fitter.process_completed()
+                if fitter is not None:
+                    fitter.wait_all()
+    return [(obs.ObsID, obs.Destination, obs.desig) for b in batches for t in b.tracklets.values() for obs in t.observations.values()]
+
+
+# -------------------------------------------------------------
+# Tests
+# -------------------------------------------------------------
+def test_fit_cache_hit_skips_fit():
+    ''' a tracklet whose fit is in the FitCache is processed with the cached result (& not fitted) '''
+    db = DB()
+    T  = tracklet_at(db, 20., 30., desig='K20A00B')
+    group(Batch('2020-04-20T14:32:16.458361', 'A0', [T], db), db)
+    fit_ready(T, db)
+
+    key, result_dict = db.FIT_CACHE.lookup(T, db)
+    assert result_dict is None and len(db.FIT_CACHE) == 1
+    db.FIT_CACHE.store(key, {'PASSED': True, 'designation': 'K20A00B', 'other_TrackletIDs': []})
+    assert db.FIT_CACHE.lookup(T, db) == (key, {'PASSED': True, 'designation': 'K20A00B', 'other_TrackletIDs': []})
+
+    orbitfit, processing.comprehensive_check_and_orbitfit = processing.comprehensive_check_and_orbitfit, no_orbitfit
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            T.tracklet_processing_B____Decide_if_and_how_to_fit(db)
+    finally:
+        processing.comprehensive_check_and_orbitfit = orbitfit
+    assert all(obs.Destination == DESIGNATED and obs.desig == 'K20A00B' for obs in T.observations.values())
+
+def test_fit_cache_invalidation():
+    '''
+    the fits are removed from the FitCache when one of their primary observations
+    is replaced, or when the observations of their designation change
+    (& a fit that is still running when it is invalidated is not stored)
+    '''
+    db   = DB()
+    P, Q = tracklet_at(db, 20., 30., desig='K20A00B'), tracklet_at(db, 80., -10., desig='K20A00C')
+    group(Batch('2020-04-20T14:32:16.458361', 'A0', [P, Q], db), db)
+    keys = {}
+    for t in (P, Q):
+        with contextlib.redirect_stdout(io.StringIO()):
+            t.assign_to_DESIGNATED(db, next(iter(t.observations.values())).desig)
+        keys[t], _ = db.FIT_CACHE.lookup(fit_ready(t, db), db)
+        db.FIT_CACHE.store(keys[t], {'PASSED': True, 'designation': t.suggested_desig.DESIG, 'other_TrackletIDs': []})
+    assert len(db.FIT_CACHE) == 2
+
+    # A later resubmission (by the same actor) of one of P's observations becomes the primary of its group
+    primary = db.GROUPSTATUS[next(iter(P.observations.values())).SimilarityGroupID].primary_ObsID
+    first   = next(iter(P.observations.values()))
+    again   = Tracklet([Obs(first.RA, first.Dec, '2020-03-20T14:32:16.458361', '568', None, 'K20A00B', None, db)], db)
+    group(Batch('2020-04-21T14:32:16.458361', 'A0', [again], db), db)
+    assert db.GROUPSTATUS[first.SimilarityGroupID].primary_ObsID not in (None, primary)
+    assert keys[P] not in db.FIT_CACHE.entries and keys[Q] in db.FIT_CACHE.entries
+    assert primary not in db.FIT_CACHE.ObsID_keys and 'K20A00B' not in db.FIT_CACHE.desig_keys
+
+    # Another tracklet is assigned to Q's designation (while its own fit of that designation is running)
+    R = tracklet_at(db, 40., 50., desig='K20A00C')
+    group(Batch('2020-04-22T14:32:16.458361', 'A1', [R], db), db)
+    key, _ = db.FIT_CACHE.lookup(fit_ready(R, db), db)
+    with contextlib.redirect_stdout(io.StringIO()):
+        R.assign_to_DESIGNATED(db, 'K20A00C')
+    assert not db.FIT_CACHE.entries and not db.FIT_CACHE.ObsID_keys and not db.FIT_CACHE.desig_keys
+
+    # So R's fit is not stored (when it is done)
+    db.FIT_CACHE.store(key, {'PASSED': True, 'designation': 'K20A00C', 'other_TrackletIDs': []})
+    assert len(db.FIT_CACHE) == 0
+
+def test_orbit_fitter_matches_synchronous():
+    '''
+    Resuming the processing (in the callbacks) when the fits on a pool of workers are done
+    gives the same destinations & designations as fitting each tracklet in turn
+    N.B. The synchronous processing also serves some fits from the FitCache (& does not fit them)
+    '''
+    state = np.random.get_state()
+    try:
+        with stand_ins():
+            for seed in (1, 2):
+                config = CONFIG._replace(seed=seed)
+                IDs    = {ID : ID.total for ID in DB_IDs.DB_ID.__subclasses__()}
+                runs   = []
+                for fitter in (None, processing.OrbitFitter(ThreadPoolExecutor(4))):
+                    # Same IDs (e.g. in designations) & random numbers (e.g. for the surveys) for each run
+                    for ID, total in IDs.items():
+                        ID.total = total
+                    np.random.seed(0)
+                    del FITTED[:]
+                    SEARCHES.clear()
+                    db = DB()
+                    METRICS.enable(stages={})
+                    try:
+                        runs.append(process(list(SyntheticSurvey(config).gen_batches(db)), db, fitter))
+                        counters = dict(METRICS.counters)
+                    finally:
+                        METRICS.disable()
+                        METRICS.reset()
+                    if fitter is None:
+                        assert counters.get('orbitfit.cache.hit', 0) > 0 and len(FITTED) == counters['orbitfit.cache.miss']
+                    else:
+                        assert not fitter.pending and len(FITTED) > 0
+                        fitter.executor.shutdown()
+                synchronous, pooled = runs
+                assert synchronous == pooled, f'seed={seed}: {sum(a != b for a, b in zip(synchronous, pooled))} observations differ'
+    finally:
+        np.random.set_state(state)
+
+
+if __name__ == '__main__':
+    test_fit_cache_hit_skips_fit()
+    test_fit_cache_invalidation()
+    test_orbit_fitter_matches_synchronous()
+    print('ok')
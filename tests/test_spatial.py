@@ -0,0 +1,81 @@
+
+# -------------------------------------------------------------
+# Third Party Imports
+# -------------------------------------------------------------
+import sys, os, io, contextlib, json, tempfile
+
+# -------------------------------------------------------------
+# Local Imports
+# -------------------------------------------------------------
+sys.path.append(os.path.join(
+                    os.path.dirname(
+                        os.path.dirname(
+                            os.path.realpath(__file__))), 'obs_overlap'))
+sys.path.append(os.path.join(
+                    os.path.dirname(
+                        os.path.dirname(
+                            os.path.realpath(__file__))), 'benchmarks'))
+
+import db as DB_IDs
+from db import DB
+from obscodes import ObsCodeTable, DEFAULT_CONFIG as OBSCODES_CONFIG
+from obs_group import ObsGroup
+from tracklet import set_up_independent_tracklets
+import near_dups
+from synthetic import SyntheticSurvey, DEFAULT_CONFIG
+
+
+# Dense sky, plenty of duplicates (from equivalent obscodes too): enough observations for several KD-trees
+CONFIG = DEFAULT_CONFIG._replace(n_obs=4000, obs_per_batch=200, n_fields=10,
+                                 p_exact=0.2, p_near=0.3, p_replaces=0.05, p_deleted=0.05, p_extend=0.1, seed=1)
+
+
+def similar_pairs(spatial):
+    ''' (ObsID, similar ObsIDs) for every observation of the survey, processed in batches into a DB with the spatial engine '''
+    db, pairs = DB(spatial=spatial), []
+    with contextlib.redirect_stdout(io.StringIO()):
+        for b in SyntheticSurvey(CONFIG).gen_batches(db):
+            with db.transaction():
+                similar = near_dups.find_similar_in_batches([b], db)
+                pairs.extend((ObsID, sorted(obs.ObsID for obs in similar_obs)) for ObsID, similar_obs in similar.items())
+                ahead   = set_up_independent_tracklets(b, db, similar)
+                for t in b.tracklets.values():
+                    if t.TrackletID not in ahead:
+                        for ObsID, obs in t.observations.items():
+                            ObsGroup(obs, db, similar_obs=similar[ObsID])
+                    t.tracklet_processing_A____Top_level_process_handler({}, db)
+    return pairs
+
+def test_engines_same_pairs():
+    ''' the KDTreeEngine & the HealpixEngine find the same near-duplicates '''
+    IDs  = {ID : ID.total for ID in DB_IDs.DB_ID.__subclasses__()}
+    runs = []
+    for spatial in ('healpix', 'kdtree'):
+        # Same ObsIDs for each run
+        for ID, total in IDs.items():
+            ID.total = total
+        runs.append(similar_pairs(spatial))
+    healpix, kdtree = runs
+    assert sum(len(similar) > 1 for _, similar in healpix) > len(healpix) // 10
+    assert healpix == kdtree
+
+def test_equivalent_obscodes_share_radius():
+    ''' a config in which equivalent obscodes have different search-radii is rejected '''
+    with open(OBSCODES_CONFIG) as fh:
+        config = json.load(fh)
+    config['arcsecRadius']['T09'] = 2 * config['defaults']['arcsecRadius']
+    with tempfile.NamedTemporaryFile('w', suffix='.json') as fh:
+        json.dump(config, fh)
+        fh.flush()
+        try:
+            ObsCodeTable(fh.name)
+        except AssertionError as e:
+            assert 'T09' in str(e)
+        else:
+            assert False, 'T09 has a different radius to 568'
+
+
+if __name__ == '__main__':
+    test_engines_same_pairs()
+    test_equivalent_obscodes_share_radius()
+    print('ok')
@@ -0,0 +1,138 @@
+
+# -------------------------------------------------------------
+# Third Party Imports
+# -------------------------------------------------------------
+import sys, os, io, contextlib, tempfile, itertools
+import numpy as np
+
+# -------------------------------------------------------------
+# Local Imports
+# -------------------------------------------------------------
+sys.path.append(os.path.join(
+                    os.path.dirname(
+                        os.path.dirname(
+                            os.path.realpath(__file__))), 'obs_overlap'))
+sys.path.append(os.path.join(
+                    os.path.dirname(
+                        os.path.dirname(
+                            os.path.realpath(__file__))), 'benchmarks'))
+
+import db as DB_IDs
+from db import DESIGNATED, ITF
+from sqlite_db import SQLiteDB
+import obs_group
+from obs_group import ObsGroup
+from tracklet import set_up_independent_tracklets
+import near_dups
+from synthetic import SyntheticSurvey, DEFAULT_CONFIG
+
+
+# Dense sky, plenty of duplicates & designations
+CONFIG = DEFAULT_CONFIG._replace(n_obs=3000, obs_per_batch=300, n_fields=10,
+                                 p_exact=0.2, p_near=0.2, p_replaces=0.1, p_deleted=0.05, p_extend=0.15, p_desig=0.5, seed=1)
+
+
+def process(batches, db):
+    ''' process the batches one observation at a time (through ObsGroup & the tracklet-processing) '''
+    for b in batches:
+        with db.transaction():
+            similar = near_dups.find_similar_in_batches([b], db)
+            ahead   = set_up_independent_tracklets(b, db, similar)
+            for t in b.tracklets.values():
+                if t.TrackletID not in ahead:
+                    for ObsID, obs in t.observations.items():
+                        ObsGroup(obs, db, similar_obs=similar[ObsID])
+                t.tracklet_processing_A____Top_level_process_handler({}, db)
+
+def test_load_motion_in_chunks():
+    '''
+    the motion summaries re-built from the file are the same whatever the size of the
+    chunks read, & re-opening the file re-builds the motion index of the ITF tracklets
+    '''
+    with tempfile.TemporaryDirectory() as tmp:
+        db = SQLiteDB(os.path.join(tmp, 'test.db'))
+        with contextlib.redirect_stdout(io.StringIO()):
+            process(SyntheticSurvey(CONFIG).gen_batches(db), db)
+        for destination in (ITF, DESIGNATED):
+            whole   = list(db._load_motion(destination))
+            chunks  = list(db._load_motion(destination, chunk=7))
+            assert len(whole) == 1 and len(chunks) > 1
+            assert list(whole[0]) == [sum(_, []) for _ in zip(*chunks)]
+            assert len(set(whole[0][0])) == len(whole[0][0]) > 1
+        assert set(SQLiteDB(db.filepath).ITF_MOTION.summaries) == set(db.ITF_MOTION.summaries)
+
+def held(db):
+    ''' the in-memory state that is re-built from the file: destination counts, ITF tracklets & designated objects (& their latest tracklet) '''
+    predictions = db.DESIGNATED_PREDICTIONS
+    return (list(db.DESTINATIONS.counts), sorted(db.ITF_MOTION.summaries),
+            sorted((desig, source[0]) for desig, source in zip(predictions.designations, predictions.sources) if source is not None))
+
+def test_rollback_reloads():
+    '''
+    after an error part-way through a batch, the in-memory state is that of the
+    file (as when it is re-opened), & processing carries on from there
+    '''
+    with tempfile.TemporaryDirectory() as tmp:
+        db      = SQLiteDB(os.path.join(tmp, 'test.db'))
+        batches = SyntheticSurvey(CONFIG).gen_batches(db)
+        with contextlib.redirect_stdout(io.StringIO()):
+            process(itertools.islice(batches, 4), db)
+            before, failed = held(db), False
+            b = next(batches)
+            try:
+                with db.transaction():
+                    similar = near_dups.find_similar_in_batches([b], db)
+                    for i, t in enumerate(b.tracklets.values()):
+                        for ObsID, obs in t.observations.items():
+                            ObsGroup(obs, db, similar_obs=similar[ObsID])
+                        t.tracklet_processing_A____Top_level_process_handler({}, db)
+                        if i == len(b.tracklets) // 2:
+                            raise RuntimeError('part-way through the batch')
+            except RuntimeError:
+                failed = True
+            assert failed and held(db) == held(SQLiteDB(db.filepath)) == before
+            assert len(db.OBSSTORE) == len(db.GROUPSTATUS) == len(db.TRACKLETS) == 0
+            process(batches, db)
+        assert held(db) == held(SQLiteDB(db.filepath)) != before
+
+# N.B. obs_group.compare_obs picks at random, so the runs can only be compared with a deterministic stand-in
+def compare_obs(selected_Obs, obs):
+    return selected_Obs if (selected_Obs.ObsID * 7919) % 13 <= (obs.ObsID * 7919) % 13 else obs
+
+def test_evict_keeps_pending():
+    '''
+    with all of the batches ingested ahead of their processing, the accepted observations are
+    still evicted from the cache (& the pending ones kept), without changing the results
+    '''
+    random_compare_obs, obs_group.compare_obs = obs_group.compare_obs, compare_obs
+    state   = np.random.get_state()
+    IDs     = {ID : ID.total for ID in DB_IDs.DB_ID.__subclasses__()}
+    try:
+        runs = []
+        for cache_rows in (10**6, 500):
+            # Same IDs & random numbers (e.g. for the orbit-fits) for each run
+            for ID, total in IDs.items():
+                ID.total = total
+            np.random.seed(0)
+            db = SQLiteDB(':memory:', cache_rows=cache_rows)
+            with contextlib.redirect_stdout(io.StringIO()):
+                batches = list(SyntheticSurvey(CONFIG).gen_batches(db))
+                n_obs   = len(db.OBSSTORE)
+                process(batches[:len(batches)//2], db)
+                cached  = len(db.OBSSTORE)
+                process(batches[len(batches)//2:], db)
+            db.flush()
+            runs.append((cached, db.conn.execute('SELECT ObsID, SimilarityGroupID, Destination FROM accepted_obs ORDER BY ObsID').fetchall()))
+        (kept, whole), (evicted, results) = runs
+        assert kept == n_obs and evicted < n_obs / 2
+        assert len(whole) == n_obs and whole == results
+    finally:
+        obs_group.compare_obs = random_compare_obs
+        np.random.set_state(state)
+
+
+if __name__ == '__main__':
+    test_load_motion_in_chunks()
+    test_rollback_reloads()
+    test_evict_keeps_pending()
+    print('ok')
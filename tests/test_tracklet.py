@@ -0,0 +1,158 @@
+
+# -------------------------------------------------------------
+# Third Party Imports
+# -------------------------------------------------------------
+import sys, os, io, contextlib
+import numpy as np
+
+# -------------------------------------------------------------
+# Local Imports
+# -------------------------------------------------------------
+sys.path.append(os.path.join(
+                    os.path.dirname(
+                        os.path.dirname(
+                            os.path.realpath(__file__))), 'obs_overlap'))
+sys.path.append(os.path.join(
+                    os.path.dirname(
+                        os.path.dirname(
+                            os.path.realpath(__file__))), 'benchmarks'))
+
+import db as DB_IDs
+from db import DB
+from sqlite_db import SQLiteDB
+import obs_group
+from obs_group import ObsGroup
+import tracklet
+import near_dups
+from obs import Obs
+from batch import Batch
+from synthetic import SyntheticSurvey, DEFAULT_CONFIG
+
+
+# Dense sky, plenty of duplicates & designations (=> every overlap category)
+CONFIG = DEFAULT_CONFIG._replace(n_obs=6000, obs_per_batch=300, n_fields=10,
+                                 p_exact=0.2, p_near=0.2, p_replaces=0.1, p_deleted=0.05, p_extend=0.15, p_desig=0.5)
+
+# N.B. In some batches of the seed=2 survey, the processing of one tracklet moves ITF tracklets
+#      (that other tracklets overlap) to DESIGNATED: see tracklet.independent_tracklets
+SEEDS  = (1, 2)
+
+# N.B. obs_group.compare_obs picks at random, & the random numbers are shared with the
+#      orbit-fits: so the two orders of processing can only be compared with a deterministic stand-in
+def compare_obs(selected_Obs, obs):
+    return selected_Obs if (selected_Obs.ObsID * 7919) % 13 <= (obs.ObsID * 7919) % 13 else obs
+
+
+def process(config, db, ahead):
+    '''
+    process a synthetic survey, optionally setting-up the independent tracklets of each batch
+    first (see tracklet.set_up_independent_tracklets), & checking that their (batch) categorization
+    is that of tracklet.categorize_tracklet_overlap when they come to be processed
+
+    returns:
+    --------
+    (overlap category, desig & itf, destinations) of each tracklet, in order, & the number set-up ahead
+    '''
+    results, n_ahead = [], 0
+    with contextlib.redirect_stdout(io.StringIO()):
+        for b in SyntheticSurvey(config).gen_batches(db):
+            with db.transaction():
+                similar = near_dups.find_similar_in_batches([b], db)
+                done    = tracklet.set_up_independent_tracklets(b, db, similar) if ahead else set()
+                n_ahead+= len(done)
+                for t in b.tracklets.values():
+                    if t.TrackletID not in done:
+                        for ObsID, obs in t.observations.items():
+                            ObsGroup(obs, db, similar_obs=similar[ObsID])
+                    else:
+                        batch = (t.SELECTABLE, t.overlap_category, t.overlap_desig, t.overlap_itf)
+                        t.overlap_desig = t.overlap_itf = None
+                        tracklet.categorize_tracklet_overlap(t, db)
+                        assert batch == (t.SELECTABLE, t.overlap_category, t.overlap_desig, t.overlap_itf), f'TrackletID={t.TrackletID}'
+                    t.tracklet_processing_A____Top_level_process_handler({}, db)
+                    results.append((t.overlap_category, t.overlap_desig, t.overlap_itf, tuple(obs.Destination for obs in t.observations.values())))
+    return results, n_ahead
+
+def test_independent_tracklets_set_up_ahead():
+    '''
+    Setting-up (& categorizing) the independent tracklets of each batch all at once
+    gives the same categorization (see process) & the same destinations as doing
+    each tracklet in turn, into a DB & a SQLiteDB
+    '''
+    random_compare_obs, obs_group.compare_obs = obs_group.compare_obs, compare_obs
+    state = np.random.get_state()
+    try:
+        for seed in SEEDS:
+            config = CONFIG._replace(seed=seed)
+            IDs    = {ID : ID.total for ID in DB_IDs.DB_ID.__subclasses__()}
+            runs   = []
+            for db, ahead in ((DB(), False), (DB(), True), (SQLiteDB(':memory:'), True)):
+                # Same IDs (e.g. in designations) & random numbers (e.g. for the orbit-fits) for each run
+                for ID, total in IDs.items():
+                    ID.total = total
+                np.random.seed(0)
+                runs.append(process(config, db, ahead))
+            (every, _), (ahead, n_ahead), (sqlite, _) = runs
+            assert 0 < n_ahead < len(every)
+            assert every == ahead == sqlite, f'seed={seed}: setting-up ahead changed {sum(a != b for a, b in zip(every, ahead))} tracklets'
+    finally:
+        obs_group.compare_obs = random_compare_obs
+        np.random.set_state(state)
+
+def test_independent_tracklets():
+    ''' tracklets that overlap others in the batch (or ITF tracklets) are not independent '''
+    db = DB()
+    def tracklet_at(RA, Dec):
+        return tracklet.Tracklet([Obs(RA + 0.1*i, Dec + 0.1*i, f'2020-03-20T1{4+i}:32:16.458361', '568', None, None, None, db) for i in range(3)], db)
+
+    # Earlier tracklets: two designated & one in the ITF
+    P, Q, R = tracklet_at(20., 30.), tracklet_at(80., -10.), tracklet_at(40., 50.)
+    earlier = Batch('2020-04-20T14:32:16.458361', 'A0', [P, Q, R], db)
+    with db.transaction(), contextlib.redirect_stdout(io.StringIO()):
+        similar = near_dups.find_similar_in_batches([earlier], db)
+        for t in earlier.tracklets.values():
+            for ObsID, obs in t.observations.items():
+                ObsGroup(obs, db, similar_obs=similar[ObsID])
+        P.assign_to_DESIGNATED(db, 'K20A00A')
+        Q.assign_to_DESIGNATED(db, 'K20A00B')
+        R.assign_to_ITF(db)
+
+    #   A : near-dup of P               C : new                 D : near-dup of C
+    #   E & F : both near-dups of Q     G : near-dup of R (in the ITF)
+    A, C, D    = tracklet_at(20.00001, 30.), tracklet_at(60., 10.), tracklet_at(60., 10.)
+    E, F, G    = tracklet_at(80., -10.), tracklet_at(80.00001, -10.), tracklet_at(40., 50.)
+    b = Batch('2020-04-20T15:32:16.458361', 'A1', [A, C, D, E, F, G], db)
+    assert tracklet.independent_tracklets(b, db, near_dups.find_similar_in_batches([b], db)) == [A, C]
+
+def test_categorize_overlaps():
+    ''' the batch categorization of every overlap category is as for a single tracklet '''
+    random_compare_obs, obs_group.compare_obs = obs_group.compare_obs, compare_obs
+    try:
+        db = DB()
+        with contextlib.redirect_stdout(io.StringIO()):
+            processed = []
+            for b in SyntheticSurvey(CONFIG._replace(seed=3)).gen_batches(db):
+                with db.transaction():
+                    similar = near_dups.find_similar_in_batches([b], db)
+                    for t in b.tracklets.values():
+                        for ObsID, obs in t.observations.items():
+                            ObsGroup(obs, db, similar_obs=similar[ObsID])
+
+                        # N.B. Before any later observations change the categories of the groups
+                        tracklet.categorize_tracklet_overlap(t, db)
+                        single = (t.SELECTABLE, t.overlap_category, t.overlap_desig, t.overlap_itf)
+                        t.overlap_desig = t.overlap_itf = None
+                        tracklet.categorize_overlaps([t], db)
+                        assert single == (t.SELECTABLE, t.overlap_category, t.overlap_desig, t.overlap_itf), f'TrackletID={t.TrackletID}'
+                        t.tracklet_processing_A____Top_level_process_handler({}, db)
+                        processed.append(t)
+        assert len(set(t.overlap_category for t in processed if t.SELECTABLE)) >= 4
+    finally:
+        obs_group.compare_obs = random_compare_obs
+
+
+if __name__ == '__main__':
+    test_independent_tracklets()
+    test_categorize_overlaps()
+    test_independent_tracklets_set_up_ahead()
+    print('ok')